@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark flyingcloud's own overhead, offline, against a fake Docker Engine.
+
+    python benchmarks/run_benchmarks.py --json results.json
+    python benchmarks/run_benchmarks.py --quick -k stream --compare results.json
+
+Docker operations go to a `FakeEngine` (flyingcloud.utils.fake_engine),
+so what is measured is flyingcloud's orchestration: stream decoding and
+logging, squash I/O, progress handling, scheduling of concurrent calls,
+and zipping bundles. Benchmarks of the synchronous Docker operations need
+docker-py 1.x (`docker.Client`), as flyingcloud itself does.
+"""
+
+from __future__ import print_function, absolute_import
+
+import argparse
+import fnmatch
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import stat
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import docker  # noqa: E402
+
+from flyingcloud.base import DockerBuildLayer  # noqa: E402
+from flyingcloud.utils import find_in_path, run_command  # noqa: E402
+from flyingcloud.utils.benchmark import (  # noqa: E402
+    Measure, Skip, run_benchmark, report, load_report, compare, format_table)
+from flyingcloud.utils.docker_util import DockerClientRegistry  # noqa: E402
+from flyingcloud.utils.fake_engine import FakeEngine, StreamHeader  # noqa: E402
+from flyingcloud.utils.log_util import configure_logging, stop_logging  # noqa: E402
+from flyingcloud.utils.metrics import MetricsRegistry  # noqa: E402
+from flyingcloud.utils.package_build import build_package  # noqa: E402
+from flyingcloud.utils.trace import Tracer  # noqa: E402
+
+
+LoggerName = "flyingcloud.benchmarks"
+
+FakeDockerSquash = """#!/bin/sh
+# docker-squash -i INPUT -o OUTPUT ...: copy, so only flyingcloud's I/O is measured
+exec cp "$2" "$4"
+"""
+
+
+class BenchLayer(DockerBuildLayer):
+    """Talks to the fake engine, and squashes with `cp`."""
+    def docker_client(self, namespace, *args, **kwargs):
+        kwargs.setdefault('base_url', namespace.base_url)
+        return super(BenchLayer, self).docker_client(namespace, *args, **kwargs)
+
+    def find_binary(self, namespace, filename, search_paths=None):
+        if filename == 'docker-squash':
+            return namespace.docker_squash
+        return super(BenchLayer, self).find_binary(namespace, filename, search_paths)
+
+
+class Context(object):
+    def __init__(self, quick, unix_socket):
+        self.quick = quick
+        self.tempdir = tempfile.mkdtemp(prefix="flyingcloud-bench-")
+        self.engine = FakeEngine(
+            socket_path=os.path.join(self.tempdir, "docker.sock") if unix_socket else None).start()
+        self.logger = configure_logging(
+            LoggerName, os.path.join(self.tempdir, "bench.log"), level=logging.WARNING)
+        self.docker_squash = os.path.join(self.tempdir, "docker-squash")
+        with open(self.docker_squash, 'w') as f:
+            f.write(FakeDockerSquash)
+        os.chmod(self.docker_squash, stat.S_IRWXU)
+        self.layer = BenchLayer("bench", "app", "bench_base", "benchmarks")
+
+    def close(self):
+        self.engine.stop()
+        stop_logging(LoggerName)
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def size(self, full, quick):
+        return quick if self.quick else full
+
+    def engine_settings(self, **settings):
+        """Reset the fake engine, then apply `settings`."""
+        self.engine.configure(**dict(FakeEngine.Defaults, **settings))
+
+    def namespace(self, sync_client=True):
+        namespace = argparse.Namespace(
+            base_url=self.engine.base_url,
+            logger=self.logger,
+            timeout=60,
+            retries=1,
+            logged_in=True,
+            use_docker_machine=False,
+            kill_containers=False,
+            stop_timeout=1,
+            docker_squash=self.docker_squash,
+            tracer=Tracer(),
+            metrics=MetricsRegistry(),
+            docker_clients=DockerClientRegistry(),
+        )
+        if sync_client:
+            if not hasattr(docker, 'Client'):
+                raise Skip("needs docker-py 1.x (docker.Client); found docker {}".format(docker.__version__))
+            namespace.docker = self.layer.docker_client(namespace, timeout=namespace.timeout)
+        return namespace
+
+    def close_namespace(self, namespace):
+        self.layer.close_docker_clients(namespace)
+
+
+Benchmarks = []
+
+
+def benchmark(name):
+    def register(func):
+        Benchmarks.append((name, func))
+        return func
+    return register
+
+
+# read_docker_output_stream, fed from memory
+
+def stream_benchmark(ctx, chunks):
+    layer = ctx.layer
+    namespace = ctx.namespace(sync_client=False)
+    return Measure(
+        run=lambda: layer.read_docker_output_stream(namespace, iter(chunks), "docker_exec"),
+        work=sum(len(c) for c in chunks) / 1e6, unit="MB")
+
+
+@benchmark("stream/json_progress")
+def bench_stream_json(ctx):
+    ctx.engine_settings(layers=ctx.size(20, 4), layer_bytes=100 << 20, progress_step_bytes=64 << 10)
+    return stream_benchmark(ctx, list(ctx.engine.json_lines(
+        ctx.engine.progress_messages('pull', "bench/app", "latest"))))
+
+
+@benchmark("stream/exec_text")
+def bench_stream_text(ctx):
+    ctx.engine_settings(exec_output_bytes=ctx.size(32 << 20, 4 << 20))
+    return stream_benchmark(ctx, [frame[StreamHeader.size:] for frame in ctx.engine.exec_frames()])
+
+
+@benchmark("stream/invalid_utf8")
+def bench_stream_invalid(ctx):
+    # Every fourth chunk takes the hexdump fallback
+    ctx.engine_settings(exec_output_bytes=ctx.size(8 << 20, 1 << 20), exec_invalid_utf8_every=4)
+    return stream_benchmark(ctx, [frame[StreamHeader.size:] for frame in ctx.engine.exec_frames()])
+
+
+# Docker operations, through docker-py and the fake engine
+
+@benchmark("exec/stream")
+def bench_exec(ctx):
+    size = ctx.size(32 << 20, 4 << 20)
+    ctx.engine_settings(exec_output_bytes=size)
+    namespace = ctx.namespace()
+    return Measure(
+        run=lambda: ctx.layer.docker_exec(namespace, "c" * 64, ["salt-call", "state.highstate"]),
+        work=size / 1e6, unit="MB", teardown=lambda: ctx.close_namespace(namespace))
+
+
+def transfer_benchmark(ctx, verb):
+    ctx.engine_settings(layers=ctx.size(10, 4), layer_bytes=ctx.size(100 << 20, 20 << 20))
+    namespace = ctx.namespace()
+    method = getattr(ctx.layer, "docker_" + verb)
+    messages = len(list(ctx.engine.progress_messages(verb, "bench/app", "latest")))
+    return Measure(
+        run=lambda: method(namespace, "bench/app:latest"),
+        work=messages, unit="msg", teardown=lambda: ctx.close_namespace(namespace))
+
+
+@benchmark("transfer/pull_progress")
+def bench_pull(ctx):
+    return transfer_benchmark(ctx, "pull")
+
+
+@benchmark("transfer/push_progress")
+def bench_push(ctx):
+    return transfer_benchmark(ctx, "push")
+
+
+@benchmark("squash/io")
+def bench_squash(ctx):
+    size = ctx.size(256 << 20, 32 << 20)
+    ctx.engine_settings(image_bytes=size)
+    namespace = ctx.namespace()
+    return Measure(
+        run=lambda: ctx.layer.docker_squash(
+            namespace, "bench/app:new", "bench/app:latest", "bench/app:squashed"),
+        # Saved, then loaded
+        work=2 * size / 1e6, unit="MB", teardown=lambda: ctx.close_namespace(namespace))
+
+
+# Scheduling: N layers' worth of pulls and teardowns, when each call waits on the daemon
+
+def schedule_settings(ctx):
+    ctx.engine_settings(
+        latency=0.02, stream_interval=0.002, layers=3, layer_bytes=4 << 20, progress_step_bytes=1 << 20)
+    return ["bench/layer{}:latest".format(i) for i in range(ctx.size(8, 4))]
+
+
+@benchmark("schedule/pull_sequential")
+def bench_pull_sequential(ctx):
+    images = schedule_settings(ctx)
+    namespace = ctx.namespace()
+
+    def run():
+        for image in images:
+            ctx.layer.docker_pull(namespace, image)
+    return Measure(run=run, work=len(images), unit="layer", teardown=lambda: ctx.close_namespace(namespace))
+
+
+@benchmark("schedule/pull_threads")
+def bench_pull_threads(ctx):
+    images = schedule_settings(ctx)
+    namespace = ctx.namespace()
+    return Measure(
+        run=lambda: ctx.layer.map_concurrently(lambda image: ctx.layer.docker_pull(namespace, image), images),
+        work=len(images), unit="layer", teardown=lambda: ctx.close_namespace(namespace))
+
+
+@benchmark("schedule/pull_asyncio")
+def bench_pull_asyncio(ctx):
+    try:
+        import asyncio
+        from flyingcloud.utils.docker_async import AsyncDockerBackend
+    except (ImportError, SyntaxError) as e:
+        raise Skip("no asyncio backend: {}".format(e))
+    images = schedule_settings(ctx)
+    namespace = ctx.namespace(sync_client=False)
+    backend = AsyncDockerBackend(ctx.layer, base_url=ctx.engine.base_url)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)  # for gather
+
+    def teardown():
+        asyncio.set_event_loop(None)
+        loop.close()
+    return Measure(
+        run=lambda: loop.run_until_complete(asyncio.gather(
+            *[backend.docker_pull(namespace, image) for image in images])),
+        work=len(images), unit="layer", teardown=teardown)
+
+
+@benchmark("schedule/teardown")
+def bench_teardown(ctx):
+    ctx.engine_settings(latency=0.02)
+    containers = ["{:064x}".format(i) for i in range(ctx.size(16, 8))]
+    namespace = ctx.namespace()
+    return Measure(
+        run=lambda: ctx.layer.docker_teardown(namespace, containers),
+        work=len(containers), unit="container", teardown=lambda: ctx.close_namespace(namespace))
+
+
+# zip_package, on synthetic trees
+
+def make_tree(root, files, seed=0):
+    """`files` files under nested directories: mostly compressible text, some
+    incompressible "images"; returns their total size."""
+    rng = random.Random(seed)
+    words = [u"".join(rng.choice(u"abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 10)))
+             for _ in range(500)]
+    total = 0
+    for i in range(files):
+        dirname = os.path.join(root, "pkg{}".format(i % 10), "mod{}".format(i % 37))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        if i % 10 == 0:
+            name, data = "image{}.png".format(i), bytes(bytearray(rng.getrandbits(8) for _ in range(32 << 10)))
+        else:
+            name = "module{}.py".format(i)
+            data = u" ".join(rng.choice(words) for _ in range(rng.randint(100, 2000))).encode('utf-8')
+        with open(os.path.join(dirname, name), 'wb') as f:
+            f.write(data)
+        total += len(data)
+    return total
+
+
+def zip_benchmark(ctx, name, *extra_args, **kwargs):
+    root = os.path.join(ctx.tempdir, name)
+    os.makedirs(os.path.join(root, "app"))
+    size = make_tree(os.path.join(root, "app"), ctx.size(2000, 200))
+    if kwargs.get('git'):
+        if not find_in_path("git"):
+            raise Skip("git not installed")
+        run_command(["git", "init", "-q"], cwd=root)
+        run_command(["git", "add", "."], cwd=root)
+    args = [os.path.join(root, "app"), "--prefix", os.path.join(root, "bundle"),
+            "--build-date", "20170101t000000z", "--build-number", "1",
+            "--branch-name", "master", "--vcs-sha", "abcdef0"] + list(extra_args)
+    if kwargs.get('previous'):
+        shutil.copy(build_package(args), os.path.join(root, "previous.zip"))
+        args += ["--previous-bundle", os.path.join(root, "previous.zip")]
+    return Measure(run=lambda: build_package(list(args)), work=size / 1e6, unit="MB")
+
+
+@benchmark("zip_package/walk")
+def bench_zip_walk(ctx):
+    return zip_benchmark(ctx, "zip-walk")
+
+
+@benchmark("zip_package/from_vcs")
+def bench_zip_vcs(ctx):
+    return zip_benchmark(ctx, "zip-vcs", "--from-vcs", git=True)
+
+
+@benchmark("zip_package/reuse_previous")
+def bench_zip_previous(ctx):
+    return zip_benchmark(ctx, "zip-previous", previous=True)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark flyingcloud against a fake Docker Engine.")
+    parser.add_argument(
+        '-k', dest='patterns', action='append', metavar="PATTERN",
+        help="Run only benchmarks whose names match PATTERN (a glob, or a substring). May be repeated.")
+    parser.add_argument('--list', action='store_true', help="List the benchmarks and exit.")
+    parser.add_argument('--quick', action='store_true', help="Smaller workloads, fewer repeats.")
+    parser.add_argument('--repeat', type=int, metavar="N", help="Timed runs of each. Default: 5 (--quick: 3)")
+    parser.add_argument('--warmup', type=int, default=1, metavar="N", help="Untimed runs first. Default: %(default)d")
+    parser.add_argument(
+        '--unix-socket', action='store_true',
+        help="Serve the fake engine on a unix socket, rather than TCP on localhost.")
+    parser.add_argument('--json', metavar="FILE", help="Write the results to FILE.")
+    parser.add_argument('--compare', metavar="FILE", help="Compare with the results in FILE (from --json).")
+    parser.add_argument(
+        '--threshold', type=float, default=0.1, metavar="FRACTION",
+        help="With --compare, a median time more than FRACTION slower is a regression "
+             "(and the exit status is 1). Default: %(default)s")
+    return parser.parse_args(args)
+
+
+def selected(name, patterns):
+    return not patterns or any(fnmatch.fnmatch(name, p) or p in name for p in patterns)
+
+
+def main(args=None):
+    namespace = parse_args(args)
+    benchmarks = [(name, func) for name, func in Benchmarks if selected(name, namespace.patterns)]
+    if namespace.list:
+        print("\n".join(name for name, _ in benchmarks))
+        return 0
+    repeat = namespace.repeat or (3 if namespace.quick else 5)
+
+    ctx = Context(namespace.quick, namespace.unix_socket)
+    results = []
+    try:
+        for name, func in benchmarks:
+            print("{} ...".format(name), file=sys.stderr)
+            params = dict(quick=namespace.quick, transport="unix" if namespace.unix_socket else "tcp")
+            try:
+                results.append(run_benchmark(
+                    name, func, repeat=repeat, warmup=namespace.warmup, args=(ctx,), params=params))
+            except Exception as e:
+                ctx.logger.exception("%s failed", name)
+                results.append(dict(name=name, params=params, error=repr(e)))
+    finally:
+        ctx.close()
+
+    comparisons = []
+    if namespace.compare:
+        comparisons = compare(results, load_report(namespace.compare)['results'], namespace.threshold)
+    print(format_table(results, comparisons))
+    if namespace.json:
+        with io.open(namespace.json, 'w') as f:
+            f.write(json.dumps(report(results, comparisons=comparisons), indent=2, sort_keys=True))
+    failed = any('error' in r for r in results) or any(c['regressed'] for c in comparisons)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,8 +4,13 @@
 from __future__ import print_function, unicode_literals, absolute_import
 
 import argparse
+import calendar
+import collections
+import concurrent.futures
 import datetime
 import glob
+import hashlib
+import inspect
 import json
 import tempfile
 
@@ -18,17 +23,38 @@ import platform
 
 import psutil
 import requests
+import six
 
 import re
 import sh
+import sqlite3
+import sys
 import time
 
 from .exceptions import *
 from .utils import disk_usage, abspath, hexdump
-from .utils.docker_util import retry_call
+from .utils.build_context import (
+    make_build_context, build_context_files, context_digest, dockerfile_base_images)
+from .utils.build_report import layer_report, format_report, parse_salt_states
+from .utils.build_store import BuildStore
+from .utils.docker_util import retry_call, DockerClientRegistry
+from .utils.log_util import StreamLogger, configure_logging
+from .utils.metrics import default_registry, transfer_bytes
+from .utils.process import iter_command, STDOUT, CalledProcessError
+from .utils.profiler import start_profiler
+from .utils.resource_sampler import ResourceSampler
+from .utils.trace import Tracer
+from .utils.vcs import find_vcs
 
 STREAMING_CHUNK_SIZE = (1 << 20)
 
+# Per-container outcome of `DockerBuildLayer.docker_teardown`
+TeardownResult = collections.namedtuple(
+    'TeardownResult', 'container stopped removed error duration')
+
+# An image tag, container, or remote tag that `DockerBuildLayer.do_gc` removes
+GCAction = collections.namedtuple('GCAction', 'kind name size error')
+
 
 # TODO
 # - do a better job of logging container-ids and image-ids
@@ -45,6 +71,23 @@ class DockerBuildLayer(object):
     # Override these as necessary
     SaltExecTimeout = 45 * 60  # seconds, for long-running commands
     DefaultTimeout = 5 * 60  # need longer than default timeout for most commands
+    StopTimeout = 10  # seconds to wait for a container to stop before Docker kills it
+    EcrLoginTimeout = 2 * 60  # seconds for `aws ecr get-login`
+    DockerWorkers = 8  # concurrent Docker API calls, for teardown and gc
+    GCKeep = 5  # most recent builds of a layer kept by --gc
+    LogStreamInterval = 0.5  # seconds of Docker stream output to batch into one log record
+    LogStreamMaxLines = 100  # most lines in one such record
+    LogStreamRateLimit = 500  # lines per second of Docker stream output logged; the rest are counted
+    StatsInterval = 5.0  # seconds between samples of the build container's resource use
+    ReportRuns = 20  # builds of a layer shown by --report
+    ReportWindow = 10  # earlier successful builds whose median is a build's baseline
+    ReportThreshold = 0.5  # fraction slower than the baseline that's a regression
+    ReportMinRegression = 5.0  # seconds slower than the baseline that's a regression
+    ContextDigestLabel = 'com.flyingcloud.context-digest'
+    TimestampFormat = '%Y-%m-%dt%H%M%Sz'  # of build tags
+    CacheFromApiVersion = '1.25'  # first Docker API version with `docker build --cache-from`
+    LabelsApiVersion = '1.23'  # first Docker API version with `docker build --label`
+    TargetApiVersion = '1.29'  # first Docker API version with `docker build --target`
 
     USERNAME_ENV_VAR = 'FLYINGCLOUD_DOCKER_REGISTRY_USERNAME'
     PASSWORD_ENV_VAR = 'FLYINGCLOUD_DOCKER_REGISTRY_PASSWORD'
@@ -73,7 +116,11 @@ class DockerBuildLayer(object):
             pull_images=None,
             registry_config=None,
             source_version_tag="latest",
-            environment=None
+            environment=None,
+            build_context=None,
+            cache_from=None,
+            build_args=None,
+            build_target=None
     ):
         self.app_name = app_name
         self.layer_name = layer_name
@@ -83,6 +130,9 @@ class DockerBuildLayer(object):
         self.exposed_ports = exposed_ports or []
         self.pull_images = pull_images or []
         self.environment = environment
+        self.build_context = build_context
+        self.build_args = build_args
+        self.build_target = build_target
 
         config = self.RegistryConfig.copy()
         if registry_config:
@@ -94,6 +144,7 @@ class DockerBuildLayer(object):
         self.container_name = container_name or "{}_{}".format(self.app_name, self.layer_name)
         self.docker_layer_name = "{}{}".format(host_org, self.container_name)
         self.layer_latest_name = "{}:latest".format(self.docker_layer_name)
+        self.cache_from = cache_from  # None: see cache_from_images
 
         if self.source_image_base_name:
             if '/' in self.source_image_base_name:
@@ -106,12 +157,22 @@ class DockerBuildLayer(object):
 
         # These require the command-line args to properly initialize
         self.layer_timestamp_name = self.layer_squashed_name = None
+        self.build_start_time = self.build_input_hash = None
+        self.build_cache_hit = self.build_source_sha = None
+        self.salt_states = []
 
     def main(self, defaults, layer_classes, **kwargs):
         self.check_user_is_root()
+        defaults = dict(defaults or {}, profiler=start_profiler(sys.argv[1:]))
         namespace = self.parse_args(defaults, layer_classes, **kwargs)
         self.check_environment_variables(namespace)
-        self.do_operation(namespace)
+        try:
+            self.do_operation(namespace)
+        finally:
+            self.close_docker_clients(namespace)
+            self.write_trace(namespace)
+            self.write_metrics(namespace)
+            self.write_profile(namespace)
 
     def repository_host(self, config):
         host, org = config['host'], config['organization']
@@ -138,7 +199,45 @@ class DockerBuildLayer(object):
 
     def do_operation(self, namespace):
         method = getattr(self, 'do_' + namespace.operation)
-        return method(namespace)
+        with self.trace(namespace, "layer " + self.layer_name, operation=namespace.operation):
+            return method(namespace)
+
+    def trace(self, namespace, name, **args):
+        """Context manager: a span named `name` on the build timeline (see --trace)."""
+        tracer = getattr(namespace, 'tracer', None)
+        if tracer is None:
+            tracer = namespace.tracer = Tracer()
+        return tracer.span(name, category=self.layer_name, **args)
+
+    def metrics(self, namespace):
+        """The run's MetricsRegistry (see --metrics-file)."""
+        return getattr(namespace, 'metrics', None) or default_registry
+
+    def write_metrics(self, namespace):
+        metrics_file = getattr(namespace, 'metrics_file', None)
+        metrics_json = getattr(namespace, 'metrics_json', None)
+        if not (metrics_file or metrics_json):
+            return
+        metrics = self.metrics(namespace)
+        metrics.set('flyingcloud_last_run_timestamp_seconds', time.time(),
+                    help="When the run finished.",
+                    layer=self.layer_name, operation=namespace.operation)
+        if metrics_file:
+            metrics.write_textfile(metrics_file)
+            namespace.logger.info("Wrote metrics to %s", metrics_file)
+        if metrics_json:
+            metrics.write_json(metrics_json)
+            namespace.logger.info("Wrote metrics summary to %s", metrics_json)
+
+    def write_trace(self, namespace):
+        if getattr(namespace, 'trace_file', None) and getattr(namespace, 'tracer', None):
+            namespace.tracer.write(namespace.trace_file)
+            namespace.logger.info("Wrote build timeline to %s", namespace.trace_file)
+
+    def write_profile(self, namespace):
+        profiler = getattr(namespace, 'profiler', None)
+        if profiler:
+            namespace.logger.info("Wrote profile to %s", ", ".join(profiler.write()))
 
     def do_run(self, namespace):
         self.port_forwarding(namespace)
@@ -190,24 +289,238 @@ class DockerBuildLayer(object):
         return env
 
     def do_kill(self, namespace):
+        results = []
         try:
-            for c in namespace.docker.containers(filters=dict(ancestor=self.docker_layer_name)):
-                self.docker_cleanup(namespace, c['Id'])
+            containers = namespace.docker.containers(filters=dict(ancestor=self.docker_layer_name))
+            results = self.docker_teardown(namespace, [c['Id'] for c in containers])
         except (docker.errors.DockerException, docker.errors.APIError):
             pass
         self.kill_port_forwarding(namespace)
+        return results
 
     def do_build(self, namespace):
         namespace.logger.info("Build starting...")
         self.log_disk_usage(namespace)
         self.docker_info(namespace)
         if self.should_build(namespace):
-            self.build(namespace)
+            start_time, status = time.time(), 'failed'
+            try:
+                self.build(namespace)
+                status = 'success'
+            except Exception:
+                try:
+                    self.record_build(namespace, self.layer_timestamp_name, 'failed')
+                except sqlite3.Error:
+                    namespace.logger.exception("Couldn't record failed build")
+                raise
+            finally:
+                self.metrics(namespace).observe(
+                    'flyingcloud_build_duration_seconds', time.time() - start_time,
+                    help="Duration of layer builds.", layer=self.layer_name, status=status)
         namespace.logger.info("Build finished")
 
     def should_build(self, namespace):
         return True
 
+    def do_gc(self, namespace):
+        """Remove old images, leftover build containers and (optionally) old remote tags.
+
+        The `--gc-keep` most recent builds, anything tagged `latest`,
+        and the latest tag and successful build in the build store are kept;
+        with `--gc-max-age-days`, so is anything younger than that.
+        """
+        actions = self.gc_plan(namespace)
+        reclaimable = sum(a.size for a in actions)
+        verb = "Would remove" if namespace.dry_run else "Removing"
+        for a in actions:
+            namespace.logger.info("%s %s %s (%d bytes)", verb, a.kind, a.name, a.size)
+        namespace.logger.info(
+            "%s %d image tags, %d containers, %d remote tags: %d bytes reclaimable",
+            verb, *([len([a for a in actions if a.kind == kind])
+                     for kind in ('image', 'container', 'remote_tag')] + [reclaimable]))
+        if namespace.dry_run:
+            return actions
+
+        actions = self.map_concurrently(lambda a: self.gc_remove(namespace, a), actions)
+        store = self.build_store(namespace)  # on this thread: its connection can't be shared
+        for a in actions:
+            if a.error:
+                namespace.logger.error("Couldn't remove %s %s: %s", a.kind, a.name, a.error)
+            elif a.kind == 'remote_tag':
+                repo, _, tag = a.name.rpartition(':')
+                store.mark_unpushed(repo, tag)
+        self.log_disk_usage(namespace)
+        return actions
+
+    def do_report(self, namespace):
+        """Print the build history of the project's layers: the trend, median and
+        95th percentile of their build durations, and regressed builds;
+        then this layer's recent builds, and how long the phases and salt states
+        of its latest build took, against the builds before it.
+        Layers that are no longer configured, but have history, come last."""
+        layers = [layer for layer in (namespace.layer_dict or {}).values()
+                  if isinstance(layer, DockerBuildLayer)] or [self]
+        store = self.build_store(namespace)
+        configured = [(layer.docker_layer_name, layer.layer_name) for layer in layers]
+        repos = set(repo for repo, layer_name in configured)
+        removed = [(repo, layer_name) for repo, layer_name in store.history_repos() if repo not in repos]
+        reports = [
+            dict(layer_report(
+                store, repo, runs=namespace.report_runs,
+                window=namespace.report_window, threshold=namespace.report_threshold,
+                min_delta=self.ReportMinRegression), layer=layer_name, configured=repo in repos)
+            for repo, layer_name in configured + removed]
+        print(format_report(reports, detail=self.docker_layer_name))
+        if namespace.report_json:
+            with open(namespace.report_json, 'w') as f:
+                json.dump(reports, f, indent=2, sort_keys=True)
+            namespace.logger.info("Wrote build history to %s", namespace.report_json)
+        return reports
+
+    @classmethod
+    def build_of_tag(cls, tag):
+        """The timestamp tag of the build that produced `tag` (e.g., a `-sq` or `_fail` variant)."""
+        return re.sub(r'(-sq|_fail)$', '', tag)
+
+    def gc_plan(self, namespace):
+        now = time.time()
+        repo = self.docker_layer_name
+        tagged = []
+        for image in namespace.docker.images(name=repo):
+            for repo_tag in image.get('RepoTags') or []:
+                image_repo, _, tag = repo_tag.rpartition(':')
+                if image_repo == repo:
+                    tagged.append((tag, image))
+
+        store = self.build_store(namespace)
+        latest_tag = store.latest_tag(repo)
+        latest_build = store.latest_successful_build(repo)
+        protected_ids = set(image['Id'] for tag, image in tagged if tag == 'latest')
+        if latest_build and latest_build['image_id']:
+            protected_ids.add(latest_build['image_id'])
+        # Only timestamp tags are builds; anything else (e.g., `stable`) is kept
+        builds = dict((build, self.build_time(namespace, build))
+                      for build in set(self.build_of_tag(tag) for tag, _ in tagged))
+        keep_builds = set(build for build, built in builds.items() if built is None)
+        keep_builds.update(sorted(
+            (build for build, built in builds.items() if built is not None),
+            key=builds.get, reverse=True)[:namespace.gc_keep])
+        if latest_tag:
+            keep_builds.add(self.build_of_tag(latest_tag))
+        max_age = namespace.gc_max_age_days and namespace.gc_max_age_days * 24 * 60 * 60
+
+        def expired(created):
+            return not max_age or now - created > max_age
+
+        remove_names = set()
+        for tag, image in tagged:
+            if (tag != 'latest' and image['Id'] not in protected_ids
+                    and self.build_of_tag(tag) not in keep_builds and expired(image['Created'])):
+                remove_names.add("{}:{}".format(repo, tag))
+
+        actions = []
+        for image in dict((image['Id'], image) for _, image in tagged).values():
+            names = sorted(set(image['RepoTags']) & remove_names)
+            # Only removing an image's last tag frees its space
+            freed = image.get('Size', 0) if names and set(image['RepoTags']) <= remove_names else 0
+            actions.extend(GCAction('image', name, freed if name == names[-1] else 0, None)
+                           for name in names)
+
+        containers = {}
+        for filters in (dict(name="^/{}$".format(self.container_name)), dict(ancestor=repo)):
+            filters['status'] = ['created', 'exited', 'dead']
+            for c in namespace.docker.containers(all=True, size=True, filters=filters):
+                containers[c['Id']] = c
+        actions.extend(GCAction('container', c_id, c.get('SizeRw') or 0, None)
+                       for c_id, c in sorted(containers.items()))
+
+        if namespace.gc_remote:
+            # Tags imported from docker_tags.json were "created" when they were imported
+            actions.extend(
+                GCAction('remote_tag', "{}:{}".format(repo, b['tag']), 0, None)
+                for b in store.pushed_builds(repo)
+                if self.build_time(namespace, b['tag']) is not None
+                and self.build_of_tag(b['tag']) not in keep_builds
+                and expired(self.build_time(namespace, b['tag'])))
+        return actions
+
+    def build_time(self, namespace, tag):
+        """When the build of a timestamp tag started, in seconds since the epoch; None for other tags."""
+        try:
+            return calendar.timegm(time.strptime(
+                self.build_of_tag(tag), getattr(namespace, 'timestamp_format', self.TimestampFormat)))
+        except ValueError:
+            return None
+
+    def gc_remove(self, namespace, action):
+        try:
+            if action.kind == 'image':
+                # Untags; the image itself goes when its last tag does
+                self.docker_remove_image(namespace, action.name, force=False)
+            elif action.kind == 'container':
+                self.docker_remove_container(namespace, action.name, force=True)
+            elif action.kind == 'remote_tag':
+                repo, _, tag = action.name.rpartition(':')
+                self.registry_delete_tag(namespace, repo, tag)
+            return action
+        except (docker.errors.DockerException, docker.errors.APIError,
+                requests.exceptions.RequestException, DockerResultError) as e:
+            return action._replace(error=e)
+
+    RegistryManifestTypes = ', '.join([
+        'application/vnd.docker.distribution.manifest.v2+json',
+        'application/vnd.docker.distribution.manifest.list.v2+json',
+    ])
+
+    def registry_delete_tag(self, namespace, repo, tag):
+        """Delete a tag's manifest through the Docker Registry HTTP API v2.
+
+        Deleting a manifest deletes every tag that points to it,
+        so a tag sharing its manifest with `latest` is left alone.
+        """
+        host, _, name = repo.partition('/')
+        if not self.registry_config['host'] or self.registry_config['aws_ecr_region']:
+            raise DockerResultError("Can't delete remote tags from registry {!r}".format(host))
+        url = "https://{}/v2/{}/manifests/{{}}".format(host, name)
+        tokens = {}
+
+        def manifest_digest(reference):
+            r = self.registry_request(namespace, 'HEAD', url.format(reference), tokens,
+                                      headers={'Accept': self.RegistryManifestTypes})
+            return r.headers['Docker-Content-Digest']
+
+        digest = manifest_digest(tag)
+        if digest == manifest_digest('latest'):
+            raise DockerResultError("{}:{} is also 'latest'".format(repo, tag))
+        self.registry_request(namespace, 'DELETE', url.format(digest), tokens)
+        namespace.logger.info("Deleted %s:%s (%s) from registry", repo, tag, digest)
+
+    def registry_request(self, namespace, method, url, tokens, **kwargs):
+        """A Docker Registry API v2 request, authenticated as the registry's 401 asks:
+        with a bearer token for the challenge's scope (Quay, Docker Hub), kept in `tokens`,
+        or with basic auth."""
+        auth = (namespace.username, namespace.password) if namespace.username else None
+        r = requests.request(method, url, **kwargs)
+        if r.status_code == 401:
+            scheme, _, params = r.headers.get('WWW-Authenticate', '').partition(' ')
+            if scheme.lower() == 'bearer':
+                challenge = dict(re.findall(r'(\w+)="([^"]*)"', params))
+                key = (challenge.get('realm'), challenge.get('scope'))
+                if key not in tokens:
+                    token_response = requests.get(
+                        challenge['realm'], auth=auth,
+                        params=dict((k, v) for k, v in challenge.items() if k in ('service', 'scope')))
+                    token_response.raise_for_status()
+                    body = token_response.json()
+                    tokens[key] = body.get('token') or body.get('access_token')
+                kwargs['headers'] = dict(kwargs.get('headers') or {},
+                                         Authorization="Bearer {}".format(tokens[key]))
+                r = requests.request(method, url, **kwargs)
+            elif auth:
+                r = requests.request(method, url, auth=auth, **kwargs)
+        r.raise_for_status()
+        return r
+
     def initialize_build(self, namespace, salt_dir):
         """Override if you need special handling"""
         pass
@@ -217,6 +530,7 @@ class DockerBuildLayer(object):
         pass
 
     def build(self, namespace):
+        self.build_start_time = time.time()
         salt_dir = os.path.abspath(os.path.join(namespace.salt_dir, self.layer_name))
 
         if not os.path.exists(salt_dir):
@@ -226,6 +540,8 @@ class DockerBuildLayer(object):
 
         self.layer_timestamp_name = "{}:{}".format(self.docker_layer_name, namespace.timestamp)
         self.layer_squashed_name = "{}-sq".format(self.layer_timestamp_name)
+        self.build_input_hash = context_digest(salt_dir, build_context_files(salt_dir))
+        self.build_source_sha = self.source_sha(salt_dir)
 
         self.initialize_build(namespace, salt_dir)
 
@@ -239,8 +555,10 @@ class DockerBuildLayer(object):
         dockerfile = self.get_dockerfile(salt_dir)
         if dockerfile:
             namespace.logger.info("Building %s", dockerfile)
-            self.source_image_name = self.build_dockerfile(
-                namespace, tag=self.layer_timestamp_name, dockerfile=dockerfile)
+            with self.trace(namespace, "build_dockerfile", dockerfile=dockerfile):
+                self.source_image_name = self.build_dockerfile(
+                    namespace, tag=self.layer_timestamp_name, dockerfile=dockerfile,
+                    context_dir=self.get_build_context_dir(namespace, salt_dir))
         else:
             self.make_expose_ports(namespace)
 
@@ -267,17 +585,23 @@ class DockerBuildLayer(object):
         # TODO: make the following lines work consistently; on some Linux boxes, they don't work
         # if remove_layer:
         #     self.docker_remove_image(namespace, remove_layer)
-        if namespace.push_layer and self.registry_config['push_layer']:
-            self.docker_push(
+        pushed = namespace.push_layer and self.registry_config['push_layer']
+        digest = None
+        if pushed:
+            push_output = self.docker_push(
                 namespace,
                 layer_strong_name)
+            digest = self.parse_push_digest(push_output)
             self.docker_push(
                 namespace,
                 self.layer_latest_name)
-            self.update_docker_tags_json(namespace, layer_strong_name)
         else:
             namespace.logger.info("Not pushing Docker layers.")
 
+        self.record_build(namespace, layer_strong_name, 'success', pushed=pushed, digest=digest)
+        if pushed:
+            self.update_docker_tags_json(namespace, layer_strong_name)
+
         return layer_strong_name
 
     def salt_highstate(
@@ -309,11 +633,19 @@ class DockerBuildLayer(object):
 
             namespace.logger.info("About to start Salting")
             start_time = time.time()
-            result, salt_output = self.docker_exec(
-                namespace, target_container_name,
-                ["salt-call", "--local", "state.highstate"],
-                timeout=timeout)
-            duration = round(time.time() - start_time)
+            sampler = self.start_resource_sampler(namespace, target_container_name)
+            try:
+                with self.trace(namespace, "highstate", container=target_container_name[:12]):
+                    # Joined as it was written: chunks can end mid-line
+                    result, salt_output = self.docker_exec(
+                        namespace, target_container_name,
+                        ["salt-call", "--local", "state.highstate"],
+                        timeout=timeout, separator='')
+            finally:
+                self.save_resource_profile(namespace, sampler)
+            self.salt_states = parse_salt_states(salt_output)
+            elapsed = time.time() - start_time
+            duration = round(elapsed)
             namespace.logger.info(
                 "Finished Salting: duration=%d:%02d minutes", duration // 60, duration % 60)
 
@@ -321,6 +653,10 @@ class DockerBuildLayer(object):
                 error = ExecError("salt_highstate failed.")
                 commit = namespace.commit_failed_builds
                 result_image_name += "_fail"
+            self.metrics(namespace).observe(
+                'flyingcloud_salt_duration_seconds', elapsed,
+                help="Duration of salt highstates.",
+                layer=self.layer_name, status='failed' if error else 'success')
 
             if not error:
                 self.post_build(namespace, target_container_name, salt_dir)
@@ -338,9 +674,55 @@ class DockerBuildLayer(object):
             raise
         finally:
             if target_container_name:
-                self.docker_cleanup(namespace, target_container_name)
+                self.docker_teardown(namespace, [target_container_name])
         return target_container_name
 
+    def start_resource_sampler(self, namespace, container_id):
+        """Sample the container's resource use in the background, if --resource-profile."""
+        if not getattr(namespace, 'resource_profile', None):
+            return None
+        sampler = ResourceSampler(
+            self.docker_client(namespace, timeout=namespace.timeout), container_id,
+            interval=namespace.stats_interval or self.StatsInterval, logger=namespace.logger.warning)
+        sampler.start()
+        return sampler
+
+    def save_resource_profile(self, namespace, sampler):
+        """Write the sampler's time series and summary to `namespace.resource_profile`
+        (formatted with `layer` and `timestamp`), log the summary and add it to the metrics."""
+        if sampler is None:
+            return None
+        sampler.stop()
+        profile = sampler.profile()
+        profile.update(layer=self.layer_name, timestamp=namespace.timestamp)
+        summary = profile['summary']
+        filename = namespace.resource_profile.format(layer=self.layer_name, timestamp=namespace.timestamp)
+        try:
+            with open(filename, 'w') as f:
+                json.dump(profile, f, indent=2, sort_keys=True)
+                f.write('\n')
+        except (IOError, OSError) as e:
+            # Don't mask the outcome of the highstate
+            namespace.logger.warning("Couldn't write resource profile %s: %s", filename, e)
+        peaks, averages, totals = summary['peaks'], summary['averages'], summary['totals']
+        namespace.logger.info(
+            "Salt resource use (%d samples): CPU peak=%.0f%% avg=%.0f%%, memory peak=%d avg=%d bytes, "
+            "block I/O read=%d write=%d bytes, network rx=%d tx=%d bytes; profile in %s",
+            summary['samples'], peaks.get('cpu_percent', 0), averages.get('cpu_percent', 0),
+            peaks.get('memory_bytes', 0), averages.get('memory_bytes', 0),
+            totals.get('block_read_bytes', 0), totals.get('block_write_bytes', 0),
+            totals.get('network_rx_bytes', 0), totals.get('network_tx_bytes', 0), filename)
+        metrics = self.metrics(namespace)
+        for stat, values in (('peak', peaks), ('average', averages)):
+            if 'cpu_percent' in values:
+                metrics.set('flyingcloud_salt_cpu_percent', values['cpu_percent'],
+                            help="Build container CPU use during the highstate (100 = one CPU).",
+                            layer=self.layer_name, stat=stat)
+                metrics.set('flyingcloud_salt_memory_bytes', values['memory_bytes'],
+                            help="Build container memory use during the highstate.",
+                            layer=self.layer_name, stat=stat)
+        return profile
+
     def salt_states_exist(self, salt_dir):
         files = glob.glob(os.path.join(salt_dir, '*.sls'))
         return len(files)
@@ -352,6 +734,12 @@ class DockerBuildLayer(object):
         df = os.path.join(salt_dir, "Dockerfile")
         return df if os.path.exists(df) else None
 
+    def get_build_context_dir(self, namespace, salt_dir):
+        """The layer's salt dir, unless `context` (relative to the project) is set in layer.yaml"""
+        if self.build_context:
+            return os.path.abspath(os.path.join(namespace.base_dir, self.build_context))
+        return salt_dir
+
     def make_expose_ports(self, namespace):
         if self.exposed_ports:
             port_list = " ".join(str(p) for p in self.container_ports(self.exposed_ports))
@@ -450,25 +838,159 @@ class DockerBuildLayer(object):
             except psutil.NoSuchProcess:
                 pass
 
-    def build_dockerfile(self, namespace, tag, dockerfile=None, fileobj=None):
+    def build_dockerfile(self, namespace, tag, dockerfile=None, fileobj=None, context_dir=None):
         namespace.logger.info("About to build Dockerfile, tag=%s", tag)
         self.login_registry(namespace)
+        options = self.build_options(namespace)
         if dockerfile:
-            dockerfile = os.path.relpath(dockerfile, namespace.base_dir)
+            context_dir = context_dir or os.path.dirname(os.path.abspath(dockerfile))
+            context_filename, context_digest = make_build_context(
+                context_dir, dockerfile, namespace.build_context_cache_dir,
+                self.container_name, namespace.logger.info)
+            digest = self.build_digest(namespace, dockerfile, context_digest, options)
+            image_id = digest and self.find_image_by_context_digest(namespace, digest)
+            self.build_cache_hit = bool(image_id)
+            self.metrics(namespace).inc(
+                'flyingcloud_build_cache_total',
+                help="Dockerfile builds, by whether an image with the same build context was reused.",
+                layer=self.layer_name, result='hit' if image_id else 'miss')
+            if image_id:
+                namespace.logger.info(
+                    "Build context unchanged (%s); reusing image_id=%s", digest[:12], image_id)
+                repo, image_tag = self.image_name2repo_tag(tag)
+                namespace.docker.tag(image=image_id, repository=repo, tag=image_tag, force=True)
+                return image_id
+            cache_from = self.cache_from_images(namespace)
+            if cache_from:
+                options['cache_from'] = cache_from
+            if digest:
+                options['labels'] = {self.ContextDigestLabel: digest}
+            with open(context_filename, 'rb') as context:
+                return self._build_dockerfile(
+                    namespace, tag, fileobj=context, custom_context=True,
+                    dockerfile=os.path.relpath(dockerfile, context_dir), **options)
+        return self._build_dockerfile(namespace, tag, fileobj=fileobj, **options)
+
+    def build_options(self, namespace):
+        """Extra docker.build() arguments from layer.yaml, omitting unset ones
+        (older Docker APIs reject them)."""
+        options = {}
+        if self.build_args:
+            options['buildargs'] = dict(
+                (k, os.path.expandvars(str(v))) for k, v in self.build_args.items())
+        if self.build_target:
+            if not self.docker_build_accepts(namespace, 'target'):
+                raise FlyingCloudError(
+                    "Layer {}: 'target' needs a Docker client library whose build() takes it, "
+                    "such as the docker package; docker-py 1.x's doesn't".format(self.layer_name))
+            if self.docker_api_older_than(namespace, self.TargetApiVersion):
+                raise FlyingCloudError("Layer {}: 'target' needs Docker API {} or later, not {}".format(
+                    self.layer_name, self.TargetApiVersion, self.docker_api_version(namespace)))
+            options['target'] = self.build_target
+        return options
+
+    @classmethod
+    def docker_build_accepts(cls, namespace, argument):
+        """Whether the Docker client's build() takes `argument`: docker-py 1.x's
+        has no `cache_from` or `target`."""
+        getargspec = getattr(inspect, 'getfullargspec', None) or inspect.getargspec
+        spec = getargspec(namespace.docker.build)
+        return argument in spec.args or spec[2] is not None  # **kwargs
+
+    def docker_api_version(self, namespace):
+        return self.registry_config['docker_api_version'] or getattr(namespace.docker, 'api_version', None)
+
+    def docker_api_older_than(self, namespace, minimum):
+        """Whether the Docker API version in use is known to be older than `minimum`."""
+        version = self.docker_api_version(namespace)
+        return isinstance(version, six.string_types) and version != 'auto' \
+            and docker.utils.version_lt(version, minimum)
+
+    def build_digest(self, namespace, dockerfile, context_digest, options):
+        """What determines the image built from `dockerfile`: its build context,
+        build args, target and the IDs of its base images. None, and so no image
+        reuse, where the Docker API predates build labels or a base image
+        can't be resolved locally."""
+        if self.docker_api_older_than(namespace, self.LabelsApiVersion):
+            return None
+        base_image_ids = []
+        for image_name in dockerfile_base_images(dockerfile):
+            if '$' in image_name:
+                return None  # set by a build arg
+            try:
+                base_image_ids.append(namespace.docker.inspect_image(image_name)['Id'])
+            except (docker.errors.DockerException, docker.errors.APIError):
+                return None  # not pulled yet
+        return hashlib.sha256(json.dumps(
+            [context_digest, options.get('buildargs'), options.get('target'), base_image_ids],
+            sort_keys=True).encode('utf-8')).hexdigest()
+
+    def cache_from_images(self, namespace):
+        """Images to seed the build of the layer's Dockerfile with: by default,
+        its previous image. None where the Docker API predates `--cache-from`."""
+        cache_from = [self.layer_latest_name] if self.cache_from is None else list(self.cache_from)
+        if cache_from and not self.docker_build_accepts(namespace, 'cache_from'):
+            if self.cache_from:
+                namespace.logger.warning(
+                    "The Docker client library (docker-py 1.x?) has no cache_from; ignoring it")
+            return []
+        if cache_from and self.docker_api_older_than(namespace, self.CacheFromApiVersion):
+            if self.cache_from:
+                namespace.logger.warning(
+                    "Docker API %s is older than %s; ignoring cache_from",
+                    self.docker_api_version(namespace), self.CacheFromApiVersion)
+            return []
+        return cache_from
+
+    def pull_cache_from_images(self, namespace, cache_from):
+        if namespace.pull_layer and self.registry_config['pull_layer']:
+            for image_name in cache_from:
+                try:
+                    self.docker_pull(namespace, image_name)
+                except (docker.errors.DockerException, docker.errors.APIError, DockerResultError) as e:
+                    # E.g., the very first build of a layer
+                    namespace.logger.info("No cache image %s: %s", image_name, e)
+
+    def _build_dockerfile(self, namespace, tag, **kwargs):
+        if kwargs.get('cache_from'):
+            self.pull_cache_from_images(namespace, kwargs['cache_from'])
         image_id = None
-        for line in namespace.docker.build(
-                tag=tag, path=namespace.base_dir,
-                dockerfile=dockerfile, fileobj=fileobj):
-            line = line.decode('utf-8').rstrip('\r\n')
-            namespace.logger.debug("%s", line)
-            if not image_id:
-                match = re.search(r'Successfully built ([0-9a-f]+)', line)
-                # Grrr! Why doesn't docker-py handle this for us?
-                image_id = match and match.group(1)
+        for raw_chunk in namespace.docker.build(tag=tag, **kwargs):
+            # A chunk may hold several JSON messages
+            for line in raw_chunk.decode('utf-8').splitlines():
+                built_id = self.parse_build_output(namespace, line)
+                image_id = image_id or built_id
 
         namespace.logger.info("Built tag=%s, image_id=%s", tag, image_id)
         return image_id
 
+    def parse_build_output(self, namespace, line):
+        """Log one line of `docker build` output; return the image ID, if reported."""
+        namespace.logger.debug("%s", line)
+        try:
+            data = json.loads(line)
+        except ValueError:
+            data = dict(stream=line)
+        if not isinstance(data, dict):
+            return None
+        if 'error' in data:
+            raise DockerResultError("Error: {!r}".format(data))
+        aux = data.get('aux')
+        if isinstance(aux, dict) and aux.get('ID'):
+            return aux['ID']
+        # Older daemons don't send `aux`
+        match = re.search(r'Successfully built ([0-9a-f]+)', data.get('stream') or '')
+        return match and match.group(1)
+
+    def find_image_by_context_digest(self, namespace, digest):
+        label = "{}={}".format(self.ContextDigestLabel, digest)
+        try:
+            image_ids = namespace.docker.images(quiet=True, filters=dict(label=label))
+        except docker.errors.APIError as e:
+            namespace.logger.debug("Can't filter images by label: %s", e)
+            return None
+        return image_ids[0] if image_ids else None
+
     def docker_create_container(
             self, namespace, container_name, image_name,
             environment=None, detach=True, volume_map=None, **kwargs):
@@ -492,7 +1014,8 @@ class DockerBuildLayer(object):
         kwargs['environment'] = environment
 
         try:
-            container = namespace.docker.create_container(**kwargs)
+            with self.trace(namespace, "create_container", image=image_name):
+                container = namespace.docker.create_container(**kwargs)
             container_id = container['Id']
             namespace.logger.info("Created container %s, result=%r", container_id[:12], container)
             return container_id
@@ -523,7 +1046,14 @@ class DockerBuildLayer(object):
                 '/var/lib/docker',
                 tempfile.gettempdir()) + extra_paths:
             if os.path.exists(path):
-                namespace.logger.info("Disk Usage '%s': %r", path, disk_usage(path))
+                usage = disk_usage(path)
+                namespace.logger.info("Disk Usage '%s': %r", path, usage)
+                self.metrics(namespace).set(
+                    'flyingcloud_disk_used_bytes', usage.used,
+                    help="Disk space used, at the last check.", path=path)
+                self.metrics(namespace).set(
+                    'flyingcloud_disk_free_bytes', usage.free,
+                    help="Disk space free, at the last check.", path=path)
 
     def docker_tags_for_image(self, namespace, image_name):
         parts = image_name.split('/')
@@ -537,7 +1067,8 @@ class DockerBuildLayer(object):
                 return None
 
     def docker_start(self, namespace, container_id, **kwargs):
-        return namespace.docker.start(container_id, **kwargs)
+        with self.trace(namespace, "start_container", container=container_id[:12]):
+            return namespace.docker.start(container_id, **kwargs)
 
     def docker_exec(self, namespace, container_id, cmd, **kwargs):
         exec_id = self.docker_exec_create(namespace, container_id, cmd)
@@ -551,7 +1082,9 @@ class DockerBuildLayer(object):
     def docker_exec_start(self, namespace, exec_id, timeout=None, raise_on_error=True, **kwargs):
         timeout = timeout or namespace.timeout or self.SaltExecTimeout
         # Use a distinct client with a custom timeout
-        # (synchronous execs can last much longer than 60 seconds)
+        # (synchronous execs can last much longer than 60 seconds).
+        # The client is cached in namespace.docker_clients, so repeated execs
+        # reuse its connection pool.
         client = self.docker_client(namespace, timeout=timeout)
         generator = client.exec_start(exec_id=exec_id, stream=True)
         full_output = self.read_docker_output_stream(namespace, generator, "docker_exec", **kwargs)
@@ -561,28 +1094,32 @@ class DockerBuildLayer(object):
             raise ExecError("docker_exec exit code was non-zero: {} (result: {})".format(exit_code, result))
         return result, full_output
 
-    def read_docker_output_stream(self, namespace, generator, logger_prefix, log_level=None):
+    def read_docker_output_stream(self, namespace, generator, logger_prefix, log_level=None, separator='\n'):
+        """Log each chunk of `generator`; return the chunks joined with `separator`."""
         log_level = log_level or logging.DEBUG
         logger = getattr(namespace.logger, logging.getLevelName(log_level).lower())
         full_output = []
 
-        for raw_chunk in generator:
-            try:
-                chunk, repl_count = self.filter_stream_header(raw_chunk)
-                decoded_chunk = chunk.decode('utf-8')
-            except UnicodeDecodeError:
-                decoded_chunk = chunk.decode('utf-8', 'replace')
-                logger("Couldn't decode %s", hexdump(chunk, 64))
-
-            full_output.append(decoded_chunk)
-            try:
-                data = json.loads(decoded_chunk)
-            except ValueError:
-                data = decoded_chunk.rstrip('\r\n')
-            logger("%s: %s", logger_prefix, data)
-            if isinstance(data, dict) and 'error' in data:
-                raise DockerResultError("Error: {!r}".format(data))
-        return '\n'.join(full_output)
+        with StreamLogger(
+                logger, logger_prefix, interval=self.LogStreamInterval,
+                max_lines=self.LogStreamMaxLines, rate_limit=self.LogStreamRateLimit) as stream_logger:
+            for raw_chunk in generator:
+                try:
+                    chunk, repl_count = self.filter_stream_header(raw_chunk)
+                    decoded_chunk = chunk.decode('utf-8')
+                except UnicodeDecodeError:
+                    decoded_chunk = chunk.decode('utf-8', 'replace')
+                    logger("Couldn't decode %s", hexdump(chunk, 64))
+
+                full_output.append(decoded_chunk)
+                try:
+                    data = json.loads(decoded_chunk)
+                except ValueError:
+                    data = decoded_chunk.rstrip('\r\n')
+                stream_logger.add(data)
+                if isinstance(data, dict) and 'error' in data:
+                    raise DockerResultError("Error: {!r}".format(data))
+        return separator.join(full_output)
 
     # See "Stream details" at https://docs.docker.com/engine/api/v1.18/
     # {STREAM_TYPE, 0, 0, 0, SIZE1, SIZE2, SIZE3, SIZE4}
@@ -597,7 +1134,8 @@ class DockerBuildLayer(object):
 
     def docker_commit(self, namespace, container_id, result_image_name):
         repo, tag = self.image_name2repo_tag(result_image_name)
-        return namespace.docker.commit(container=container_id, repository=repo, tag=tag)
+        with self.trace(namespace, "commit", image=result_image_name):
+            return namespace.docker.commit(container=container_id, repository=repo, tag=tag)
 
     def find_binary(self, namespace, filename, search_paths=None):
         if search_paths is None:
@@ -624,23 +1162,34 @@ class DockerBuildLayer(object):
             input_temp = tempfile.NamedTemporaryFile(suffix="-input-image.tar", delete=False)
             output_temp = tempfile.NamedTemporaryFile(suffix="-output-image.tar", delete=False)
             # docker save to tarfile
-            image_raw = namespace.docker.get_image(image_name)
-            for chunk in image_raw.stream(STREAMING_CHUNK_SIZE, decode_content=True):
-                input_temp.write(chunk)
-            input_temp.close()
+            with self.trace(namespace, "squash_export", image=image_name):
+                image_raw = namespace.docker.get_image(image_name)
+                for chunk in image_raw.stream(STREAMING_CHUNK_SIZE, decode_content=True):
+                    input_temp.write(chunk)
+                input_temp.close()
 
             # docker-squash -i tar1 -o tar2
             # TODO: use subprocess.Popen and pipe input and output
             output_temp.close()
+            input_size = os.path.getsize(input_temp.name)
             namespace.logger.info("Squashing '%s' (%d bytes) to '%s'",
-                                  input_temp.name, os.path.getsize(input_temp.name), output_temp.name)
-            docker_squash_cmd("-i", input_temp.name, "-o", output_temp.name, "-t", latest_image_name,
-                              "-from", "root")
+                                  input_temp.name, input_size, output_temp.name)
+            with self.trace(namespace, "squash", image=image_name):
+                docker_squash_cmd("-i", input_temp.name, "-o", output_temp.name, "-t", latest_image_name,
+                                  "-from", "root")
             output_temp = open(output_temp.name, 'rb')
 
             # docker load tar2
-            namespace.logger.info("Loading squashed image (%d bytes)", os.path.getsize(output_temp.name))
-            namespace.docker.load_image(data=output_temp)
+            output_size = os.path.getsize(output_temp.name)
+            namespace.logger.info("Loading squashed image (%d bytes)", output_size)
+            self.metrics(namespace).set(
+                'flyingcloud_squash_input_bytes', input_size,
+                help="Size of the last image saved for squashing.", layer=self.layer_name)
+            self.metrics(namespace).set(
+                'flyingcloud_squash_output_bytes', output_size,
+                help="Size of the last squashed image.", layer=self.layer_name)
+            with self.trace(namespace, "squash_load", image=squashed_image_name):
+                namespace.docker.load_image(data=output_temp)
             output_temp.close()
 
             _, tag = self.image_name2repo_tag(squashed_image_name)
@@ -671,14 +1220,68 @@ class DockerBuildLayer(object):
         self.docker_stop(namespace, container_name)
         self.docker_remove_container(namespace, container_name)
 
-    def docker_stop(self, namespace, container_name):
-        namespace.docker.stop(container_name)
+    def docker_teardown(self, namespace, container_ids):
+        """Stop and remove containers concurrently.
+
+        Each container gets `namespace.stop_timeout` seconds to stop
+        before Docker kills it; with `namespace.kill_containers`,
+        containers are killed and removed without a graceful stop.
+        Returns a list of `TeardownResult`, one per container.
+        """
+        with self.trace(namespace, "teardown", containers=len(container_ids)):
+            results = self.map_concurrently(
+                lambda c: self.docker_teardown_container(namespace, c), container_ids)
+        for r in results:
+            log = namespace.logger.error if r.error else namespace.logger.info
+            log("Teardown %s: stopped=%s, removed=%s, duration=%.1fs, error=%s",
+                r.container[:12], r.stopped, r.removed, r.duration, r.error)
+        return results
+
+    def map_concurrently(self, func, items, max_workers=None):
+        """`map(func, items)` on up to `DockerWorkers` threads; results in order."""
+        items = list(items)
+        if len(items) <= 1:
+            return [func(item) for item in items]
+        workers = min(max_workers or self.DockerWorkers, len(items))
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            return list(executor.map(func, items))
+
+    def docker_teardown_container(self, namespace, container_id):
+        namespace.logger.info("docker_teardown %s", container_id)
+        start_time = time.time()
+        stopped = removed = False
+        error = None
+        try:
+            if not namespace.kill_containers:
+                try:
+                    self.docker_stop(namespace, container_id, timeout=namespace.stop_timeout)
+                    stopped = True
+                except (docker.errors.DockerException, docker.errors.APIError,
+                        requests.exceptions.RequestException) as e:
+                    # Forced removal kills the container
+                    namespace.logger.warning(
+                        "Couldn't stop %s, killing it: %s", container_id[:12], e)
+            self.docker_remove_container(namespace, container_id, force=True)
+            removed = True
+        except (docker.errors.DockerException, docker.errors.APIError,
+                requests.exceptions.RequestException) as e:
+            error = e
+        return TeardownResult(
+            container_id, stopped, removed, error, time.time() - start_time)
+
+    def docker_stop(self, namespace, container_name, timeout=None):
+        with self.trace(namespace, "stop_container", container=container_name[:12]):
+            if timeout is None:
+                namespace.docker.stop(container_name)
+            else:
+                namespace.docker.stop(container_name, timeout=timeout)
 
     def docker_kill(self, namespace, container_name, signal=None):
         return namespace.docker.kill(container_name, signal=signal)
 
     def docker_remove_container(self, namespace, container_name, force=True):
-        namespace.docker.remove_container(container=container_name, force=force)
+        with self.trace(namespace, "remove_container", container=container_name[:12]):
+            namespace.docker.remove_container(container=container_name, force=force)
 
     def docker_remove_image(self, namespace, image_name, force=True):
         namespace.docker.remove_image(image=image_name, force=force)
@@ -694,7 +1297,8 @@ class DockerBuildLayer(object):
     def docker_tag(self, namespace, image_name, tag=None, force=True):
         repo, tag = self.image_name2repo_tag(image_name, tag)
         namespace.logger.info("Tagging image %s as repo=%s, tag=%s", image_name, repo, tag)
-        namespace.docker.tag(image=image_name, repository=repo, tag=tag, force=force)
+        with self.trace(namespace, "tag", image=image_name, tag=tag):
+            namespace.docker.tag(image=image_name, repository=repo, tag=tag, force=force)
 
     def docker_pull(self, namespace, image_name, **kwargs):
         return self._docker_push_pull(namespace, image_name, "pull", **kwargs)
@@ -713,29 +1317,104 @@ class DockerBuildLayer(object):
             generator = method(repository=repo, tag=tag, stream=True)
             return self.read_docker_output_stream(namespace, generator, "docker_{}".format(verb), **kwargs)
 
-        retry_call(do_it, verb, namespace.logger, namespace.retries)
+        start_time = time.time()
+        with self.trace(namespace, verb, image=image_name):
+            output = retry_call(do_it, verb, namespace.logger, namespace.retries)
+        metrics = self.metrics(namespace)
+        metrics.observe(
+            'flyingcloud_transfer_duration_seconds', time.time() - start_time,
+            help="Duration of image pushes and pulls, including retries.",
+            layer=self.layer_name, verb=verb)
+        metrics.inc(
+            'flyingcloud_transfer_bytes_total', transfer_bytes(output),
+            help="Image layer bytes pushed and pulled, from Docker's progress reports.",
+            layer=self.layer_name, verb=verb)
+        return output
+
+    @classmethod
+    def parse_push_digest(cls, push_output):
+        match = re.search(r'"Digest":\s*"(sha256:[0-9a-f]+)"', push_output or '')
+        if not match:
+            match = re.search(r'digest: (sha256:[0-9a-f]+)', push_output or '')
+        return match and match.group(1)
+
+    def build_store(self, namespace):
+        """The workspace's BuildStore, opened once per process.
+
+        A legacy docker_tags.json is imported into a new store."""
+        store = getattr(namespace, 'build_store_db', None)
+        if store is None:
+            store = namespace.build_store_db = BuildStore(namespace.build_store_file)
+            if store.is_empty() and os.path.exists(namespace.docker_tagsfile):
+                if store.import_tags_json(namespace.docker_tagsfile, if_empty=True) is not None:
+                    namespace.logger.info("Imported %s into %s", namespace.docker_tagsfile, store.filename)
+        return store
+
+    def record_build(self, namespace, layer_name, status, pushed=False, digest=None):
+        if layer_name:
+            repo, tag = self.image_name2repo_tag(layer_name)
+        else:
+            repo, tag = self.docker_layer_name, None
+        duration = self.build_start_time and time.time() - self.build_start_time
+        image = self.docker_inspect_image(namespace, layer_name) or {}
+        build_id = self.build_store(namespace).record_build(
+            repo, tag,
+            image_id=image.get('Id'),
+            digest=digest,
+            input_hash=self.build_input_hash,
+            duration=duration,
+            status=status,
+            pushed=pushed,
+            layer=self.layer_name,
+            image_size=image.get('Size'),
+            cache_hit=self.build_cache_hit,
+            source_sha=self.build_source_sha,
+            phases=self.build_phase_durations(namespace),
+            states=self.salt_states)
+        namespace.logger.info("Recorded build %d: %s:%s, status=%s", build_id, repo, tag, status)
+        return build_id
+
+    def build_phase_durations(self, namespace):
+        """Seconds spent in each of this layer's finished --trace spans, by name."""
+        tracer = getattr(namespace, 'tracer', None)
+        phases = collections.defaultdict(float)
+        for event in tracer.trace_events() if tracer else []:
+            if event['ph'] == 'X' and event['cat'] == self.layer_name:
+                phases[event['name']] += event['dur'] / 1e6
+        return dict(phases)
+
+    def source_sha(self, salt_dir):
+        """The commit of the repository holding the layer's salt states, if any."""
+        vcs = find_vcs(salt_dir)
+        try:
+            return vcs.sha() if vcs else None
+        except (CalledProcessError, OSError):
+            return None
+
+    def docker_inspect_image(self, namespace, image_name):
+        if image_name:
+            try:
+                return namespace.docker.inspect_image(image_name)
+            except (docker.errors.DockerException, docker.errors.APIError,
+                    requests.exceptions.RequestException):
+                # E.g., the daemon went away: don't mask a failed build's error
+                pass
+        return None
+
+    def docker_image_id(self, namespace, image_name):
+        return (self.docker_inspect_image(namespace, image_name) or {}).get('Id')
 
     def update_docker_tags_json(self, namespace, layer_strong_name):
-        repo, tag = self.image_name2repo_tag(layer_strong_name)
-        docker_tags_data = {}
-        if os.path.exists(namespace.docker_tagsfile):
-            with open(namespace.docker_tagsfile, 'r') as fp:
-                docker_tags_data = json.load(fp)
-        repo_tags = docker_tags_data.setdefault(repo, [])
-        repo_tags.append(tag)
-        with open(namespace.docker_tagsfile, 'w') as fp:
-            json.dump(docker_tags_data, fp, indent=4)
-        namespace.logger.info("Wrote %s=%s to %s", repo, tag, namespace.docker_tagsfile)
+        """Export pushed tags to docker_tags.json, for scripts that still read it."""
+        if not namespace.export_tags_json:
+            return None
+        docker_tags_data = self.build_store(namespace).export_tags_json(namespace.docker_tagsfile)
+        namespace.logger.info("Wrote %s to %s", layer_strong_name, namespace.docker_tagsfile)
         return docker_tags_data
 
     def get_latest_tag(self, namespace, image_name):
         repo, _ = self.image_name2repo_tag(image_name)
-        tag = None
-        if os.path.exists(namespace.docker_tagsfile):
-            with open(namespace.docker_tagsfile, 'r') as fp:
-                docker_tags_data = json.load(fp)
-            repo_tags = docker_tags_data.get(repo)
-            tag = sorted(repo_tags , reverse=True)[0] if repo_tags else None
+        tag = self.build_store(namespace).latest_tag(repo)
         namespace.logger.info("get_latest_tag('%s') = '%s'", repo, tag)
         return tag
 
@@ -764,18 +1443,14 @@ class DockerBuildLayer(object):
         return info
 
     def configure_logging(self, namespace):
-        logger = logging.getLogger(__name__)
-        logger.setLevel(logging.DEBUG)
-        fh = logging.FileHandler(namespace.logfile)
-        fh.setLevel(logging.DEBUG)
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.DEBUG if namespace.debug else logging.INFO)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        ch.setFormatter(formatter)
-        fh.setFormatter(formatter)
-        logger.addHandler(ch)
-        logger.addHandler(fh)
-        return logger
+        """Log to the terminal and `namespace.logfile` from a background thread,
+        so slow sinks don't hold up builds. Safe to call more than once."""
+        return configure_logging(
+            __name__, namespace.logfile,
+            level=logging.DEBUG if namespace.debug else logging.INFO,
+            max_bytes=namespace.log_max_bytes,
+            backup_count=namespace.log_backups,
+            compress=namespace.log_compress)
 
     def add_additional_configuration(self, namespace):
         """Override to add additional configuration to namespace"""
@@ -791,12 +1466,35 @@ class DockerBuildLayer(object):
         defaults.setdefault('base_dir', os.path.abspath(os.path.dirname(__file__)))
         defaults.setdefault('salt_dir', os.path.join(defaults['base_dir'], "salt"))
         defaults.setdefault('logfile', os.path.join(defaults['base_dir'], "flyingcloud.log"))
+        defaults.setdefault('log_max_bytes', 0)
+        defaults.setdefault('log_backups', 5)
+        defaults.setdefault('log_compress', False)
         defaults.setdefault('docker_tagsfile', os.path.join(defaults['base_dir'], "docker_tags.json"))
-        defaults.setdefault('timestamp_format', '%Y-%m-%dt%H%M%Sz')
+        defaults.setdefault('build_store_file', os.path.join(defaults['base_dir'], "flyingcloud_builds.sqlite"))
+        defaults.setdefault('export_tags_json', True)
+        defaults.setdefault('gc_keep', self.GCKeep)
+        defaults.setdefault('gc_max_age_days', None)
+        defaults.setdefault('gc_remote', False)
+        defaults.setdefault('dry_run', False)
+        defaults.setdefault('report_runs', self.ReportRuns)
+        defaults.setdefault('report_window', self.ReportWindow)
+        defaults.setdefault('report_threshold', self.ReportThreshold)
+        defaults.setdefault('report_json', None)
+        defaults.setdefault('build_context_cache_dir',
+                            os.path.join(tempfile.gettempdir(), "flyingcloud-build-context"))
+        defaults.setdefault('timestamp_format', self.TimestampFormat)
         defaults.setdefault(
             'timestamp',
             datetime.datetime.utcnow().strftime(defaults['timestamp_format']))
         defaults.setdefault('operation', 'build')
+        defaults.setdefault('trace_file', None)
+        defaults.setdefault('metrics_file', None)
+        defaults.setdefault('metrics_json', None)
+        defaults.setdefault('resource_profile', None)
+        defaults.setdefault('stats_interval', self.StatsInterval)
+        defaults.setdefault('tracer', None)
+        defaults.setdefault('profile', None)
+        defaults.setdefault('profiler', None)
 
         defaults.setdefault('timeout', self.DefaultTimeout)
         defaults.setdefault('pull_layer', True)
@@ -804,6 +1502,8 @@ class DockerBuildLayer(object):
         defaults.setdefault('squash_layer', False)
         defaults.setdefault('logged_in', False)
         defaults.setdefault('retries', 3)
+        defaults.setdefault('stop_timeout', self.StopTimeout)
+        defaults.setdefault('kill_containers', False)
         defaults.setdefault('username', os.environ.get(self.USERNAME_ENV_VAR))
         defaults.setdefault('password', os.environ.get(self.PASSWORD_ENV_VAR))
         defaults.setdefault('email', os.environ.get(self.EMAIL_ENV_VAR))
@@ -840,6 +1540,19 @@ class DockerBuildLayer(object):
             '--retries', '-R', type=int,
             help="How often to retry remote Docker operations, such as push/pull. "
                  "Default: %(default)d")
+        parser.add_argument(
+            '--stop-timeout', type=int, metavar='SECONDS',
+            help="Seconds to let containers stop before Docker kills them, "
+                 "in --kill and build cleanup. Default: %(default)d")
+        parser.add_argument(
+            '--kill-containers', action='store_true',
+            help="Kill containers immediately rather than stopping them gracefully, "
+                 "in --kill and build cleanup.")
+        parser.add_argument(
+            '--no-tags-json', dest='export_tags_json', action='store_false',
+            help="Do not export pushed tags to {}; they are always recorded in {}.".format(
+                os.path.basename(defaults['docker_tagsfile']),
+                os.path.basename(defaults['build_store_file'])))
         parser.add_argument(
             '--commit-failed-builds', '-C', action='store_true',
             help="Commit failed builds. "
@@ -848,6 +1561,42 @@ class DockerBuildLayer(object):
         parser.add_argument(
             '--debug', '-D', action='store_true',
             help="Set terminal logging level to DEBUG, etc")
+        parser.add_argument(
+            '--log-max-bytes', type=int, metavar='BYTES',
+            help="Rotate {} when it would exceed BYTES. Default: %(default)d (never)".format(
+                os.path.basename(defaults['logfile'])))
+        parser.add_argument(
+            '--log-backups', type=int, metavar='N',
+            help="Keep N rotated log files. Default: %(default)d")
+        parser.add_argument(
+            '--log-compress', action='store_true',
+            help="Gzip rotated log files.")
+        parser.add_argument(
+            '--trace', dest='trace_file', metavar='FILE',
+            help="Write a timeline of the build's phases to FILE, in Chrome trace-event format "
+                 "(open it in chrome://tracing or https://ui.perfetto.dev).")
+        parser.add_argument(
+            '--metrics-file', metavar='FILE',
+            help="Write the run's metrics to FILE (it should end in .prom) in the Prometheus "
+                 "textfile-collector format: build, salt, push and pull durations, bytes "
+                 "pushed and pulled, retries, squash sizes, disk usage.")
+        parser.add_argument(
+            '--metrics-json', metavar='FILE',
+            help="Write the run's metrics to FILE as JSON.")
+        parser.add_argument(
+            '--resource-profile', metavar='FILE',
+            help="Sample the build container's CPU, memory, block I/O and network use "
+                 "during the highstate, and write the samples, peaks and averages to FILE "
+                 "as JSON. FILE may contain {layer} and {timestamp}.")
+        parser.add_argument(
+            '--stats-interval', type=float, metavar='SECONDS',
+            help="Seconds between --resource-profile samples. Default: %(default)s")
+        parser.add_argument(
+            '--profile', metavar='PREFIX',
+            help="Profile flyingcloud itself, from loading the configuration on, and write "
+                 "PREFIX.pstats (cProfile), PREFIX.collapsed (sampled stacks of every thread, "
+                 "for flamegraph.pl or speedscope, under the build phase they were in) "
+                 "and PREFIX.txt (a summary).")
         parser.add_argument(
             '--env', '-E', action='append', dest='env_vars', metavar='ENV_VAR',
             help="Set environment variables for --run. "
@@ -889,6 +1638,42 @@ class DockerBuildLayer(object):
         op_group.add_argument(
             '--kill', '-k', dest='operation', action='store_const', const='kill',
             help="Kill a running layer.")
+        op_group.add_argument(
+            '--gc', dest='operation', action='store_const', const='gc',
+            help="Remove a layer's old images and leftover containers.")
+        op_group.add_argument(
+            '--report', dest='operation', action='store_const', const='report',
+            help="Report the build durations of the layers, and regressions.")
+
+        gc_group = parser.add_argument_group("Garbage Collection (--gc)")
+        gc_group.add_argument(
+            '--gc-keep', type=int, metavar='N',
+            help="Keep the N most recent builds of the layer. Default: %(default)d")
+        gc_group.add_argument(
+            '--gc-max-age-days', type=float, metavar='DAYS',
+            help="Also keep builds younger than DAYS days. Default: %(default)s")
+        gc_group.add_argument(
+            '--gc-remote', action='store_true',
+            help="Also delete old tags from the registry.")
+        gc_group.add_argument(
+            '--dry-run', '-n', action='store_true',
+            help="Report what would be removed and how much space that would reclaim.")
+
+        report_group = parser.add_argument_group("Build History (--report)")
+        report_group.add_argument(
+            '--report-runs', type=int, metavar='N',
+            help="Show the N most recent builds of each layer. Default: %(default)d")
+        report_group.add_argument(
+            '--report-window', type=int, metavar='N',
+            help="Compare each build with the median of the N successful builds before it. "
+                 "Default: %(default)d")
+        report_group.add_argument(
+            '--report-threshold', type=float, metavar='FRACTION',
+            help="Flag builds, phases and salt states more than FRACTION slower than that "
+                 "(and at least {:g} seconds). Default: %(default)s".format(self.ReportMinRegression))
+        report_group.add_argument(
+            '--report-json', metavar='FILE',
+            help="Also write the report to FILE as JSON.")
 
         subparsers = parser.add_subparsers(
             title="Layer Names",
@@ -910,8 +1695,14 @@ class DockerBuildLayer(object):
         parser.set_defaults(layer_dict=layer_classes)
 
         namespace = parser.parse_args()
+        if namespace.operation == 'report':
+            # Only reads the build store
+            namespace.pull_layer = namespace.push_layer = False
 
         namespace.logger = self.configure_logging(namespace)
+        namespace.tracer = namespace.tracer or Tracer(profiler=namespace.profiler)
+        namespace.metrics = default_registry
+        namespace.docker_clients = DockerClientRegistry()
         namespace.docker = self.docker_client(namespace, timeout=namespace.timeout)
 
         if namespace.pull_layer or namespace.push_layer:
@@ -924,19 +1715,20 @@ class DockerBuildLayer(object):
 
     def login_registry(self, namespace, force=False):
         if force or not namespace.logged_in:
-            if self.registry_config['aws_ecr_region']:
-                credentials_namespace, registry = self.ecr_get_login(
-                    namespace, self.registry_config['aws_ecr_region'])
-            else:
-                registry = self.registry_config['host']
-                credentials_namespace = namespace
-
-            result = self.docker_login(
-                namespace,
-                username=credentials_namespace.username,
-                password=credentials_namespace.password,
-                email=credentials_namespace.email,
-                registry=registry)
+            with self.trace(namespace, "login"):
+                if self.registry_config['aws_ecr_region']:
+                    credentials_namespace, registry = self.ecr_get_login(
+                        namespace, self.registry_config['aws_ecr_region'])
+                else:
+                    registry = self.registry_config['host']
+                    credentials_namespace = namespace
+
+                result = self.docker_login(
+                    namespace,
+                    username=credentials_namespace.username,
+                    password=credentials_namespace.password,
+                    email=credentials_namespace.email,
+                    registry=registry)
             namespace.logger.debug("Login: %r", result)
             namespace.logged_in = True
             return result
@@ -960,10 +1752,10 @@ class DockerBuildLayer(object):
         if LooseVersion(awscli.__version__) >= LooseVersion("1.11.91"):
             command += ["--no-include-email"]
 
-        with io.BytesIO() as output:
-            namespace.logger.info("Running: %r", command)
-            sh.Command(aws_cli_path)(*command, _out=output)
-            docker_login_cmdline = output.getvalue()
+        namespace.logger.info("Running: %r", command)
+        docker_login_cmdline = " ".join(
+            line for stream, line in iter_command([aws_cli_path] + command, timeout=self.EcrLoginTimeout)
+            if stream == STDOUT)
         return self.parse_docker_login(docker_login_cmdline.split())
 
     @classmethod
@@ -984,8 +1776,18 @@ class DockerBuildLayer(object):
             kwargs.setdefault('version', self.registry_config['docker_api_version'])
         if self.use_docker_machine(namespace):
             kwargs = self.get_docker_machine_client(namespace, **kwargs)
-        namespace.logger.debug("Constructing docker client object with %s", kwargs)
-        return docker.Client(*args, **kwargs)
+        registry = getattr(namespace, 'docker_clients', None)
+        if registry is None:
+            namespace.logger.debug("Constructing docker client object with %s", kwargs)
+            return docker.Client(*args, **kwargs)
+        namespace.logger.debug("Getting docker client object with %s", kwargs)
+        return registry.get(*args, **kwargs)
+
+    def close_docker_clients(self, namespace):
+        registry = getattr(namespace, 'docker_clients', None)
+        if registry is not None:
+            namespace.logger.debug("Closing %d docker client(s)", len(registry))
+            registry.close()
 
     @classmethod
     def use_docker_machine(cls, namespace):
@@ -1002,12 +1804,16 @@ class DockerBuildLayer(object):
             return output.getvalue()
 
     def get_docker_machine_client(self, namespace, **kwargs):
-        # TODO: better error handling
-        docker_machine_json = self.run_docker_machine(
-            "inspect", namespace.docker_machine_name).decode('utf-8')
-        namespace.logger.debug("docker-machine json: %r", docker_machine_json)
-        namespace.logger.debug("docker-machine json type: %r", type(docker_machine_json))
-        docker_machine_json = json.loads(docker_machine_json)
+        # `docker-machine inspect` is slow; run it once per machine per process.
+        inspected = namespace.__dict__.setdefault('docker_machine_inspected', {})
+        docker_machine_json = inspected.get(namespace.docker_machine_name)
+        if docker_machine_json is None:
+            # TODO: better error handling
+            docker_machine_json = self.run_docker_machine(
+                "inspect", namespace.docker_machine_name).decode('utf-8')
+            namespace.logger.debug("docker-machine json: %r", docker_machine_json)
+            docker_machine_json = json.loads(docker_machine_json)
+            inspected[namespace.docker_machine_name] = docker_machine_json
         docker_machine_tls = docker_machine_json['HostOptions']['AuthOptions']
         docker_machine_ip = docker_machine_json['Driver']['IPAddress']
         # Use docker-s port. TODO: IPv6?
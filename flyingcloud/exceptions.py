@@ -21,3 +21,9 @@ class ExecError(FlyingCloudError):
 class DockerResultError(FlyingCloudError):
     """Error in result from Docker Daemon"""
 
+
+class EngineAPIError(DockerResultError):
+    """Error status returned by the Docker Engine API"""
+    def __init__(self, status_code, message):
+        super(EngineAPIError, self).__init__("{} {}".format(status_code, message))
+        self.status_code = status_code
@@ -9,6 +9,8 @@ import yaml
 
 from .base import DockerBuildLayer, FlyingCloudError
 from .utils import import_derived_class
+from .utils.profiler import start_profiler
+from .utils.trace import Tracer
 
 
 def get_layer(app_name, layer_name, layer_data, registry_config):
@@ -35,6 +37,10 @@ def get_layer(app_name, layer_name, layer_data, registry_config):
     pull_images = layer_info.get('pull_images')
     container_name = layer_info.get('image_name')
     environment = layer_info.get('environment')
+    build_context = layer_info.get('context')
+    cache_from = layer_info.get('cache_from')
+    build_args = layer_info.get('build_args')
+    build_target = layer_info.get('target')
 
     layer = layer_class(
         app_name=app_name,
@@ -47,6 +53,10 @@ def get_layer(app_name, layer_name, layer_data, registry_config):
         pull_images=pull_images,
         registry_config=registry_config,
         environment=environment,
+        build_context=build_context,
+        cache_from=cache_from,
+        build_args=build_args,
+        build_target=build_target,
     )
 
 #   print(layer.__dict__)
@@ -100,26 +110,39 @@ def main():
     DockerBuildLayer.check_user_is_root()
 
     project_root = os.path.abspath(os.getcwd())
+    # Started before the full command line can be parsed, to cover loading the configuration
+    profiler = start_profiler(sys.argv[1:])
+    tracer = Tracer(profiler=profiler)
     defaults = dict(
         base_dir=project_root,
+        tracer=tracer,
+        profiler=profiler,
     )
 
     try:
-        project_info, layers = configure_layers(project_root)
+        with tracer.span("load_config"):
+            project_info, layers = configure_layers(project_root)
     except FlyingCloudError:
         # TODO: argparse help
         raise
 
     if layers is not None:
         instance = layers[list(layers.keys())[0]]
-        namespace = instance.parse_args(
-            defaults,
-            layers,
-            description=project_info['description'])
+        with tracer.span("parse_args"):
+            namespace = instance.parse_args(
+                defaults,
+                layers,
+                description=project_info['description'])
         instance.check_environment_variables(namespace)
 
         instance = namespace.layer_inst
-        instance.do_operation(namespace)
+        try:
+            instance.do_operation(namespace)
+        finally:
+            instance.close_docker_clients(namespace)
+            instance.write_trace(namespace)
+            instance.write_metrics(namespace)
+            instance.write_profile(namespace)
     else:
         instance = DockerBuildLayer('no_app', 'no_layer', 'no_image_base', "no layer present")
         namespace = instance.parse_args(
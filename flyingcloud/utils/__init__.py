@@ -2,9 +2,9 @@
 
 from __future__ import absolute_import
 
-from .process import run_command, DevNull
+from .process import run_command, iter_command, run_commands, DevNull
 from .file import abspath, make_dir, move_file_to_dir, find_in_path, find_recursive_pattern, disk_usage
-from .archive import make_tarfile, make_zipfile, zip_add_directory, zip_write_directory, check_zipfile
+from .archive import make_tarfile, write_tarfile, make_zipfile, zip_add_directory, zip_add_files, zip_write_directory, check_zipfile
 from .vcs import find_vcs
 from .package_build import build_package
 from .importer import import_derived_class
@@ -2,12 +2,26 @@
 
 from __future__ import absolute_import
 
+import concurrent.futures
+import contextlib
+import functools
 import logging
+import multiprocessing
 import os
+import stat
+import subprocess
 import tarfile
+import time
 import zipfile
+import zlib
 
-from .file import abspath
+from .file import abspath, find_in_path
+from .gzip_writer import ParallelGzipWriter
+from .path_filter import PathFilter, select, walk
+from .process import CalledProcessError
+from .zip_writer import ParallelZipWriter, CompressionPolicy, normalized_mode
+
+ZIP_EPOCH = 315532800  # 1980-01-01T00:00:00Z, the earliest time a zip entry can have
 
 
 def tar_compression_mode(filename):
@@ -15,108 +29,274 @@ def tar_compression_mode(filename):
         return ":gz"
     elif filename.endswith(".tar.bz2") or filename.endswith(".tbz2"):
         return ":bz2"
+    elif filename.endswith(".tar.xz") or filename.endswith(".txz"):
+        return ":xz"
+    elif filename.endswith(".tar.zst") or filename.endswith(".tzst"):
+        return ":zst"
     else:
         return ""
 
 
-def make_tarfile(output_filename, source_dir):
-    with tarfile.open(output_filename,
-                      "w" + tar_compression_mode(output_filename)) as tar:
-        tar.add(source_dir, arcname=os.path.basename(source_dir))
+# Multi-threaded compressors, run as filters, for the modes that have one
+TarCompressors = {
+    ":xz": "xz",
+    ":zst": "zstd",
+}
+
+
+def source_date_epoch():
+    """Timestamp for reproducible archives: $SOURCE_DATE_EPOCH, else 1980-01-01.
+
+    See https://reproducible-builds.org/specs/source-date-epoch/
+    """
+    return int(os.environ.get('SOURCE_DATE_EPOCH', ZIP_EPOCH))
+
+
+def reproducible_zip_options(reproducible=True):
+    """Keyword arguments for `ParallelZipWriter` to write reproducible zipfiles."""
+    if not reproducible:
+        return {}
+    return dict(date_time=time.gmtime(source_date_epoch())[0:6], normalize_modes=True)
+
+
+def make_tarfile(output_filename, source_dir, reproducible=False, compresslevel=None, threads=None):
+    """Tar up `source_dir`, compressed according to the extension of `output_filename`.
+
+    See `write_tarfile`.
+    """
+    filename = os.path.basename(output_filename)
+    if filename.endswith(".gz"):
+        filename = filename[:-3]
+    with open(output_filename, "wb") as fp:
+        write_tarfile(fp, source_dir, tar_compression_mode(output_filename),
+                      reproducible, compresslevel, threads, filename=filename)
+
+
+def write_tarfile(
+        fileobj, source_dir, compression="", reproducible=False, compresslevel=None, threads=None,
+        filename=None):
+    """Stream a tarball of `source_dir` to `fileobj`, which is written
+    sequentially, so it may be a pipe or a socket.
+
+    `compression` is a `tar_compression_mode`. Gzip is block-parallel on
+    `threads` threads (default: one per CPU) and still standard.
+    xz and zstd are run as commands with `-T threads`, if `fileobj` has a
+    file descriptor; otherwise (or without `xz`), Python's single-threaded
+    lzma is used for xz, and zstd is an error. Memory use doesn't grow
+    with the size of the tree.
+
+    If `reproducible`, entries are sorted and have normalized timestamps,
+    modes and owners, so identical trees give identical bytes.
+    `filename` is recorded in the gzip header, unless `reproducible`.
+    """
+    epoch = source_date_epoch() if reproducible else None
+    with _compressed_output(
+            fileobj, compression, compresslevel, threads, epoch,
+            None if reproducible else filename) as output:
+        _write_tar(output, source_dir, epoch)
+
+
+class _CompressorWriter(object):
+    """File-like wrapper that writes through a bz2/lzma compressor object."""
+    def __init__(self, fileobj, compressor):
+        self.fileobj = fileobj
+        self.compressor = compressor
+
+    def write(self, data):
+        self.fileobj.write(self.compressor.compress(data))
+        return len(data)
+
+    def close(self):
+        self.fileobj.write(self.compressor.flush())
+
+
+def _has_fileno(fileobj):
+    try:
+        fileobj.fileno()
+        return True
+    except (AttributeError, IOError, ValueError):  # io.UnsupportedOperation is both of the latter
+        return False
+
+
+@contextlib.contextmanager
+def _compressed_output(fp, compression, compresslevel, threads, mtime=None, filename=None):
+    """Yield a file-like object that writes what it's given, compressed, to `fp`."""
+    command = TarCompressors.get(compression)
+    executable = command and _has_fileno(fp) and find_in_path(command)
+    if compression == ":gz":
+        with ParallelGzipWriter(
+                fp, compresslevel=9 if compresslevel is None else compresslevel,
+                max_workers=threads, mtime=mtime, filename=filename) as gz:
+            yield gz
+    elif executable:
+        cmd = [executable, "-q", "-c", "-T{}".format(threads or 0)]
+        if compresslevel is not None:
+            cmd.append("-{}".format(compresslevel))
+        if hasattr(fp, "flush"):
+            fp.flush()
+        child = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=fp)
+        try:
+            yield child.stdin
+        except:
+            child.kill()
+            child.wait()
+            raise
+        child.stdin.close()
+        retcode = child.wait()
+        if retcode != 0:
+            raise CalledProcessError(retcode, cmd)
+    elif compression in (":xz", ":bz2"):
+        if compression == ":xz":
+            import lzma
+            compressor = lzma.LZMACompressor(preset=compresslevel)
+        else:
+            import bz2
+            compressor = bz2.BZ2Compressor(9 if compresslevel is None else compresslevel)
+        writer = _CompressorWriter(fp, compressor)
+        yield writer
+        writer.close()
+    elif compression == ":zst":
+        raise ValueError("Cannot write zstd: zstd not found in PATH, or output has no file descriptor")
+    else:
+        yield fp
+
+
+def _write_tar(fileobj, source_dir, mtime=None):
+    """Stream `source_dir` to `fileobj`; with an `mtime`, reproducibly."""
+    arcroot = os.path.basename(source_dir)
+    if mtime is None:
+        with tarfile.open(fileobj=fileobj, mode="w|") as tar:
+            tar.add(source_dir, arcname=arcroot)
+        return
+
+    def normalize(tarinfo):
+        tarinfo.mtime = mtime
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = ""
+        tarinfo.mode = normalized_mode(tarinfo.mode | (stat.S_IFDIR if tarinfo.isdir() else 0)) & 0o7777
+        return tarinfo
+
+    with tarfile.open(fileobj=fileobj, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        tar.add(source_dir, arcname=arcroot, recursive=False, filter=normalize)
+        for dirpath, dirnames, filenames in os.walk(source_dir):
+            dirnames.sort()
+            arcdir = os.path.join(arcroot, os.path.relpath(dirpath, source_dir))
+            for name in sorted(dirnames + filenames):
+                tar.add(os.path.join(dirpath, name), arcname=os.path.normpath(os.path.join(arcdir, name)),
+                        recursive=False, filter=normalize)
 
 
 def zip_add_directory(
         zip_archive, source_dir,
         exclude_dirs=None, exclude_extensions=None, exclude_filenames=None,
-        prefix_dir=None, logger=None):
-    """Recursively add a directory tree to `zip_archive`."""
-    exclude_dirs = set(exclude_dirs or ())
-    exclude_extensions = set(exclude_extensions or ())
-    exclude_filenames = set(exclude_filenames or ())
+        prefix_dir=None, logger=None, path_filter=None):
+    """Recursively add a directory tree to `zip_archive`.
+
+    `path_filter` (a `PathFilter`) supersedes the `exclude_*` arguments.
+    """
     # TODO: just use regular logging
-    logger = logger or (lambda s: None)
+    if path_filter is None:
+        path_filter = PathFilter(exclude_dirs or (), exclude_extensions or (), exclude_filenames or ())
+        if logger:
+            logger("zip_add_directory: exclude_dirs={!r}, exclude_extensions={!r}, exclude_filenames={!r}".format(
+                exclude_dirs, exclude_extensions, exclude_filenames))
     relroot = abspath(os.path.join(source_dir, "."))
-    logger("zip_add_directory: exclude_dirs={!r}, exclude_extensions={!r}, exclude_filenames={!r}".format(
-        exclude_dirs, exclude_extensions, exclude_filenames))
 
-    def is_excluded_dirpath(dirpath):
-        return any([dirpath.endswith(name) for name in exclude_dirs])
+    for dirpath, reldir, entries in walk(relroot, path_filter, logger):
+        arcdir = os.path.join(prefix_dir or '', reldir or '.')
+        if not entries:
+            # add directory `dirpath` (needed for empty dirs)
+            if logger:
+                logger("zip: Adding dir {0!r} -> {1!r}".format(dirpath, arcdir))
+            zip_archive.write(dirpath, arcdir)
 
-    def is_excluded_dirname(dirname):
-        return dirname in exclude_dirs
+        for entry in entries:
+            arcname = os.path.join(arcdir, entry.name)
+            if logger:
+                logger("zip: Zipping {0!r} -> {1!r}".format(entry.path, arcname))
+            if isinstance(zip_archive, ParallelZipWriter):
+                zip_archive.write(entry.path, arcname, st=entry.stat())
+            else:
+                zip_archive.write(entry.path, arcname)
+            # TODO add symlink support, per https://gist.github.com/kgn/610907
 
-    def filename_extension_excluded(name):
-        return any([name.endswith(ext) for ext in exclude_extensions])
 
-    for dirpath, dirnames, filenames in os.walk(source_dir):
-        logger("zip: dirpath={0!r}, dirnames={1!r}, filenames={2!r}".format(
-            dirpath, dirnames, filenames))
+def zip_add_files(zip_archive, source_dir, relpaths, prefix_dir=None, logger=None, path_filter=None):
+    """Add the files `relpaths` (relative to `source_dir`, with '/' separators)
+    to `zip_archive`, in sorted order, without walking `source_dir`.
 
-        if is_excluded_dirpath(dirpath):
-            logger("zip: Removing dirpath {0!r}".format(dirpath))
-            dirnames[:] = []
-            filenames = []
-            continue
+    Files that `path_filter` excludes, and paths that aren't files, are skipped.
+    """
+    for path, relpath, st in select(abspath(source_dir), relpaths, path_filter, logger):
+        arcname = os.path.join(prefix_dir or '', relpath)
+        if logger:
+            logger("zip: Zipping {0!r} -> {1!r}".format(path, arcname))
+        if isinstance(zip_archive, ParallelZipWriter):
+            zip_archive.write(path, arcname, st=st)
         else:
-            # Must modify dirnames in-place, per os.walk documentation,
-            # to prevent traversal of excluded subdirectories.
-            # We must enumerate a copy of `dirnames` as the in-place modifications
-            # confuse the iterator.
-            for dir in list(dirnames):
-                logger("zip: Examining dir {0!r}".format(dir))
-                if is_excluded_dirname(dir) or filename_extension_excluded(dir):
-                    logger("zip: Removing dir {0!r}".format(dir))
-                    dirnames.remove(dir)
-                else:
-                    logger("zip: Retaining dir {0!r}".format(dir))
-
-        files = []
-
-        for filename in filenames:
-            if filename in exclude_filenames or filename_extension_excluded(filename):
-                logger("zip: Removing filename {0!r}".format(filename))
-                continue
-            else:
-                files.append(filename)
-
-        arcdir = os.path.join(
-            prefix_dir or '', os.path.relpath(dirpath, relroot))
-        zip_write_directory(
-            zip_archive, arcdir, dirpath, files, logger)
+            zip_archive.write(path, arcname)
 
 
 def zip_write_directory(
         zip_archive, arcdir, dirpath, filenames, logger=None):
-    logger = logger or (lambda s: None)
     if not filenames:
         # add directory `dirpath` (needed for empty dirs)
-        logger("zip: Adding dir {0!r} -> {1!r}".format(dirpath, arcdir))
+        if logger:
+            logger("zip: Adding dir {0!r} -> {1!r}".format(dirpath, arcdir))
         zip_archive.write(dirpath, arcdir)
 
     for filename in filenames:
         filepath = os.path.join(dirpath, filename)
         if os.path.isfile(filepath):  # regular files only
             arcname = os.path.join(arcdir, filename)
-            logger("zip: Zipping {0!r} -> {1!r}".format(filepath, arcname))
+            if logger:
+                logger("zip: Zipping {0!r} -> {1!r}".format(filepath, arcname))
             zip_archive.write(filepath, arcname)
             # TODO add symlink support, per https://gist.github.com/kgn/610907
 
 
 def make_zipfile(
         output_filename, source_dir,
-        exclude_dirs=None, exclude_extensions=None):
-    with zipfile.ZipFile(output_filename, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        exclude_dirs=None, exclude_extensions=None, max_workers=None, reproducible=False,
+        policy=None):
+    with ParallelZipWriter(output_filename, max_workers=max_workers, policy=policy or CompressionPolicy(),
+                           **reproducible_zip_options(reproducible)) as zip_file:
         zip_add_directory(zip_file, source_dir, exclude_dirs, exclude_extensions)
 
-def check_zipfile(zip_filename):
+
+def check_zipfile(zip_filename, max_workers=None):
+    """Check that `zip_filename` is a zip without duplicate names, then
+    decompress every entry to test its CRC, on `max_workers` threads."""
     if not zipfile.is_zipfile(zip_filename):
         raise Exception('Not a ZIP file')
     with zipfile.ZipFile(zip_filename) as zip_file:
-        zip_file.testzip()
         filenames = zip_file.namelist()
-        seen = set()
+    seen = set()
+    for filename in filenames:
+        if filename in seen:
+            raise Exception('Duplicate filename found: {}'.format(filename))
+        else:
+            seen.add(filename)
+
+    max_workers = max_workers or multiprocessing.cpu_count()
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        for bad_filename in executor.map(
+                functools.partial(_test_zip_entries, zip_filename),
+                [filenames[i::max_workers] for i in range(max_workers)]):
+            if bad_filename:
+                raise zipfile.BadZipfile('Bad CRC or header for {} in {}'.format(
+                    bad_filename, zip_filename))
+
+
+def _test_zip_entries(zip_filename, filenames):
+    """Like `ZipFile.testzip`, for some of the entries, with a ZipFile of its own."""
+    with zipfile.ZipFile(zip_filename) as zip_file:
         for filename in filenames:
-            if filename in seen:
-                raise Exception('Duplicate filename found: {}'.format(filename))
-            else:
-                seen.add(filename)
+            try:
+                with zip_file.open(filename) as fp:
+                    while fp.read(1 << 20):
+                        pass
+            except (zipfile.BadZipfile, zlib.error, EOFError):
+                # A corrupt deflate stream raises zlib.error or EOFError
+                return filename
+    return None
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+"""Time code repeatedly, report the timings as JSON, and compare them with a baseline.
+
+A benchmark is a function that does its setup and returns a `Measure`:
+the callable to time, and optionally how much work one call does (bytes,
+messages, ...) for a throughput figure, and a teardown callable.
+"""
+
+from __future__ import absolute_import, division
+
+import collections
+import datetime
+import json
+import math
+import multiprocessing
+import os
+import platform
+import sys
+
+from .trace import timer
+from .vcs import find_vcs
+
+ReportFormat = "flyingcloud-benchmarks"
+ReportVersion = 1
+
+Measure = collections.namedtuple('Measure', 'run work unit teardown')
+Measure.__new__.__defaults__ = (None, None, None)
+
+
+class Skip(Exception):
+    """Raised by a benchmark that can't run here (e.g., a missing dependency)."""
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+def summarize(name, times, work=None, unit=None, params=None):
+    """A benchmark result: the timings, in seconds, and their statistics."""
+    mean = sum(times) / len(times)
+    result = dict(
+        name=name,
+        params=params or {},
+        repeat=len(times),
+        times=times,
+        min=min(times),
+        median=median(times),
+        mean=mean,
+        stdev=math.sqrt(sum((t - mean) ** 2 for t in times) / (len(times) - 1)) if len(times) > 1 else 0.0,
+    )
+    if work:
+        result.update(work=work, unit=unit, throughput=work / result['median'] if result['median'] else None)
+    return result
+
+
+def run_benchmark(name, benchmark, repeat=5, warmup=1, params=None, args=()):
+    """Set up `benchmark(*args)`, call the returned `Measure.run` `warmup` times
+    untimed and `repeat` times timed, and return the result (see `summarize`),
+    or dict(name, skipped=reason)."""
+    try:
+        measure = benchmark(*args)
+    except Skip as e:
+        return dict(name=name, params=params or {}, skipped=str(e))
+    try:
+        for _ in range(warmup):
+            measure.run()
+        times = []
+        for _ in range(repeat):
+            start = timer()
+            measure.run()
+            times.append(timer() - start)
+    finally:
+        if measure.teardown:
+            measure.teardown()
+    return summarize(name, times, measure.work, measure.unit, params)
+
+
+def environment():
+    """Where and what the benchmarks ran: results are only comparable on like machines."""
+    vcs = find_vcs(os.path.dirname(os.path.abspath(__file__)))
+    return dict(
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        platform=platform.platform(),
+        machine=platform.machine(),
+        cpus=multiprocessing.cpu_count(),
+        sha=vcs.sha() if vcs else None,
+        argv=sys.argv,
+    )
+
+
+def report(results, **metadata):
+    return dict(
+        format=ReportFormat,
+        version=ReportVersion,
+        created=datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        environment=environment(),
+        results=results,
+        **metadata)
+
+
+def load_report(filename):
+    with open(filename) as f:
+        data = json.load(f)
+    if data.get('format') != ReportFormat:
+        raise ValueError("{}: not a benchmark report".format(filename))
+    return data
+
+
+def compare(results, baseline, threshold=0.1):
+    """Compare the median times of `results` with those of the same benchmarks
+    in `baseline` (a list of results); a benchmark more than `threshold`
+    (a fraction) slower has regressed."""
+    baseline = dict((r['name'], r) for r in baseline if 'median' in r)
+    comparisons = []
+    for result in results:
+        base = baseline.get(result['name'])
+        if base is None or 'median' not in result or not base['median']:
+            continue
+        change = result['median'] / base['median'] - 1
+        comparisons.append(dict(
+            name=result['name'], baseline=base['median'], current=result['median'],
+            change=change, regressed=change > threshold))
+    return comparisons
+
+
+def _format_seconds(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return "{:.3g}{}".format(seconds / scale, unit)
+    return "{:.3g}us".format(seconds / 1e-6)
+
+
+def format_table(results, comparisons=()):
+    changes = dict((c['name'], c) for c in comparisons)
+    width = max([len(r['name']) for r in results] + [9])
+    lines = ["{:<{w}}  {:>9}  {:>9}  {:>7}  {:>16}  {}".format(
+        "benchmark", "median", "min", "stdev", "throughput", "vs baseline", w=width)]
+    for r in results:
+        if 'skipped' in r or 'error' in r:
+            lines.append("{:<{w}}  {}".format(
+                r['name'], "skipped: " + r['skipped'] if 'skipped' in r else "failed: " + r['error'], w=width))
+            continue
+        throughput = "{:.4g} {}/s".format(r['throughput'], r['unit']) if r.get('throughput') else ""
+        change = changes.get(r['name'])
+        vs = "{:+.1%}{}".format(change['change'], "  REGRESSED" if change['regressed'] else "") if change else ""
+        lines.append("{:<{w}}  {:>9}  {:>9}  {:>7}  {:>16}  {}".format(
+            r['name'], _format_seconds(r['median']), _format_seconds(r['min']),
+            "{:.1%}".format(r['stdev'] / r['mean']) if r['mean'] else "", throughput, vs, w=width).rstrip())
+    return "\n".join(lines)
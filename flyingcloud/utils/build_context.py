@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+"""Minimal Docker build contexts, honoring .dockerignore and cached by content hash."""
+
+from __future__ import absolute_import
+
+import glob
+import hashlib
+import os
+import re
+import stat
+import tarfile
+import tempfile
+
+from .file import make_dir
+
+
+def glob_to_regex(pattern):
+    """Translate a Docker/Go-style glob, where '**' spans directories, to a regex."""
+    i, n, out = 0, len(pattern), []
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+            continue
+        elif pattern.startswith('**', i):
+            out.append('.*')
+            i += 2
+            continue
+        elif c == '*':
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            j = pattern.find(']', i + 1)
+            if j < 0:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:j]
+                if body.startswith('!') or body.startswith('^'):
+                    body = '^' + body[1:]
+                out.append('[' + body.replace('\\', '\\\\') + ']')
+                i = j
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return '^' + ''.join(out) + '$'
+
+
+class DockerIgnore(object):
+    """Exclusion rules from a .dockerignore file.
+
+    As in Docker, patterns are matched against the path relative to the
+    context root and against each of its parent directories;
+    the last matching pattern wins, and '!pattern' re-includes.
+    """
+    def __init__(self, patterns=()):
+        self.rules = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            negated = pattern.startswith('!')
+            if negated:
+                pattern = pattern[1:].strip()
+            pattern = os.path.normpath(pattern).lstrip('/')
+            if pattern == '.':
+                continue
+            self.rules.append((re.compile(glob_to_regex(pattern)), negated))
+        self.has_exceptions = any(negated for _, negated in self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    @classmethod
+    def from_file(cls, filename):
+        if not os.path.exists(filename):
+            return cls()
+        with open(filename) as fp:
+            return cls(fp.read().splitlines())
+
+    def excluded(self, relpath):
+        parts = relpath.split('/')
+        candidates = ['/'.join(parts[:i]) for i in range(len(parts), 0, -1)]
+        excluded = False
+        for regex, negated in self.rules:
+            if any(regex.match(c) for c in candidates):
+                excluded = not negated
+        return excluded
+
+
+DockerfileFrom = re.compile(r'^\s*FROM\s+(?:--\S+\s+)*(\S+)(?:\s+AS\s+(\S+))?\s*$', re.I | re.M)
+
+
+def dockerfile_base_images(dockerfile):
+    """The images named by the FROM lines of `dockerfile`, in order,
+    other than `scratch` and earlier build stages."""
+    with open(dockerfile) as fp:
+        text = fp.read()
+    images, stages = [], set()
+    for image, stage in DockerfileFrom.findall(text):
+        if image.lower() not in stages and image != 'scratch' and image not in images:
+            images.append(image)
+        if stage:
+            stages.add(stage.lower())
+    return images
+
+
+def build_context_files(context_dir, always_include=()):
+    """Sorted relative paths of the files and directories to send as build context."""
+    ignore = DockerIgnore.from_file(os.path.join(context_dir, '.dockerignore'))
+    always_include = set(always_include) | {'.dockerignore'}
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(context_dir):
+        reldir = os.path.relpath(dirpath, context_dir)
+        reldir = '' if reldir == '.' else reldir.replace(os.sep, '/') + '/'
+        for name in list(dirnames):
+            relpath = reldir + name
+            if ignore.excluded(relpath):
+                # Without '!' rules, nothing below an excluded dir can be re-included
+                if not ignore.has_exceptions:
+                    dirnames.remove(name)
+            else:
+                paths.append(relpath)
+        for name in filenames:
+            relpath = reldir + name
+            if relpath in always_include or not ignore.excluded(relpath):
+                paths.append(relpath)
+    paths.extend(p for p in always_include
+                 if p not in paths and os.path.exists(os.path.join(context_dir, p)))
+    return sorted(paths)
+
+
+def context_digest(context_dir, relpaths):
+    """SHA-256 over the names, modes and contents of the context."""
+    digest = hashlib.sha256()
+    for relpath in relpaths:
+        path = os.path.join(context_dir, relpath)
+        st = os.lstat(path)
+        digest.update("{}\0{:o}\0".format(relpath, stat.S_IMODE(st.st_mode)).encode('utf-8'))
+        if stat.S_ISLNK(st.st_mode):
+            digest.update(os.readlink(path).encode('utf-8'))
+        elif stat.S_ISREG(st.st_mode):
+            with open(path, 'rb') as fp:
+                for block in iter(lambda: fp.read(1 << 20), b''):
+                    digest.update(block)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def write_context_tar(fileobj, context_dir, relpaths):
+    with tarfile.open(fileobj=fileobj, mode='w') as tar:
+        for relpath in relpaths:
+            tar.add(os.path.join(context_dir, relpath), arcname=relpath, recursive=False)
+
+
+def make_build_context(context_dir, dockerfile, cache_dir, name, logger=None):
+    """Return (tar_filename, digest) of the build context for `dockerfile`.
+
+    The tarball is cached in `cache_dir` as `{name}-{digest}.tar`;
+    older contexts for `name` are removed.
+    """
+    logger = logger or (lambda *args: None)
+    dockerfile_relpath = os.path.relpath(dockerfile, context_dir).replace(os.sep, '/')
+    if dockerfile_relpath.startswith('../'):
+        raise ValueError("Dockerfile {} is outside build context {}".format(dockerfile, context_dir))
+    relpaths = build_context_files(context_dir, always_include=[dockerfile_relpath])
+    digest = context_digest(context_dir, relpaths)
+
+    make_dir(cache_dir, 0o755)
+    tar_filename = os.path.join(cache_dir, "{}-{}.tar".format(name, digest))
+    if os.path.exists(tar_filename):
+        logger("Reusing cached build context %s", tar_filename)
+    else:
+        logger("Writing build context %s (%d entries)", tar_filename, len(relpaths))
+        fd, temp_filename = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                write_context_tar(fp, context_dir, relpaths)
+            os.rename(temp_filename, tar_filename)
+        except:
+            os.unlink(temp_filename)
+            raise
+        stale = re.compile(re.escape(name) + r'-[0-9a-f]{64}\.tar$')
+        for old in glob.glob(os.path.join(cache_dir, "{}-*.tar".format(name))):
+            if old != tar_filename and stale.match(os.path.basename(old)):
+                os.remove(old)
+    return tar_filename, digest
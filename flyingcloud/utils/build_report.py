@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+"""Build history reports, from the durations recorded in the BuildStore.
+
+For each layer: the trend, median and 95th percentile of its build
+durations, and runs, phases and salt states that took longer than their
+rolling baseline (the median of the preceding runs) by more than a
+threshold.
+"""
+
+from __future__ import absolute_import, division, unicode_literals
+
+import re
+import time
+
+MinBaselineRuns = 3  # fewer earlier runs than this are no baseline
+
+SaltStateSeparator = re.compile(r'^-{10}\s*$', re.M)
+SaltStateField = re.compile(r'^[ \t]*(ID|Function|Name|Result|Duration):[ \t]*(.*?)[ \t]*$', re.M)
+# --state-output=terse (or mixed, for unchanged states)
+SaltTerseState = re.compile(
+    r'^\s*Name: (?P<name>.*?) - Function: (?P<function>\S+) - Result: (?P<result>\S+)'
+    r'.*?Duration: (?P<duration>[0-9.]+ ?m?s)\s*$', re.M)
+SaltDuration = re.compile(r'^([0-9.]+) ?(ms|s)?$')
+
+
+def parse_salt_duration(text):
+    match = SaltDuration.match(text.strip())
+    if not match:
+        return None
+    return float(match.group(1)) / (1000 if match.group(2) != 's' else 1)
+
+
+def parse_salt_states(output):
+    """(state ID, function, result, seconds) of each state that ran,
+    from `salt-call state.highstate` output."""
+    states = []
+    for block in SaltStateSeparator.split(output or ''):
+        fields = {}
+        for name, value in SaltStateField.findall(block):
+            fields.setdefault(name, value)  # not what's in Changes
+        duration = parse_salt_duration(fields.get('Duration', ''))
+        if fields.get('Function') and duration is not None:
+            states.append((fields.get('ID') or fields.get('Name'), fields['Function'],
+                           fields.get('Result'), duration))
+    for match in SaltTerseState.finditer(output or ''):
+        states.append((match.group('name'), match.group('function'), match.group('result'),
+                       parse_salt_duration(match.group('duration'))))
+    return states
+
+
+def percentile(values, fraction):
+    """The `fraction` (0-1) percentile of `values`, interpolated; None if empty."""
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def compare_with_baseline(value, history, threshold, min_delta):
+    """How `value` compares with the median of `history`: dict(baseline, change,
+    regressed), where it regressed if it's more than `threshold` (a fraction)
+    and `min_delta` seconds longer. None if `history` is too short."""
+    if value is None or len(history) < MinBaselineRuns:
+        return None
+    baseline = percentile(history, 0.5)
+    change = value / baseline - 1 if baseline else None
+    return dict(
+        baseline=baseline, change=change,
+        regressed=change is not None and change > threshold and value - baseline >= min_delta)
+
+
+def layer_report(store, repo, runs=20, window=10, threshold=0.5, min_delta=5.0):
+    """The report on `repo`'s last `runs` builds. Each is compared with the
+    `window` successful builds before it that had the same build-context
+    cache result (a cache hit skips the Dockerfile build)."""
+    history = store.build_history(repo, limit=runs + window)
+    successes = [b for b in history if b['status'] == 'success']
+    for build in history:
+        earlier = [b['duration'] for b in successes
+                   if b['id'] < build['id'] and b['cache_hit'] == build['cache_hit']][-window:]
+        build.update(compare_with_baseline(build['duration'], earlier, threshold, min_delta)
+                     or dict(baseline=None, change=None, regressed=False))
+    shown = history[-runs:]
+    durations = [b['duration'] for b in shown if b['status'] == 'success']
+
+    # Phases and states: the latest build against the successful ones before it
+    latest = history[-1] if history else None
+    recent = [b['id'] for b in successes if latest and b['id'] < latest['id']][-window:]
+    ids = recent + ([latest['id']] if latest else [])
+    return dict(
+        repo=repo,
+        layer=next((b['layer'] for b in reversed(history) if b['layer']), None),
+        runs=shown,
+        summary=dict(
+            runs=len(durations),
+            last=durations[-1] if durations else None,
+            median=percentile(durations, 0.5),
+            p95=percentile(durations, 0.95),
+        ),
+        phases=_breakdown(store.phase_durations(ids), recent, latest, threshold, min_delta),
+        states=_breakdown(store.state_durations(ids), recent, latest, threshold, min_delta),
+    )
+
+
+def _breakdown(durations, recent, latest, threshold, min_delta):
+    """Median, p95 and the latest value of each phase or state; regressions first,
+    then the longest."""
+    names = set(name for build_id in durations for name in durations[build_id])
+    rows = []
+    for name in names:
+        history = [durations[i][name] for i in recent if name in durations[i]]
+        value = durations[latest['id']].get(name) if latest else None
+        row = dict(name=name, latest=value, median=percentile(history, 0.5), p95=percentile(history, 0.95))
+        row.update(compare_with_baseline(value, history, threshold, min_delta)
+                   or dict(baseline=None, change=None, regressed=False))
+        rows.append(row)
+    rows.sort(key=lambda r: (not r['regressed'], -(r['latest'] or 0), str(r['name'])))
+    return rows
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "-"
+    if seconds < 60:
+        return "{:.1f}s".format(seconds)
+    if seconds < 60 * 60:
+        return "{}m{:02d}s".format(int(seconds // 60), int(seconds % 60))
+    return "{}h{:02d}m".format(int(seconds // 3600), int(seconds % 3600 // 60))
+
+
+def format_change(row):
+    if row.get('change') is None:
+        return "-"
+    return "{:+.0%}{}".format(row['change'], " REGRESSED" if row['regressed'] else "")
+
+
+def sparkline(values, levels="_.-=*#"):
+    values = [v for v in values if v is not None]
+    if not values:
+        return ""
+    low, high = min(values), max(values)
+    return "".join(
+        levels[int((v - low) / (high - low) * (len(levels) - 1)) if high > low else 0] for v in values)
+
+
+def _table(headers, rows):
+    widths = [max(len(str(c)) for c in column) for column in zip(headers, *rows)]
+    return ["  " + "  ".join("{:<{}}".format(c, w) for c, w in zip(row, widths)).rstrip()
+            for row in [headers] + rows]
+
+
+def format_report(reports, detail=None, max_rows=15):
+    """A summary line per layer report, then the runs, phases and salt states
+    of the one for `detail` (a repo). Reports with `configured` False are
+    marked as no longer configured."""
+    lines = ["Build durations by layer:"]
+    lines.extend(_table(
+        ["Layer", "Runs", "Last", "Median", "p95", "Trend", "Latest run"],
+        [[(r['layer'] or r['repo']) + ("" if r.get('configured', True) else " (not configured)"),
+          r['summary']['runs'], format_duration(r['summary']['last']),
+          format_duration(r['summary']['median']), format_duration(r['summary']['p95']),
+          sparkline(b['duration'] for b in r['runs'] if b['status'] == 'success'),
+          format_change(r['runs'][-1]) if r['runs'] else "-"]
+         for r in reports]))
+
+    for report in reports:
+        if report['repo'] != detail:
+            continue
+        name = report['layer'] or report['repo']
+        lines.extend(["", "{}: runs".format(name)])
+        lines.extend(_table(
+            ["Build", "Tag", "Started", "Status", "Duration", "vs baseline", "Image size", "Cache", "Source"],
+            [[b['id'], b['tag'] or "-",
+              time.strftime("%Y-%m-%d %H:%M", time.localtime(b['created_at'])),
+              b['status'], format_duration(b['duration']), format_change(b),
+              "{:.0f} MB".format(b['image_size'] / 1e6) if b['image_size'] else "-",
+              {None: "-", 0: "miss", 1: "hit"}[b['cache_hit']], b['source_sha'] or "-"]
+             for b in report['runs']]))
+        for title, rows, label in (
+                ("phases", report['phases'], lambda r: r['name']),
+                ("salt states", report['states'], lambda r: "{} ({})".format(*r['name']))):
+            if not rows:
+                continue
+            lines.extend(["", "{}: {} of the latest run, against the runs before it".format(name, title)])
+            lines.extend(_table(
+                ["Name", "Latest", "Median", "p95", "Change"],
+                [[label(r), format_duration(r['latest']), format_duration(r['median']),
+                  format_duration(r['p95']), format_change(r)] for r in rows[:max_rows]]))
+            if len(rows) > max_rows:
+                lines.append("  ... and {} more".format(len(rows) - max_rows))
+    return "\n".join(lines)
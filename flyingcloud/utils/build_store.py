@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+"""Build metadata store, shared safely by concurrent builds in one workspace.
+
+Supersedes `docker_tags.json`, which can still be exported for downstream scripts.
+"""
+
+from __future__ import absolute_import
+
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+
+class BuildStore(object):
+    """SQLite (WAL mode) record of every build: repo, tag, image ID, digest,
+    input hash, duration and status; and, for build history reports, the
+    layer, image size, build-context cache hit, source commit, and the
+    durations of the build's phases and salt states."""
+
+    Schema = [
+        """CREATE TABLE IF NOT EXISTS builds (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            repo TEXT NOT NULL,
+            tag TEXT,
+            image_id TEXT,
+            digest TEXT,
+            input_hash TEXT,
+            duration REAL,
+            status TEXT NOT NULL,
+            pushed INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS builds_repo_tag ON builds (repo, pushed, tag)",
+        "CREATE INDEX IF NOT EXISTS builds_repo_status ON builds (repo, status, id)",
+        """CREATE TABLE IF NOT EXISTS build_phases (
+            build_id INTEGER NOT NULL REFERENCES builds (id),
+            phase TEXT NOT NULL,
+            duration REAL NOT NULL,
+            PRIMARY KEY (build_id, phase)
+        )""",
+        """CREATE TABLE IF NOT EXISTS build_states (
+            build_id INTEGER NOT NULL REFERENCES builds (id),
+            state TEXT NOT NULL,
+            function TEXT NOT NULL,
+            result TEXT,
+            duration REAL NOT NULL,
+            PRIMARY KEY (build_id, state, function)
+        )""",
+    ]
+    # Added to `builds` after it was first released: (name, type)
+    AddedColumns = [
+        ('layer', 'TEXT'),
+        ('image_size', 'INTEGER'),
+        ('cache_hit', 'INTEGER'),
+        ('source_sha', 'TEXT'),
+    ]
+    BusyTimeout = 30  # seconds to wait for another build's write lock
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, timeout=self.BusyTimeout)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            for statement in self.Schema:
+                self.conn.execute(statement)
+        self.add_columns()
+
+    def add_columns(self):
+        columns = set(row['name'] for row in self.conn.execute("PRAGMA table_info(builds)"))
+        for name, type in self.AddedColumns:
+            if name not in columns:
+                try:
+                    with self.conn:
+                        self.conn.execute("ALTER TABLE builds ADD COLUMN {} {}".format(name, type))
+                except sqlite3.OperationalError as e:
+                    # Another build added it first
+                    if 'duplicate column' not in str(e):
+                        raise
+
+    def __repr__(self):
+        return "<%s filename=%r>" % (self.__class__.__name__, self.filename)
+
+    def close(self):
+        self.conn.close()
+
+    def record_build(
+            self, repo, tag=None, image_id=None, digest=None, input_hash=None,
+            duration=None, status='success', pushed=False, layer=None, image_size=None,
+            cache_hit=None, source_sha=None, phases=None, states=None):
+        """Record a build. `phases` maps phase names to seconds;
+        `states` is a list of (state, function, result, seconds)."""
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO builds (repo, tag, image_id, digest, input_hash, duration,"
+                " status, pushed, created_at, layer, image_size, cache_hit, source_sha)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (repo, tag, image_id, digest, input_hash, duration,
+                 status, int(bool(pushed)), time.time(), layer, image_size,
+                 None if cache_hit is None else int(bool(cache_hit)), source_sha))
+            build_id = cursor.lastrowid
+            self.conn.executemany(
+                "INSERT INTO build_phases (build_id, phase, duration) VALUES (?, ?, ?)",
+                [(build_id, phase, duration) for phase, duration in (phases or {}).items()])
+            # A state can appear twice (e.g., in an included file); keep the last
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO build_states (build_id, state, function, result, duration)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [(build_id,) + tuple(state) for state in states or ()])
+        return build_id
+
+    def latest_tag(self, repo, pushed=True):
+        """Highest (i.e., most recent timestamp) tag for `repo`."""
+        row = self.conn.execute(
+            "SELECT tag FROM builds WHERE repo = ? AND pushed = ? AND tag IS NOT NULL"
+            " ORDER BY tag DESC LIMIT 1", (repo, int(pushed))).fetchone()
+        return row['tag'] if row else None
+
+    def latest_successful_build(self, repo):
+        row = self.conn.execute(
+            "SELECT * FROM builds WHERE repo = ? AND status = 'success'"
+            " ORDER BY id DESC LIMIT 1", (repo,)).fetchone()
+        return dict(row) if row else None
+
+    def pushed_builds(self, repo):
+        """Pushed builds of `repo` (tag and created_at), newest tag first."""
+        return [dict(row) for row in self.conn.execute(
+            "SELECT tag, MIN(created_at) AS created_at FROM builds"
+            " WHERE repo = ? AND pushed = 1 AND tag IS NOT NULL"
+            " GROUP BY tag ORDER BY tag DESC", (repo,))]
+
+    def mark_unpushed(self, repo, tag):
+        """Record that `tag` no longer exists in the registry."""
+        with self.conn:
+            self.conn.execute(
+                "UPDATE builds SET pushed = 0 WHERE repo = ? AND tag = ?", (repo, tag))
+
+    def tags(self, pushed=True):
+        """{repo: [tag, ...]} in build order, as in docker_tags.json."""
+        result = {}
+        for row in self.conn.execute(
+                "SELECT repo, tag FROM builds WHERE pushed = ? AND tag IS NOT NULL"
+                " ORDER BY id", (int(pushed),)):
+            result.setdefault(row['repo'], []).append(row['tag'])
+        return result
+
+    def build_history(self, repo, limit=None):
+        """The last `limit` builds of `repo` that have a duration, oldest first."""
+        rows = self.conn.execute(
+            "SELECT * FROM builds WHERE repo = ? AND duration IS NOT NULL"
+            " ORDER BY id DESC LIMIT ?", (repo, -1 if limit is None else limit)).fetchall()
+        return [dict(row) for row in reversed(rows)]
+
+    def history_repos(self):
+        """Repos that have builds with durations, and their layer names."""
+        return [(row['repo'], row['layer']) for row in self.conn.execute(
+            "SELECT repo, MAX(layer) AS layer FROM builds WHERE duration IS NOT NULL"
+            " GROUP BY repo ORDER BY repo")]
+
+    def phase_durations(self, build_ids):
+        """{build_id: {phase: seconds}}"""
+        return self._durations("build_phases", ["phase"], build_ids)
+
+    def state_durations(self, build_ids):
+        """{build_id: {(state, function): seconds}}"""
+        return self._durations("build_states", ["state", "function"], build_ids)
+
+    def _durations(self, table, key_columns, build_ids):
+        build_ids = list(build_ids)
+        result = dict((build_id, {}) for build_id in build_ids)
+        # Stay under SQLite's limit on query parameters
+        for i in range(0, len(build_ids), 500):
+            batch = build_ids[i:i + 500]
+            for row in self.conn.execute(
+                    "SELECT build_id, {}, duration FROM {} WHERE build_id IN ({})".format(
+                        ", ".join(key_columns), table, ",".join("?" * len(batch))), batch):
+                key = tuple(row[c] for c in key_columns)
+                result[row['build_id']][key[0] if len(key) == 1 else key] = row['duration']
+        return result
+
+    def is_empty(self):
+        return self.conn.execute("SELECT 1 FROM builds LIMIT 1").fetchone() is None
+
+    def import_tags_json(self, filename, if_empty=False):
+        """Load a legacy docker_tags.json as pushed, successful builds.
+
+        With `if_empty`, only into an empty store, checked in the same write
+        transaction, so concurrent first builds import it just once;
+        returns None if the store wasn't empty.
+        """
+        with open(filename) as fp:
+            docker_tags_data = json.load(fp)
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            if if_empty and not self.is_empty():
+                return None
+            self.conn.executemany(
+                "INSERT INTO builds (repo, tag, status, pushed, created_at)"
+                " VALUES (?, ?, 'success', 1, ?)",
+                [(repo, tag, time.time())
+                 for repo, tags in sorted(docker_tags_data.items()) for tag in tags])
+        return docker_tags_data
+
+    def export_tags_json(self, filename):
+        """Atomically write pushed tags in the legacy docker_tags.json format."""
+        docker_tags_data = self.tags()
+        fd, temp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(filename)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(docker_tags_data, fp, indent=4)
+            os.chmod(temp_filename, 0o644)
+            os.rename(temp_filename, filename)
+        except:
+            os.unlink(temp_filename)
+            raise
+        return docker_tags_data
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+
+"""Asyncio backend for the Docker Engine API.
+
+Speaks HTTP/1.1 to the Engine API over its unix socket (or TCP),
+one connection per request, so that many operations can be in flight
+at once in a single event loop::
+
+    backend = AsyncDockerBackend(layer)
+    loop.run_until_complete(asyncio.gather(
+        backend.docker_pull(namespace, "quay.io/org/app_sysbase:latest"),
+        backend.docker_pull(namespace, "quay.io/org/app_pybase:latest"),
+    ))
+
+The `docker_*` methods mirror those on `DockerBuildLayer`.
+Requires Python 3.6+.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import asyncio
+import base64
+import json
+import logging
+import os
+import struct
+from urllib.parse import quote, urlencode, urlsplit
+
+from ..exceptions import DockerResultError, EngineAPIError, ExecError
+from .misc import hexdump
+
+STREAMING_CHUNK_SIZE = (1 << 20)
+DEFAULT_BASE_URL = "unix:///var/run/docker.sock"
+
+
+class EngineResponse(object):
+    """An HTTP response from the Engine API; the body is read lazily."""
+    def __init__(self, status, reason, headers, reader, writer):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.reader = reader
+        self.writer = writer
+
+    @property
+    def chunked(self):
+        return self.headers.get('transfer-encoding', '').lower() == 'chunked'
+
+    @property
+    def content_length(self):
+        length = self.headers.get('content-length')
+        return int(length) if length is not None else None
+
+    async def iter_chunks(self):
+        """Yield the body as it arrives, undoing chunked transfer-encoding."""
+        reader = self.reader
+        if self.chunked:
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                if size == 0:
+                    # Skip optional trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                data = await reader.readexactly(size)
+                await reader.readexactly(2)  # CRLF
+                yield data
+        elif self.content_length is not None:
+            remaining = self.content_length
+            while remaining > 0:
+                data = await reader.read(min(remaining, STREAMING_CHUNK_SIZE))
+                if not data:
+                    raise DockerResultError("Connection closed with {} bytes unread".format(remaining))
+                remaining -= len(data)
+                yield data
+        else:
+            while True:
+                data = await reader.read(STREAMING_CHUNK_SIZE)
+                if not data:
+                    break
+                yield data
+
+    async def read(self):
+        return b''.join([chunk async for chunk in self.iter_chunks()])
+
+    async def json(self):
+        body = await self.read()
+        return json.loads(body.decode('utf-8')) if body else None
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncEngineClient(object):
+    """Minimal asyncio client for the Docker Engine API."""
+    def __init__(self, base_url=None, version=None, timeout=5 * 60, auth_config=None):
+        self.base_url = base_url or os.environ.get('DOCKER_HOST') or DEFAULT_BASE_URL
+        self.version = version
+        self.timeout = timeout
+        self.auth_config = auth_config or {}
+        url = urlsplit(self.base_url)
+        if url.scheme == 'unix':
+            self.socket_path, self.address = url.path, None
+        elif url.scheme in ('tcp', 'http'):
+            self.socket_path, self.address = None, (url.hostname, url.port or 2375)
+        else:
+            raise ValueError("Unsupported Docker base_url: {!r}".format(self.base_url))
+
+    def __repr__(self):
+        return "<%s base_url=%r version=%r>" % (
+            self.__class__.__name__, self.base_url, self.version)
+
+    def url(self, path, params=None):
+        if self.version:
+            path = "/v{}{}".format(self.version, path)
+        params = dict((k, v) for k, v in (params or {}).items() if v is not None)
+        return path + ('?' + urlencode(params) if params else '')
+
+    def registry_auth_header(self):
+        auth = json.dumps(self.auth_config).encode('utf-8')
+        return base64.urlsafe_b64encode(auth).decode('ascii')
+
+    async def open_connection(self):
+        if self.socket_path:
+            return await asyncio.open_unix_connection(self.socket_path)
+        return await asyncio.open_connection(*self.address)
+
+    async def send(self, method, path, params=None, body=None, headers=None):
+        """Send a request and return the EngineResponse once its headers arrive.
+
+        The caller owns the response and must `close()` it.
+        """
+        reader, writer = await asyncio.wait_for(self.open_connection(), self.timeout)
+        if body is not None and not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+            headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        lines = [
+            "{} {} HTTP/1.1".format(method, self.url(path, params)),
+            "Host: docker",
+            "Connection: close",
+            "Content-Length: {}".format(len(body or b'')),
+        ]
+        lines.extend("{}: {}".format(k, v) for k, v in (headers or {}).items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + (body or b''))
+        await writer.drain()
+
+        try:
+            status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+            _, status, reason = status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+            response_headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+                if not line:
+                    break
+                k, v = line.split(':', 1)
+                response_headers[k.strip().lower()] = v.strip()
+        except Exception:
+            writer.close()
+            raise
+        response = EngineResponse(int(status), reason, response_headers, reader, writer)
+        if response.status >= 400:
+            try:
+                message = await response.read()
+            finally:
+                response.close()
+            try:
+                message = json.loads(message.decode('utf-8'))['message']
+            except (ValueError, KeyError, TypeError):
+                message = message.decode('utf-8', 'replace')
+            raise EngineAPIError(response.status, message)
+        return response
+
+    async def request(self, method, path, params=None, body=None, headers=None):
+        """Send a request and return the decoded JSON body (or None)."""
+        response = await self.send(method, path, params, body, headers)
+        try:
+            return await asyncio.wait_for(response.json(), self.timeout)
+        finally:
+            response.close()
+
+    async def stream(self, method, path, params=None, body=None, headers=None):
+        """Send a request and yield raw body chunks as they arrive."""
+        response = await self.send(method, path, params, body, headers)
+        try:
+            async for chunk in response.iter_chunks():
+                yield chunk
+        finally:
+            response.close()
+
+    async def json_stream(self, method, path, params=None, body=None, headers=None):
+        """Yield newline-delimited JSON messages (e.g., pull/push progress)."""
+        buffer = b''
+        async for chunk in self.stream(method, path, params, body, headers):
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                if line.strip():
+                    yield line
+        if buffer.strip():
+            yield buffer
+
+
+# See "Stream details" at https://docs.docker.com/engine/api/v1.18/
+# {STREAM_TYPE, 0, 0, 0, SIZE1, SIZE2, SIZE3, SIZE4}
+StreamHeader = struct.Struct('>BxxxL')
+
+
+async def demux_stream(chunks):
+    """Split a multiplexed exec/attach stream into (stream_type, payload) frames."""
+    buffer = b''
+    async for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= StreamHeader.size:
+            stream_type, size = StreamHeader.unpack_from(buffer)
+            end = StreamHeader.size + size
+            if len(buffer) < end:
+                break
+            yield stream_type, buffer[StreamHeader.size:end]
+            buffer = buffer[end:]
+    if buffer:
+        yield 1, buffer
+
+
+class AsyncDockerBackend(object):
+    """Coroutine versions of `DockerBuildLayer`'s Docker operations.
+
+    Layer-specific configuration (exposed ports, image naming, timeouts)
+    comes from `layer`.
+    """
+    def __init__(self, layer, client=None, **client_kwargs):
+        self.layer = layer
+        if client is None:
+            client_kwargs.setdefault('timeout', layer.DefaultTimeout)
+            client_kwargs.setdefault('version', layer.registry_config['docker_api_version'])
+            client = AsyncEngineClient(**client_kwargs)
+        self.client = client
+
+    async def docker_create_container(
+            self, namespace, container_name, image_name,
+            environment=None, detach=True, volume_map=None, **kwargs):
+        namespace.logger.info(
+            "Creating container '%s' from image %s",
+            container_name, image_name)
+        layer = self.layer
+        if isinstance(environment, dict):
+            environment = ["{}={}".format(k, v) for k, v in environment.items()]
+        volumes, binds = {}, []
+        for local_path, remote_path in (volume_map or {}).items():
+            volumes[remote_path] = {}
+            binds.append("{}:{}:rw".format(os.path.abspath(local_path), remote_path))
+        port_bindings = dict(
+            ("{}/tcp".format(cp), [{"HostPort": str(hp)}])
+            for cp, hp in layer.port_bindings(layer.exposed_ports).items())
+        body = dict(
+            Image=image_name,
+            Env=environment,
+            AttachStdout=not detach,
+            AttachStderr=not detach,
+            ExposedPorts=dict(
+                ("{}/tcp".format(p), {}) for p in layer.container_ports(layer.exposed_ports)),
+            Volumes=volumes or None,
+            HostConfig=dict(Binds=binds, PortBindings=port_bindings),
+        )
+        body.update(kwargs)
+        try:
+            container = await self.client.request(
+                "POST", "/containers/create", params=dict(name=container_name), body=body)
+        except EngineAPIError as e:
+            if e.status_code == 409:  # Conflict
+                raise DockerResultError(
+                    "You probably need to run 'flyingcloud --kill': {}".format(e))
+            raise
+        container_id = container['Id']
+        namespace.logger.info("Created container %s, result=%r", container_id[:12], container)
+        return container_id
+
+    async def docker_start(self, namespace, container_id):
+        return await self.client.request(
+            "POST", "/containers/{}/start".format(quote(container_id)))
+
+    async def docker_exec(self, namespace, container_id, cmd, **kwargs):
+        exec_id = await self.docker_exec_create(namespace, container_id, cmd)
+        return await self.docker_exec_start(namespace, exec_id, **kwargs)
+
+    async def docker_exec_create(self, namespace, container_id, cmd):
+        namespace.logger.info("Running %r in container %s", cmd, container_id[:12])
+        exec_create = await self.client.request(
+            "POST", "/containers/{}/exec".format(quote(container_id)),
+            body=dict(Cmd=cmd, AttachStdout=True, AttachStderr=True, Tty=False))
+        return exec_create['Id']
+
+    async def docker_exec_start(self, namespace, exec_id, timeout=None, raise_on_error=True, **kwargs):
+        timeout = timeout or self.layer.SaltExecTimeout
+        frames = demux_stream(self.client.stream(
+            "POST", "/exec/{}/start".format(exec_id), body=dict(Detach=False, Tty=False)))
+        payloads = (payload async for _, payload in frames)
+        full_output = await asyncio.wait_for(
+            self.read_docker_output_stream(namespace, payloads, "docker_exec", **kwargs),
+            timeout)
+        result = await self.client.request("GET", "/exec/{}/json".format(exec_id))
+        exit_code = result['ExitCode']
+        if exit_code and raise_on_error:
+            raise ExecError("docker_exec exit code was non-zero: {} (result: {})".format(exit_code, result))
+        return result, full_output
+
+    async def docker_logs(self, namespace, container_id, follow=True, tail='all'):
+        """Yield (stream_type, text) from a container's log as it is written."""
+        chunks = self.client.stream(
+            "GET", "/containers/{}/logs".format(quote(container_id)),
+            params=dict(follow=int(follow), stdout=1, stderr=1, tail=tail))
+        async for stream_type, payload in demux_stream(chunks):
+            yield stream_type, payload.decode('utf-8', 'replace')
+
+    async def read_docker_output_stream(self, namespace, chunks, logger_prefix, log_level=None, separator='\n'):
+        log_level = log_level or logging.DEBUG
+        logger = getattr(namespace.logger, logging.getLevelName(log_level).lower())
+        full_output = []
+
+        async for chunk in chunks:
+            try:
+                decoded_chunk = chunk.decode('utf-8')
+            except UnicodeDecodeError:
+                decoded_chunk = chunk.decode('utf-8', 'replace')
+                logger("Couldn't decode %s", hexdump(chunk, 64))
+
+            full_output.append(decoded_chunk)
+            try:
+                data = json.loads(decoded_chunk)
+            except ValueError:
+                data = decoded_chunk.rstrip('\r\n')
+            logger("%s: %s", logger_prefix, data)
+            if isinstance(data, dict) and 'error' in data:
+                raise DockerResultError("Error: {!r}".format(data))
+        return separator.join(full_output)
+
+    async def docker_commit(self, namespace, container_id, result_image_name):
+        repo, tag = self.layer.image_name2repo_tag(result_image_name)
+        return await self.client.request(
+            "POST", "/commit", params=dict(container=container_id, repo=repo, tag=tag))
+
+    async def docker_cleanup(self, namespace, container_name):
+        namespace.logger.info("docker_cleanup %s", container_name)
+        await self.docker_stop(namespace, container_name)
+        await self.docker_remove_container(namespace, container_name)
+
+    async def docker_stop(self, namespace, container_name, timeout=None):
+        return await self.client.request(
+            "POST", "/containers/{}/stop".format(quote(container_name)), params=dict(t=timeout))
+
+    async def docker_kill(self, namespace, container_name, signal=None):
+        return await self.client.request(
+            "POST", "/containers/{}/kill".format(quote(container_name)), params=dict(signal=signal))
+
+    async def docker_remove_container(self, namespace, container_name, force=True):
+        return await self.client.request(
+            "DELETE", "/containers/{}".format(quote(container_name)), params=dict(force=int(force)))
+
+    async def docker_remove_image(self, namespace, image_name, force=True):
+        return await self.client.request(
+            "DELETE", "/images/{}".format(quote(image_name)), params=dict(force=int(force)))
+
+    async def docker_tag(self, namespace, image_name, tag=None, force=True):
+        repo, tag = self.layer.image_name2repo_tag(image_name, tag)
+        namespace.logger.info("Tagging image %s as repo=%s, tag=%s", image_name, repo, tag)
+        return await self.client.request(
+            "POST", "/images/{}/tag".format(quote(image_name)),
+            params=dict(repo=repo, tag=tag, force=int(force)))
+
+    async def docker_pull(self, namespace, image_name, **kwargs):
+        repo, tag = self.layer.image_name2repo_tag(image_name)
+        return await self._docker_push_pull(
+            namespace, "pull", "POST", "/images/create",
+            params=dict(fromImage=repo, tag=tag), **kwargs)
+
+    async def docker_push(self, namespace, image_name, **kwargs):
+        repo, tag = self.layer.image_name2repo_tag(image_name)
+        return await self._docker_push_pull(
+            namespace, "push", "POST", "/images/{}/push".format(quote(repo)),
+            params=dict(tag=tag), **kwargs)
+
+    async def _docker_push_pull(self, namespace, verb, method, path, params, retries=None, **kwargs):
+        retries = retries or namespace.retries
+        headers = {'X-Registry-Auth': self.client.registry_auth_header()}
+        for i in range(retries):
+            try:
+                namespace.logger.info("calling %r, attempt %d/%d", verb, i + 1, retries)
+                lines = self.client.json_stream(method, path, params=params, headers=headers)
+                return await self.read_docker_output_stream(
+                    namespace, lines, "docker_{}".format(verb), **kwargs)
+            except (DockerResultError, OSError):
+                if i + 1 == retries:
+                    namespace.logger.error("failed calling %r after %d tries, giving up", verb, retries)
+                    raise
+                namespace.logger.exception("error calling %r, retrying", verb)
+                await asyncio.sleep(2 ** i)
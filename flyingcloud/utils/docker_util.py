@@ -2,9 +2,13 @@
 
 from __future__ import unicode_literals, absolute_import, print_function
 
+import threading
 from time import sleep
+
+import docker
 from docker.errors import APIError, DockerException
 from .. import exceptions
+from .metrics import default_registry
 
 
 def retry_call(call, name, logger, retries, *args, **kwargs):
@@ -19,8 +23,57 @@ def retry_call(call, name, logger, retries, *args, **kwargs):
 
         except (APIError, DockerException, exceptions.DockerResultError) as exc:
             logger.exception("error calling %r, retrying", call)
+            default_registry.inc('flyingcloud_retries_total', help="Failed attempts of retried calls.",
+                                 operation=name)
             sleep(2 ** i)
 
     logger.error("failed calling %r after %d tries, giving up", call,
             retries)
     raise exc
+
+
+class DockerClientRegistry(object):
+    """Cache of Docker API clients, keyed by their connection parameters.
+
+    Each client owns a connection pool, so constructing a new one per call
+    (e.g., for every long-timeout exec) pays connection setup each time.
+    The registry hands back the same client for the same
+    (base_url, timeout, version, tls) and closes them all in `close()`.
+    """
+    def __init__(self, factory=None):
+        self.factory = factory
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._clients)
+
+    @classmethod
+    def client_key(cls, *args, **kwargs):
+        tls = kwargs.get('tls')
+        if isinstance(tls, docker.tls.TLSConfig):
+            tls = (tls.cert, tls.ca_cert, tls.verify)
+        return (
+            args,
+            kwargs.get('base_url'),
+            kwargs.get('timeout'),
+            kwargs.get('version'),
+            tls,
+        )
+
+    def get(self, *args, **kwargs):
+        key = self.client_key(*args, **kwargs)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                factory = self.factory or docker.Client
+                client = self._clients[key] = factory(*args, **kwargs)
+            return client
+
+    def close(self):
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            close = getattr(client, 'close', None)
+            if close:
+                close()
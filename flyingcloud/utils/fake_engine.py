@@ -0,0 +1,483 @@
+# -*- coding: utf-8 -*-
+
+"""A fake Docker Engine API server, for benchmarks and tests that need no daemon.
+
+It answers the calls flyingcloud makes (containers, execs, commit, tag,
+build, push, pull, save and load) with synthetic payloads of configurable
+size, after a configurable latency, over TCP or a unix socket::
+
+    with FakeEngine(socket_path="/tmp/fake-docker.sock", latency=0.01,
+                    exec_output_bytes=10 << 20) as engine:
+        client = docker.Client(base_url=engine.base_url)
+        ...
+
+Nothing is stored: images and containers are accepted by any name.
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+import collections
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import struct
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qsl, unquote
+
+
+VersionPrefix = re.compile(r'^/v[0-9.]+(?=/)')
+
+# (HTTP method, path pattern, FakeEngine method)
+Routes = [(method, re.compile('^' + pattern + '$'), handler) for method, pattern, handler in [
+    ('GET', r'/_ping', 'ping'),
+    ('GET', r'/version', 'version'),
+    ('GET', r'/info', 'info'),
+    ('POST', r'/auth', 'auth'),
+    ('POST', r'/containers/create', 'container_create'),
+    ('GET', r'/containers/json', 'container_list'),
+    ('GET', r'/containers/(?P<id>[^/]+)/json', 'container_inspect'),
+    ('POST', r'/containers/(?P<id>[^/]+)/(?:start|stop|kill|restart|pause|unpause)', 'no_content'),
+    ('POST', r'/containers/(?P<id>[^/]+)/wait', 'container_wait'),
+    ('DELETE', r'/containers/(?P<id>[^/]+)', 'no_content'),
+    ('GET', r'/containers/(?P<id>[^/]+)/stats', 'container_stats'),
+    ('POST', r'/containers/(?P<id>[^/]+)/exec', 'exec_create'),
+    ('POST', r'/exec/(?P<id>[^/]+)/start', 'exec_start'),
+    ('GET', r'/exec/(?P<id>[^/]+)/json', 'exec_inspect'),
+    ('POST', r'/commit', 'commit'),
+    ('POST', r'/build', 'build'),
+    ('POST', r'/images/create', 'image_pull'),
+    ('POST', r'/images/load', 'image_load'),
+    ('GET', r'/images/json', 'image_list'),
+    ('POST', r'/images/(?P<name>.+)/push', 'image_push'),
+    ('POST', r'/images/(?P<name>.+)/tag', 'image_tag'),
+    ('GET', r'/images/(?P<name>.+)/get', 'image_get'),
+    ('GET', r'/images/(?P<name>.+)/json', 'image_inspect'),
+    ('DELETE', r'/images/(?P<name>.+)', 'image_remove'),
+]]
+
+# See "Stream details" at https://docs.docker.com/engine/api/v1.18/
+StreamHeader = struct.Struct('>BxxxL')
+
+
+def fake_id(*parts):
+    return hashlib.sha256(":".join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+
+def rechunk(chunks, size):
+    """`chunks` joined and split into pieces of `size` bytes, whatever their boundaries."""
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= size:
+            yield buffer[:size]
+            buffer = buffer[size:]
+    if buffer:
+        yield buffer
+
+
+class EngineRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeEngine/1.0"
+
+    def log_message(self, format, *args):
+        # Quiet; and unix-socket clients have no address to log
+        pass
+
+    def do_GET(self):
+        self.dispatch()
+
+    do_POST = do_DELETE = do_GET
+
+    def dispatch(self):
+        engine = self.server.engine
+        path, _, query = self.path.partition('?')
+        path = unquote(VersionPrefix.sub('', path))
+        self.params = dict(parse_qsl(query))
+        self.body_read = False
+        self.call = engine.record(self.command, path, self.params)
+        engine.enter()
+        try:
+            if engine.latency:
+                time.sleep(engine.latency)
+            for method, pattern, handler in Routes:
+                match = pattern.match(path)
+                if method == self.command and match:
+                    getattr(engine, handler)(self, **match.groupdict())
+                    break
+            else:
+                self.send_json(404, dict(message="page not found: {} {}".format(self.command, path)))
+        finally:
+            engine.leave()
+
+    def iter_body(self):
+        """The request body, in pieces as they arrive."""
+        self.body_read = True
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                yield self.rfile.read(size)
+                self.rfile.readline()
+        else:
+            remaining = int(self.headers.get('Content-Length') or 0)
+            while remaining > 0:
+                data = self.rfile.read(min(remaining, 1 << 20))
+                if not data:
+                    return
+                remaining -= len(data)
+                yield data
+
+    def drain_body(self):
+        """Read and discard the request body; return its length."""
+        return sum(len(data) for data in self.iter_body())
+
+    def json_body(self):
+        body = b''.join(self.iter_body())
+        self.call['body'] = json.loads(body.decode('utf-8')) if body.strip() else None
+        return self.call['body']
+
+    def _start(self, status, content_type=None, headers=()):
+        if not self.body_read:
+            self.drain_body()
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        for k, v in headers:
+            self.send_header(k, v)
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self._start(status, 'application/json', [('Content-Length', str(len(body)))])
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status=204):
+        self._start(status, headers=[('Content-Length', '0')])
+        self.end_headers()
+
+    def send_chunked(self, chunks, content_type='application/json', interval=0, chunk_bytes=0):
+        """Send each of `chunks` as an HTTP chunk, `interval` seconds apart,
+        as the daemon does for build, push and pull progress;
+        or, with `chunk_bytes`, split into chunks of that size."""
+        self._start(status=200, content_type=content_type, headers=[('Transfer-Encoding', 'chunked')])
+        self.end_headers()
+        if chunk_bytes:
+            chunks = rechunk(chunks, chunk_bytes)
+        for chunk in chunks:
+            self.wfile.write("{:x}\r\n".format(len(chunk)).encode('ascii') + chunk + b"\r\n")
+            if interval:
+                time.sleep(interval)
+        self.wfile.write(b"0\r\n\r\n")
+
+    def send_raw_stream(self, chunks, pause=0.01):
+        """Send `chunks` after the headers and close the connection, like a hijacked
+        exec stream. docker-py 1.x reads such streams from the raw socket, so bytes
+        arriving with the headers would be lost in http.client's buffer: hence `pause`."""
+        self._start(200, 'application/vnd.docker.raw-stream')
+        self.end_headers()
+        self.wfile.flush()
+        time.sleep(pause)
+        for chunk in chunks:
+            self.wfile.write(chunk)
+        self.close_connection = True
+
+    def send_sized(self, size, block, content_type='application/x-tar'):
+        self._start(200, content_type, [('Content-Length', str(size))])
+        self.end_headers()
+        while size > 0:
+            self.wfile.write(block[:size])
+            size -= len(block)
+
+
+class UnixEngineServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class TCPEngineServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    # Not HTTPServer: its server_bind looks up the host's FQDN, which can be slow
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeEngine(object):
+    """Serves the Engine API on `socket_path`, or on `host`:`port` (by default,
+    a free port on localhost), from a background thread.
+
+    Settings (see `Defaults`) can be passed to the constructor or changed
+    with `configure` between runs. The `requests` made are counted, by route;
+    `calls` lists each one's method, path, parameters and JSON body;
+    `max_active` is the most that were being answered at once.
+    """
+    Defaults = dict(
+        latency=0.0,  # seconds before answering each request
+        stream_interval=0.0,  # seconds between streamed progress messages
+        stream_chunk_bytes=0,  # split build, push and pull streams into chunks this size; 0, a message each
+        exec_output_bytes=1 << 20,  # output of each exec
+        exec_line_bytes=100,
+        exec_frame_bytes=4096,  # stream frames; docker-py 1.x wants them small
+        exec_invalid_utf8_every=0,  # every Nth frame holds invalid UTF-8; 0, none
+        exec_exit_code=0,
+        exec_output=None,  # [(stream, bytes)] frames to send instead of synthetic output
+        conflicting_names=(),  # container names already in use
+        push_error=None,  # error message ending each push
+        image_bytes=16 << 20,  # size of `docker save` output
+        layers=5,  # in each push and pull
+        layer_bytes=8 << 20,
+        progress_step_bytes=512 << 10,  # bytes per progress message
+        build_steps=20,
+        stats_samples=5,
+        stats_interval=0.0,
+    )
+
+    def __init__(self, socket_path=None, host='127.0.0.1', port=0, **settings):
+        self.socket_path = socket_path
+        self.address = (host, port)
+        self.configure(**dict(self.Defaults, **settings))
+        self.requests = collections.Counter()
+        self.calls = []
+        self.active = self.max_active = 0
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.server = self.thread = None
+        # Incompressible, like real image layers
+        rng = random.Random(0)
+        self.image_block = bytes(bytearray(rng.getrandbits(8) for _ in range(1 << 16))) * 16
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def configure(self, **settings):
+        for k, v in settings.items():
+            if k not in self.Defaults:
+                raise TypeError("Unknown FakeEngine setting {!r}".format(k))
+            setattr(self, k, v)
+        return self
+
+    @property
+    def base_url(self):
+        if self.socket_path:
+            return "unix://" + self.socket_path
+        return "tcp://{}:{}".format(*self.server.server_address[:2])
+
+    def start(self):
+        if self.socket_path:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self.server = UnixEngineServer(self.socket_path, EngineRequestHandler)
+        else:
+            self.server = TCPEngineServer(self.address, EngineRequestHandler)
+        self.server.engine = self
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-engine")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = self.thread = None
+            if self.socket_path and os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def record(self, method, path, params):
+        call = dict(method=method, path=path, params=params, body=None)
+        # Count by route, not by container or image
+        for route_method, pattern, handler in Routes:
+            if route_method == method and pattern.match(path):
+                path = handler
+                break
+        with self.lock:
+            self.requests[path] += 1
+            self.calls.append(call)
+        return call
+
+    def enter(self):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+    def leave(self):
+        with self.lock:
+            self.active -= 1
+
+    def new_id(self, kind):
+        return fake_id(kind, next(self.ids))
+
+    # Payloads
+
+    @classmethod
+    def json_lines(cls, messages):
+        for message in messages:
+            yield json.dumps(message).encode('utf-8') + b"\r\n"
+
+    def exec_frames(self):
+        if self.exec_output is not None:
+            for stream, data in self.exec_output:
+                yield StreamHeader.pack(stream, len(data)) + data
+            return
+        line = (b"    ID: pkg.installed - " + b"x" * self.exec_line_bytes)[:self.exec_line_bytes - 1] + b"\n"
+        payload = line * max(1, self.exec_frame_bytes // len(line))
+        invalid = payload[:-2] + b"\xff\n"
+        remaining = self.exec_output_bytes
+        for i in itertools.count(1):
+            if remaining <= 0:
+                break
+            every = self.exec_invalid_utf8_every
+            frame = (invalid if every and i % every == 0 else payload)[:remaining]
+            remaining -= len(frame)
+            yield StreamHeader.pack(1, len(frame)) + frame
+
+    def progress_messages(self, verb, repo, tag):
+        layer_ids = [fake_id(repo, tag, i)[:12] for i in range(self.layers)]
+        first, done = dict(
+            pull=("Pulling fs layer", "Pull complete"),
+            push=("Preparing", "Pushed"))[verb]
+        active = "Downloading" if verb == 'pull' else "Pushing"
+        if verb == 'pull':
+            yield dict(status="Pulling from {}".format(repo), id=tag)
+        for layer_id in layer_ids:
+            yield dict(status=first, progressDetail={}, id=layer_id)
+        step = max(1, self.progress_step_bytes)
+        for layer_id in layer_ids:
+            for current in range(step, self.layer_bytes + step, step):
+                current = min(current, self.layer_bytes)
+                yield dict(
+                    status=active, id=layer_id,
+                    progressDetail=dict(current=current, total=self.layer_bytes),
+                    progress="[{:<50}] {}/{}".format(
+                        "=" * (50 * current // self.layer_bytes), current, self.layer_bytes))
+            yield dict(status=done, progressDetail={}, id=layer_id)
+        digest = "sha256:" + fake_id(repo, tag)
+        if verb == 'pull':
+            yield dict(status="Digest: " + digest)
+            yield dict(status="Status: Downloaded newer image for {}:{}".format(repo, tag))
+        else:
+            size = self.layers * self.layer_bytes
+            yield dict(status="{}: digest: {} size: {}".format(tag, digest, size))
+            yield dict(progressDetail={}, aux=dict(Tag=tag, Digest=digest, Size=size))
+
+    # Routes
+
+    def ping(self, request):
+        request._start(200, 'text/plain', [('Content-Length', '2')])
+        request.end_headers()
+        request.wfile.write(b"OK")
+
+    def version(self, request):
+        request.send_json(200, dict(Version="fake", ApiVersion="1.24", Os="linux", Arch="amd64"))
+
+    def info(self, request):
+        request.send_json(200, dict(Containers=0, Images=0, Driver="fake", NCPU=1, MemTotal=1 << 30))
+
+    def auth(self, request):
+        request.send_json(200, dict(Status="Login Succeeded"))
+
+    def no_content(self, request, id=None):
+        request.send_empty(204)
+
+    def container_create(self, request):
+        request.json_body()
+        name = request.params.get('name')
+        if name in self.conflicting_names:
+            request.send_json(409, dict(
+                message='Conflict. The container name "/{}" is already in use'.format(name)))
+            return
+        request.send_json(201, dict(Id=self.new_id('container'), Warnings=None))
+
+    def container_list(self, request):
+        request.send_json(200, [])
+
+    def container_inspect(self, request, id):
+        request.send_json(200, dict(Id=id, State=dict(Running=True, ExitCode=0)))
+
+    def container_wait(self, request, id):
+        request.send_json(200, dict(StatusCode=0))
+
+    def container_stats(self, request, id):
+        def stats():
+            for i in range(self.stats_samples):
+                yield dict(
+                    read=time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    cpu_stats=dict(cpu_usage=dict(total_usage=(i + 1) * 10 ** 8),
+                                   system_cpu_usage=(i + 1) * 10 ** 9, online_cpus=1),
+                    precpu_stats=dict(cpu_usage=dict(total_usage=i * 10 ** 8),
+                                      system_cpu_usage=i * 10 ** 9, online_cpus=1),
+                    memory_stats=dict(usage=(i + 1) << 20, limit=1 << 30, stats=dict(cache=0)))
+        request.send_chunked(self.json_lines(stats()), interval=self.stats_interval)
+
+    def exec_create(self, request, id):
+        request.json_body()
+        request.send_json(201, dict(Id=self.new_id('exec')))
+
+    def exec_start(self, request, id):
+        request.json_body()
+        request.send_raw_stream(self.exec_frames())
+
+    def exec_inspect(self, request, id):
+        request.send_json(200, dict(ID=id, Running=False, ExitCode=self.exec_exit_code))
+
+    def commit(self, request):
+        request.json_body()
+        request.send_json(201, dict(Id="sha256:" + self.new_id('image')))
+
+    def build(self, request):
+        request.drain_body()
+        image_id = self.new_id('image')
+
+        def messages():
+            for i in range(self.build_steps):
+                yield dict(stream="Step {}/{} : RUN true\n".format(i + 1, self.build_steps))
+                yield dict(stream=" ---> {}\n".format(fake_id('step', i)[:12]))
+            yield dict(aux=dict(ID="sha256:" + image_id))
+            yield dict(stream="Successfully built {}\n".format(image_id[:12]))
+        request.send_chunked(self.json_lines(messages()), interval=self.stream_interval,
+                             chunk_bytes=self.stream_chunk_bytes)
+
+    def image_pull(self, request):
+        messages = self.progress_messages(
+            'pull', request.params.get('fromImage', ''), request.params.get('tag', 'latest'))
+        request.send_chunked(self.json_lines(messages), interval=self.stream_interval,
+                             chunk_bytes=self.stream_chunk_bytes)
+
+    def image_push(self, request, name):
+        messages = self.progress_messages('push', name, request.params.get('tag', 'latest'))
+        if self.push_error:
+            messages = itertools.chain(
+                itertools.islice(messages, self.layers),
+                [dict(errorDetail=dict(message=self.push_error), error=self.push_error)])
+        request.send_chunked(self.json_lines(messages), interval=self.stream_interval,
+                             chunk_bytes=self.stream_chunk_bytes)
+
+    def image_load(self, request):
+        size = request.drain_body()
+        request.send_chunked(self.json_lines(
+            [dict(stream="Loaded image ({} bytes)\n".format(size))]))
+
+    def image_list(self, request):
+        request.send_json(200, [])
+
+    def image_tag(self, request, name):
+        request.send_empty(201)
+
+    def image_get(self, request, name):
+        request.send_sized(self.image_bytes, self.image_block)
+
+    def image_inspect(self, request, name):
+        request.send_json(200, dict(Id="sha256:" + fake_id('image', name), RepoTags=[name]))
+
+    def image_remove(self, request, name):
+        request.send_json(200, [dict(Untagged=name)])
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+"""Gzip stream writer that deflates blocks on a thread pool, like pigz."""
+
+from __future__ import absolute_import
+
+import collections
+import concurrent.futures
+import multiprocessing
+import struct
+import time
+import zlib
+
+import six
+
+
+DICTIONARY_SIZE = 32 << 10  # deflate's window
+
+
+class ParallelGzipWriter(object):
+    """Write-only gzip stream whose blocks are deflated on `max_workers` threads.
+
+    Input is cut into `block_size` blocks. Each block is primed with the
+    last 32KB of the one before and ends with a sync flush, so together
+    they form one ordinary deflate stream and the output is a standard
+    .gz file. `fileobj` only needs a `write` method and is written
+    sequentially, from the calling thread, so it may be a pipe or socket.
+    At most `2 * max_workers` blocks are held in memory.
+    """
+    def __init__(
+            self, fileobj, compresslevel=9, max_workers=None, block_size=128 << 10,
+            mtime=None, filename=None):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        self.block_size = block_size
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.max_workers)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.dictionary = b''
+        self.crc = self.size = 0
+        self.closed = False
+        self._write_header(time.time() if mtime is None else mtime, filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _write_header(self, mtime, filename):
+        flags, extra = 0, b''
+        if filename:
+            flags, extra = 0x08, filename.encode('latin-1') + b'\0'  # FNAME
+        xfl = 2 if self.compresslevel == 9 else 4 if self.compresslevel == 1 else 0
+        self.fileobj.write(b'\x1f\x8b\x08' + struct.pack('<BLBB', flags, int(mtime), xfl, 255) + extra)
+
+    def write(self, data):
+        view = memoryview(data)
+        length = len(view)
+        if self.buffer:
+            needed = self.block_size - len(self.buffer)
+            self.buffer.extend(view[:needed])
+            view = view[needed:]
+            if len(self.buffer) < self.block_size:
+                return length
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while len(view) >= self.block_size:
+            self._submit(view[:self.block_size].tobytes())
+            view = view[self.block_size:]
+        self.buffer.extend(view)
+        return length
+
+    def flush(self):
+        """Output is only flushed by `close`: flushing blocks early would hurt compression."""
+
+    def _submit(self, block):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append(self.executor.submit(self._deflate, block, self.dictionary))
+        self.dictionary = block[-DICTIONARY_SIZE:]
+        while self.pending and (self.pending[0].done() or len(self.pending) > 2 * self.max_workers):
+            self.fileobj.write(self.pending.popleft().result())
+
+    def _deflate(self, block, dictionary):
+        if dictionary and six.PY3:
+            compressor = zlib.compressobj(
+                self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                zlib.Z_DEFAULT_STRATEGY, dictionary)
+        else:
+            compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+            # An empty final block ends the deflate stream
+            self.fileobj.write(zlib.compressobj(self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS).flush())
+            self.fileobj.write(struct.pack('<LL', self.crc & 0xFFFFFFFF, self.size & 0xFFFFFFFF))
+            if hasattr(self.fileobj, 'flush'):
+                self.fileobj.flush()
+        finally:
+            self.executor.shutdown()
+
+    def abort(self):
+        self.closed = True
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown()
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+"""Logging that never makes the caller wait for a slow terminal or log file.
+
+Records go onto a bounded queue; a background listener thread formats and
+writes them. High-volume stream output (Docker build, exec, push and pull)
+is coalesced into batches by `StreamLogger` first, and rate-limited on the
+console (but not in the log file).
+"""
+
+from __future__ import absolute_import
+
+import atexit
+import copy
+import gzip
+import logging
+import logging.handlers
+import os
+import shutil
+import threading
+import time
+
+from six.moves import queue
+
+
+DefaultFormat = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class QueueHandler(logging.Handler):
+    """Puts records on `queue` without blocking. When the queue is full,
+    records below `BlockingLevel` (debug and stream output) are dropped and
+    counted, and a warning about them is queued once there is room again;
+    warnings and errors wait for room instead."""
+    BlockingLevel = logging.WARNING
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Format now, in the caller's thread, so args needn't be thread-safe
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord(dict(
+                    name=record.name, levelno=logging.WARNING, levelname="WARNING",
+                    msg="Logging fell behind: dropped %d records" % self.dropped)))
+                self.dropped = 0
+            self.queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            if record.levelno >= self.BlockingLevel:
+                self.queue.put(self.prepare(record))
+            else:
+                self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class DestinationFilter(logging.Filter):
+    """Passes records unless they were logged with `extra={attribute: False}`,
+    e.g., to keep a record out of the console but not the log file."""
+    def __init__(self, attribute):
+        logging.Filter.__init__(self)
+        self.attribute = attribute
+
+    def filter(self, record):
+        return getattr(record, self.attribute, True)
+
+
+class QueueListener(object):
+    """Hands queued records to `handlers` on a background thread,
+    respecting each handler's level."""
+    _sentinel = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._monitor, name="log-listener")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """Write out everything queued so far, then stop."""
+        if self.thread:
+            self.queue.put(self._sentinel)  # blocks if full: we want every record
+            self.thread.join()
+            self.thread = None
+        for handler in self.handlers:
+            handler.flush()
+
+
+def gzip_rotator(source, dest):
+    with open(source, 'rb') as f_in:
+        with gzip.open(dest, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def make_file_handler(filename, max_bytes=0, backup_count=5, compress=False):
+    """A FileHandler; or, if `max_bytes`, one that rotates the file when it
+    would exceed `max_bytes`, keeping `backup_count` old files, gzipped if
+    `compress` (Python 3 only)."""
+    if not max_bytes:
+        return logging.FileHandler(filename)
+    handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count)
+    if compress and hasattr(handler, 'rotator'):
+        handler.namer = lambda name: name + ".gz"
+        handler.rotator = gzip_rotator
+    return handler
+
+
+# Installed queue listeners, by logger name
+_listeners = {}
+
+
+def configure_logging(
+        name, logfile=None, level=logging.INFO, file_level=logging.DEBUG, fmt=DefaultFormat,
+        max_bytes=0, backup_count=5, compress=False, queue_size=10000):
+    """Log `name` to the console at `level` and to `logfile` at `file_level`,
+    through a queue of up to `queue_size` records and a background listener.
+
+    Calling it again replaces the previous setup (after writing out what it
+    had queued), rather than adding more handlers.
+    """
+    logger = logging.getLogger(name)
+    stop_logging(name)
+
+    formatter = logging.Formatter(fmt)
+    handlers = []
+    console = logging.StreamHandler()
+    console.setLevel(level)
+    console.addFilter(DestinationFilter('to_console'))
+    handlers.append(console)
+    if logfile:
+        file_handler = make_file_handler(logfile, max_bytes, backup_count, compress)
+        file_handler.setLevel(file_level)
+        file_handler.addFilter(DestinationFilter('to_logfile'))
+        handlers.append(file_handler)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.Queue(maxsize=queue_size)
+    queue_handler = QueueHandler(records)
+    listener = QueueListener(records, *handlers)
+    listener.start()
+    _listeners[name] = (queue_handler, listener)
+    logger.addHandler(queue_handler)
+    logger.setLevel(min(level, file_level) if logfile else level)
+    return logger
+
+
+def stop_logging(name):
+    """Write out `name`'s queued records and remove what `configure_logging` installed."""
+    if name in _listeners:
+        queue_handler, listener = _listeners.pop(name)
+        logging.getLogger(name).removeHandler(queue_handler)
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+@atexit.register
+def _stop_all():
+    for name in list(_listeners):
+        stop_logging(name)
+
+
+class StreamLogger(object):
+    """Logs lines of stream output in batches, instead of a record per line.
+
+    A batch is logged as one record, each line prefixed with `prefix`,
+    `interval` seconds after its first line arrives or once it has
+    `max_lines` lines. With `rate_limit`, at most that many lines per
+    second (on average, in bursts of up to as many) go to the console;
+    there, the rest are counted, and the count shown. A batch with lines
+    over the limit is logged twice: in full for the log file (`to_console`
+    False), and limited for the console (`to_logfile` False).
+    """
+    def __init__(self, log, prefix, interval=0.5, max_lines=100, rate_limit=None):
+        self.log = log
+        self.prefix = prefix
+        self.interval = interval
+        self.max_lines = max_lines
+        self.rate_limit = rate_limit
+        self.lines = []
+        self.suppressed = 0
+        self.tokens = rate_limit
+        self.last_refill = time.time()
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def add(self, line):
+        with self.lock:
+            shown = True
+            if self.rate_limit:
+                now = time.time()
+                self.tokens = min(self.rate_limit, self.tokens + (now - self.last_refill) * self.rate_limit)
+                self.last_refill = now
+                if self.tokens < 1:
+                    self.suppressed += 1
+                    shown = False
+                else:
+                    self.tokens -= 1
+            self.lines.append((line, shown))
+            if len(self.lines) >= self.max_lines:
+                self._flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.lines:
+            return
+        if self.suppressed:
+            self.log("%s", self._format(line for line, _ in self.lines), extra=dict(to_console=False))
+            shown = [line for line, shown in self.lines if shown]
+            shown.append("[{} lines not shown]".format(self.suppressed))
+            self.log("%s", self._format(shown), extra=dict(to_logfile=False))
+            self.suppressed = 0
+        else:
+            self.log("%s", self._format(line for line, _ in self.lines))
+        self.lines = []
+
+    def _format(self, lines):
+        return "\n".join("{}: {}".format(self.prefix, line) for line in lines)
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""Run metrics, written in the Prometheus textfile-collector format.
+
+A run's counters, gauges and histograms are collected in a `MetricsRegistry`
+and written when it ends, for node_exporter's textfile collector to pick up
+(https://github.com/prometheus/node_exporter#textfile-collector).
+"""
+
+from __future__ import absolute_import
+
+import json
+import math
+import os
+import tempfile
+import threading
+
+
+DurationBuckets = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)  # seconds
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and not math.isinf(value):
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels) + "}"
+
+
+class MetricsRegistry(object):
+    """Thread-safe counters, gauges and histograms, with labels.
+
+    Metrics are declared on first use: `inc` makes a counter,
+    `set` a gauge and `observe` a histogram.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}  # name -> dict(type, help, buckets, samples={labels: value})
+
+    def _metric(self, name, type, help, buckets=None):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = dict(type=type, help=help or name, buckets=buckets, samples={})
+        elif metric['type'] != type:
+            raise ValueError("{} is a {}, not a {}".format(name, metric['type'], type))
+        return metric
+
+    def inc(self, name, value=1, help=None, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            samples = self._metric(name, 'counter', help)['samples']
+            samples[key] = samples.get(key, 0) + value
+
+    def set(self, name, value, help=None, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self._metric(name, 'gauge', help)['samples'][key] = value
+
+    def observe(self, name, value, help=None, buckets=DurationBuckets, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            metric = self._metric(name, 'histogram', help, tuple(buckets))
+            sample = metric['samples'].setdefault(
+                key, dict(buckets=[0] * len(metric['buckets']), sum=0, count=0))
+            for i, bound in enumerate(metric['buckets']):
+                if value <= bound:
+                    sample['buckets'][i] += 1
+            sample['sum'] += value
+            sample['count'] += 1
+
+    def value(self, name, **labels):
+        """A counter's or gauge's value, or a histogram's count; None if never recorded."""
+        metric = self.metrics.get(name)
+        sample = metric and metric['samples'].get(tuple(sorted(labels.items())))
+        return sample['count'] if isinstance(sample, dict) else sample
+
+    def clear(self):
+        with self.lock:
+            self.metrics.clear()
+
+    def text(self):
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name, metric in sorted(self.metrics.items()):
+                lines.append("# HELP {} {}".format(name, metric['help'].replace('\\', '\\\\').replace('\n', '\\n')))
+                lines.append("# TYPE {} {}".format(name, metric['type']))
+                for labels, sample in sorted(metric['samples'].items()):
+                    if metric['type'] != 'histogram':
+                        lines.append("{}{} {}".format(name, _format_labels(labels), _format_value(sample)))
+                        continue
+                    for bound, count in zip(metric['buckets'], sample['buckets']):
+                        lines.append("{}_bucket{} {}".format(
+                            name, _format_labels(labels + (('le', _format_value(float(bound))),)), count))
+                    lines.append("{}_bucket{} {}".format(
+                        name, _format_labels(labels + (('le', '+Inf'),)), sample['count']))
+                    lines.append("{}_sum{} {}".format(name, _format_labels(labels), _format_value(sample['sum'])))
+                    lines.append("{}_count{} {}".format(name, _format_labels(labels), sample['count']))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """The metrics as JSON-serializable data."""
+        with self.lock:
+            return dict(
+                (name, dict(
+                    type=metric['type'], help=metric['help'],
+                    samples=[dict(labels=dict(labels), **(
+                        dict(sample, buckets=dict(zip((str(b) for b in metric['buckets']), sample['buckets'])))
+                        if metric['type'] == 'histogram' else dict(value=sample)))
+                        for labels, sample in sorted(metric['samples'].items())]))
+                for name, metric in self.metrics.items())
+
+    def write_textfile(self, filename):
+        """Write `text()` atomically, so the collector never reads a partial file."""
+        self._write_atomically(filename, self.text())
+
+    def write_json(self, filename):
+        self._write_atomically(filename, json.dumps(self.summary(), indent=2, sort_keys=True) + "\n")
+
+    @classmethod
+    def _write_atomically(cls, filename, content):
+        dirname = os.path.dirname(os.path.abspath(filename))
+        fd, temp_filename = tempfile.mkstemp(dir=dirname, prefix=".metrics-")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+            os.chmod(temp_filename, 0o644)
+            os.rename(temp_filename, filename)
+        except:
+            os.remove(temp_filename)
+            raise
+
+
+# The process's metrics, for code that has no namespace at hand (e.g. `retry_call`)
+default_registry = MetricsRegistry()
+
+
+def transfer_bytes(output):
+    """Bytes moved by a `docker push` or `docker pull`, from its JSON progress
+    output: the largest `progressDetail` total (or current) seen for each layer."""
+    sizes = {}
+    for line in (output or '').splitlines():
+        try:
+            data = json.loads(line)
+        except ValueError:
+            continue
+        if not isinstance(data, dict) or not isinstance(data.get('progressDetail'), dict):
+            continue
+        detail = data['progressDetail']
+        size = detail.get('total') or detail.get('current')
+        if data.get('id') and isinstance(size, (int, float)) and size > 0:
+            sizes[data['id']] = max(sizes.get(data['id'], 0), size)
+    return sum(sizes.values())
@@ -10,15 +10,30 @@ import datetime
 import imp
 import json
 import os
+import posixpath
+import sys
 import zipfile
 
 from .vcs import find_vcs
-from .archive import abspath, zip_add_directory, zip_write_directory, check_zipfile
+from .archive import (
+    abspath, zip_add_directory, zip_add_files, zip_write_directory, check_zipfile,
+    reproducible_zip_options)
+from .path_filter import PathFilter, IgnoreRules, walk
+from .profiler import start_profiler, profile_phase
+from .zip_writer import ParallelZipWriter, ArchiveEntries, CompressionPolicy
 
 
 VERSION = "0.3.1"
 
 
+def pattern_level(value):
+    """Parse a PATTERN=LEVEL argument."""
+    pattern, sep, level = value.rpartition('=')
+    if not (sep and pattern and level.isdigit() and 0 <= int(level) <= 9):
+        raise argparse.ArgumentTypeError("expected PATTERN=LEVEL, LEVEL 0-9: {!r}".format(value))
+    return pattern, int(level)
+
+
 def parse_args(args=None, namespace=None, defaults=None):
     parser = argparse.ArgumentParser(
         description="Package a Cookbrite application "
@@ -37,6 +52,18 @@ def parse_args(args=None, namespace=None, defaults=None):
         'version_format',
         '{build_date}-{branch_name}-b{build_number:05d}-{sha}')
     defaults.setdefault('package_path', os.getcwd())
+    defaults.setdefault('jobs', None)
+    defaults.setdefault('previous_bundle', None)
+    defaults.setdefault('verify', False)
+    defaults.setdefault('compress_level', 6)
+    defaults.setdefault('compress_patterns', None)
+    defaults.setdefault('reproducible', 'SOURCE_DATE_EPOCH' in os.environ)
+    defaults.setdefault('exclude_patterns', None)
+    defaults.setdefault('ignore_files', None)
+    defaults.setdefault('from_vcs', False)
+    defaults.setdefault('include_paths', None)
+    defaults.setdefault('profile', None)
+    defaults.setdefault('profiler', None)
 
     vcs = find_vcs(defaults['package_path'])
     version_data = build_version_data(vcs, defaults['build_date'], defaults['build_number'])
@@ -61,6 +88,56 @@ def parse_args(args=None, namespace=None, defaults=None):
     parser.add_argument(
         '--prefix', '-p',
         help="Prefix the zipfile_name with this string.  Default: %(default)r")
+    parser.add_argument(
+        '--jobs', '-j', type=int, metavar="N",
+        help="Compress with N threads. Default: one per CPU")
+    parser.add_argument(
+        '--compress-level', '-z', type=int, choices=range(10), metavar="LEVEL",
+        help="Deflate level (1-9; 0 stores). Default: %(default)r")
+    parser.add_argument(
+        '--compress',
+        dest='compress_patterns', action='append', type=pattern_level, metavar="PATTERN=LEVEL",
+        help="Deflate files matching PATTERN at LEVEL (0 stores them). May be repeated; "
+             "the first match wins. Already-compressed types (.jpg, .png, .gz, .whl, .zip, ...) "
+             "are stored unless a PATTERN says otherwise.")
+    parser.add_argument(
+        '--reproducible',
+        action='store_true',
+        help="Give every entry the same timestamp ($SOURCE_DATE_EPOCH, or 1980-01-01) "
+             "and normalized permissions, so identical sources give an identical zipfile. "
+             "Default: %(default)r (true if SOURCE_DATE_EPOCH is set)")
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        help="Re-read the finished zipfile and test every entry's CRC.")
+    parser.add_argument(
+        '--previous-bundle', '-r',
+        metavar="ZIPFILE",
+        help="Copy unchanged files' compressed data from ZIPFILE, "
+             "a previous build of this bundle, instead of recompressing them.")
+    parser.add_argument(
+        '--exclude', '-x',
+        dest='exclude_patterns', action='append', metavar="PATTERN",
+        help="Exclude paths matching PATTERN (.gitignore syntax). May be repeated.")
+    parser.add_argument(
+        '--ignore-file',
+        dest='ignore_files', action='append', metavar="FILE",
+        help="Exclude paths matching the rules in FILE, relative to 'package_path' "
+             "(.gitignore syntax). May be repeated. Default: .ebignore")
+    parser.add_argument(
+        '--from-vcs',
+        action='store_true',
+        help="Zip only the files under 'package_path' that Git or Mercurial tracks "
+             "(the Git index, or `hg manifest`), instead of walking the tree.")
+    parser.add_argument(
+        '--include',
+        dest='include_paths', action='append', metavar="PATH",
+        help="With --from-vcs, also zip PATH (a file or directory, relative to "
+             "'package_path'), tracked or not. May be repeated.")
+    parser.add_argument(
+        '--profile', metavar="PREFIX",
+        help="Profile the packaging and write PREFIX.pstats (cProfile), PREFIX.collapsed "
+             "(sampled stacks, for flamegraph.pl or speedscope) and PREFIX.txt (a summary).")
     parser.add_argument(
         '--emit-build-info-only', '-e',
         action='store_true', default=False,
@@ -97,6 +174,11 @@ def parse_args(args=None, namespace=None, defaults=None):
     namespace = parser.parse_args(args, namespace)
     namespace.package_path = abspath(namespace.package_path)
     namespace.vcs = find_vcs(namespace.package_path)
+    if namespace.from_vcs and not namespace.vcs:
+        parser.error("--from-vcs: {!r} is not in a Git or Mercurial repository".format(
+            namespace.package_path))
+    if namespace.include_paths and not namespace.from_vcs:
+        parser.error("--include requires --from-vcs")
     namespace.version_data = build_version_data(
         namespace.vcs,
         namespace.build_date,
@@ -123,17 +205,24 @@ def build_version_data(vcs, build_date, build_number, branch_name=None, sha=None
 def build_info(namespace):
     info = namespace.version_data.copy()
     info['version'] = namespace.version_label
+    content_digest = getattr(namespace, 'content_digest', None)
+    if content_digest:
+        info['content_digest'] = content_digest
     return info
 
 
+def build_info_filename(namespace):
+    target_dir = namespace.package_path
+    if namespace.build_info_path:
+        target_dir = os.path.join(target_dir, namespace.build_info_path)
+    return os.path.join(target_dir, "version.json")
+
+
 def emit_build_info(namespace):
     info = build_info(namespace)
-    json_info = json.dumps(info, indent=4)
+    json_info = json.dumps(info, indent=4, sort_keys=True)
     if not namespace.dry_run:
-        target_dir = namespace.package_path
-        if namespace.build_info_path:
-            target_dir = os.path.join(target_dir, namespace.build_info_path)
-        with open(os.path.join(target_dir, "version.json"), "w") as f:
+        with open(build_info_filename(namespace), "w") as f:
             f.write(json_info)
             f.write('\n')
     if namespace.verbose:
@@ -146,7 +235,13 @@ def zip_package(
         exclude_dirs=None,
         exclude_extensions=None,
         exclude_filenames=None,
-        logger=None):
+        logger=None,
+        emit_info=False):
+    """Zip up the package as `namespace.zipfile_name`.
+
+    If `emit_info`, version.json is written, with the content digest
+    of everything else in the zipfile, and then added to it last.
+    """
     exclude_dirs = ((exclude_dirs or []) + [
         '.git', '.idea', '.main', '.env'])
     exclude_extensions = ((exclude_extensions or []) + [
@@ -154,56 +249,164 @@ def zip_package(
         '.coverage', '.egg-info', '.o', '.dump.gz'])
     exclude_filenames = ((exclude_filenames or []) + [
         'TAGS', '.DS_Store'])
-    logger = logger or print if namespace.verbose else lambda x: None
+    logger = (logger or print) if namespace.verbose else None
+    profiler = getattr(namespace, 'profiler', None)
+
+    if namespace.dry_run:
+        if emit_info:
+            emit_build_info(namespace)
+    else:
+        ignore_files = namespace.ignore_files or ['.ebignore']
+        patterns = list(namespace.exclude_patterns or ())
+        if emit_info:
+            patterns.append('/' + os.path.relpath(
+                build_info_filename(namespace), namespace.package_path).replace(os.sep, '/'))
+        package_filter = PathFilter(
+            exclude_dirs, exclude_extensions, exclude_filenames,
+            patterns=patterns,
+            rules=[IgnoreRules.from_file(os.path.join(namespace.package_path, f)) for f in ignore_files])
+        if logger:
+            logger("zip: exclude_dirs={!r}, exclude_extensions={!r}, exclude_filenames={!r}, "
+                   "exclude_patterns={!r}, ignore_files={!r}".format(
+                       exclude_dirs, exclude_extensions, exclude_filenames,
+                       namespace.exclude_patterns, ignore_files))
+        with profile_phase(profiler, "open_previous_bundle"):
+            previous_bundle = open_previous_bundle(namespace, logger)
+        try:
+            _zip_package(namespace, package_filter, PathFilter(exclude_dirs, exclude_extensions),
+                         logger, previous_bundle, emit_info)
+        except:
+            if previous_bundle and previous_bundle.filename != namespace.previous_bundle:
+                os.rename(previous_bundle.filename, namespace.previous_bundle)
+            raise
+        finally:
+            if previous_bundle:
+                previous_bundle.close()
+        if previous_bundle and previous_bundle.filename != namespace.previous_bundle:
+            os.remove(previous_bundle.filename)
+
+        if namespace.verify:
+            with profile_phase(profiler, "verify"):
+                check_zipfile(namespace.zipfile_name, max_workers=namespace.jobs)
 
-    if not namespace.dry_run:
-        with zipfile.ZipFile(
-                namespace.zipfile_name, "w", zipfile.ZIP_DEFLATED) as zip_archive:
-            zip_add_directory(
-                zip_archive, namespace.package_path,
-                exclude_dirs, exclude_extensions, exclude_filenames,
-                logger=logger)
-
-            # TODO: get rid of --aux-package and --packages.
-            # Bootstrap's --make-local-packages supersedes them.
-            if namespace.aux_package:
-                source_dir, prefix_dir = namespace.aux_package
+    return namespace.zipfile_name
+
+
+def open_previous_bundle(namespace, logger):
+    """The entries of `--previous-bundle`, or None if there isn't a usable one."""
+    filename = namespace.previous_bundle
+    if not filename or not os.path.exists(filename):
+        return None
+    if os.path.abspath(filename) == os.path.abspath(namespace.zipfile_name):
+        # Rebuilding the same version: keep the old bundle readable while we overwrite it
+        root, ext = os.path.splitext(filename)
+        os.rename(filename, root + ".previous" + ext)
+        filename = root + ".previous" + ext
+    entries = None
+    try:
+        entries = ArchiveEntries(filename)
+    except zipfile.BadZipfile as e:
+        if logger:
+            logger("zip: Not reusing {0!r}: {1}".format(namespace.previous_bundle, e))
+    finally:
+        if entries is None and filename != namespace.previous_bundle:
+            os.rename(filename, namespace.previous_bundle)  # don't lose the user's file
+    return entries
+
+
+def vcs_files(namespace):
+    """Paths, relative to 'package_path' with '/' separators, of the files
+    under it that the VCS tracks, plus those under `--include` paths."""
+    vcs = namespace.vcs
+    prefix = os.path.relpath(namespace.package_path, vcs.root).replace(os.sep, '/')
+    prefix = '' if prefix == '.' else prefix + '/'
+    relpaths = set(path[len(prefix):] for path in vcs.tracked_files() if path.startswith(prefix))
+    for include in namespace.include_paths or ():
+        path = os.path.join(namespace.package_path, include)
+        relpath = os.path.relpath(path, namespace.package_path).replace(os.sep, '/')
+        if relpath.startswith('../'):
+            raise ValueError("--include {!r} is outside {!r}".format(include, namespace.package_path))
+        if os.path.isdir(path):
+            for _, reldir, entries in walk(path):
+                relpaths.update(posixpath.normpath(posixpath.join(relpath, reldir, entry.name))
+                                for entry in entries)
+        else:
+            relpaths.add(relpath)
+    return relpaths
+
+
+def compression_policy(namespace):
+    return CompressionPolicy(
+        level=namespace.compress_level, levels=namespace.compress_patterns or ())
+
+
+def _zip_package(namespace, package_filter, aux_filter, logger, previous_bundle=None, emit_info=False):
+    profiler = getattr(namespace, 'profiler', None)
+    with ParallelZipWriter(
+            namespace.zipfile_name, max_workers=namespace.jobs, reuse=previous_bundle,
+            policy=compression_policy(namespace),
+            **reproducible_zip_options(namespace.reproducible)) as zip_archive:
+        with profile_phase(profiler, "zip_package_path"):
+            if namespace.from_vcs:
+                zip_add_files(
+                    zip_archive, namespace.package_path, vcs_files(namespace),
+                    path_filter=package_filter, logger=logger)
+            else:
                 zip_add_directory(
-                    zip_archive, source_dir,
-                    exclude_dirs=exclude_dirs, exclude_extensions=exclude_extensions,
-                    prefix_dir=prefix_dir, logger=logger)
-
-            if namespace.packages:
-                module_path, func, target_dir = namespace.packages
-                module = imp.load_source("tmp_pkg", module_path)
-                full_filenames = list(getattr(module, func)())
-
-                dirpath = os.path.split(full_filenames[0])[0]
-                filenames = []
-                for f in full_filenames:
-                    dir, filename = os.path.split(f)
-                    assert dir == dirpath
-                    filenames.append(filename)
-
-                zip_write_directory(
-                    zip_archive,
-                    target_dir,
-                    dirpath,
-                    filenames,
-                    logger=logger
-                )
-
-    check_zipfile(namespace.zipfile_name)
+                    zip_archive, namespace.package_path,
+                    path_filter=package_filter, logger=logger)
 
-    return namespace.zipfile_name
+        # TODO: get rid of --aux-package and --packages.
+        # Bootstrap's --make-local-packages supersedes them.
+        if namespace.aux_package:
+            source_dir, prefix_dir = namespace.aux_package
+            zip_add_directory(
+                zip_archive, source_dir,
+                path_filter=aux_filter, prefix_dir=prefix_dir, logger=logger)
+
+        if namespace.packages:
+            module_path, func, target_dir = namespace.packages
+            module = imp.load_source("tmp_pkg", module_path)
+            full_filenames = list(getattr(module, func)())
+
+            dirpath = os.path.split(full_filenames[0])[0]
+            filenames = []
+            for f in full_filenames:
+                dir, filename = os.path.split(f)
+                assert dir == dirpath
+                filenames.append(filename)
+
+            zip_write_directory(
+                zip_archive,
+                target_dir,
+                dirpath,
+                sorted(filenames) if namespace.reproducible else filenames,
+                logger=logger
+            )
+
+        if emit_info:
+            with profile_phase(profiler, "content_digest"):
+                namespace.content_digest = zip_archive.content_digest()
+            emit_build_info(namespace)
+            info_filename = build_info_filename(namespace)
+            zip_archive.write(info_filename, os.path.relpath(info_filename, namespace.package_path))
+
+    if previous_bundle and logger:
+        logger("zip: Reused {0} compressed entries from {1!r}".format(
+            zip_archive.reused_count, namespace.previous_bundle))
 
 
 def build_package(args=None, defaults=None, **kwargs):
-    namespace = parse_args(args, defaults=defaults)
-    result = emit_build_info(namespace)
-    if not namespace.emit_build_info_only:
-        result = zip_package(namespace, **kwargs)
-    return result
+    profiler = start_profiler(sys.argv[1:] if args is None else args)
+    try:
+        with profile_phase(profiler, "parse_args"):
+            namespace = parse_args(args, defaults=dict(defaults or {}, profiler=profiler))
+        if namespace.emit_build_info_only:
+            return emit_build_info(namespace)
+        return zip_package(namespace, emit_info=True, **kwargs)
+    finally:
+        if profiler:
+            print("Wrote profile to {}".format(", ".join(profiler.write())), file=sys.stderr)
 
 
 if __name__ == '__main__':
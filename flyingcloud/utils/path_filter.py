@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""Compiled exclusion rules, and a directory walker that applies them."""
+
+from __future__ import absolute_import
+
+import os
+import re
+import stat
+
+try:
+    from os import scandir
+except ImportError:  # Python < 3.5
+    from scandir import scandir
+
+from .build_context import glob_to_regex
+
+
+def compile_alternatives(regexes, template='(?:{})'):
+    """Compile several regexes into one, or return None if there are none."""
+    regexes = [r for r in regexes if r]
+    if not regexes:
+        return None
+    return re.compile(template.format('|'.join(regexes)))
+
+
+class IgnoreRules(object):
+    """Rules in .gitignore syntax, as used by .ebignore.
+
+    Patterns without a slash match at any depth; a leading or embedded
+    slash anchors a pattern to the root; a trailing slash matches only
+    directories; '!pattern' re-includes; the last matching rule wins.
+    Nested ignore files are not read.
+    """
+    def __init__(self, patterns=()):
+        self.rules = []
+        for pattern in patterns:
+            pattern = pattern.rstrip('\r\n').rstrip(' ')
+            if not pattern or pattern.startswith('#'):
+                continue
+            negated = pattern.startswith('!')
+            if negated:
+                pattern = pattern[1:]
+            elif pattern.startswith('\\'):
+                pattern = pattern[1:]
+            dir_only = pattern.endswith('/')
+            anchored = '/' in pattern.rstrip('/')
+            pattern = pattern.strip('/')
+            if not pattern:
+                continue
+            regex = glob_to_regex(pattern)
+            if not anchored:
+                regex = '^(?:.*/)?' + regex[1:]
+            self.rules.append((regex, negated, dir_only))
+        self.has_exceptions = any(negated for _, negated, _ in self.rules)
+        # Without exceptions, order doesn't matter: match all rules at once
+        self.dir_regex = compile_alternatives(regex for regex, _, _ in self.rules)
+        self.file_regex = compile_alternatives(
+            regex for regex, _, dir_only in self.rules if not dir_only)
+        self.compiled = [(re.compile(regex), negated, dir_only)
+                         for regex, negated, dir_only in self.rules]
+
+    def __len__(self):
+        return len(self.rules)
+
+    @classmethod
+    def from_file(cls, filename):
+        if not os.path.exists(filename):
+            return cls()
+        with open(filename) as fp:
+            return cls(fp.read().splitlines())
+
+    def excluded(self, relpath, is_dir=False):
+        """Whether `relpath`, relative to the root with '/' separators, is excluded."""
+        if not self.has_exceptions:
+            regex = self.dir_regex if is_dir else self.file_regex
+            return bool(regex and regex.match(relpath))
+        excluded = False
+        for regex, negated, dir_only in self.compiled:
+            if (is_dir or not dir_only) and regex.match(relpath):
+                excluded = not negated
+        return excluded
+
+
+class PathFilter(object):
+    """All of a bundle's exclusions, compiled.
+
+    Directories are excluded if their path ends with one of `exclude_dirs`
+    or `exclude_extensions`; files if their name is one of `exclude_filenames`
+    or ends with one of `exclude_extensions`. `rules` (a list of `IgnoreRules`)
+    and `patterns` (gitignore-style globs) are matched against relative paths.
+    """
+    def __init__(
+            self, exclude_dirs=(), exclude_extensions=(), exclude_filenames=(),
+            patterns=(), rules=()):
+        self.dir_regex = compile_alternatives(
+            [re.escape(s) for s in sorted(set(exclude_dirs) | set(exclude_extensions))],
+            '(?:{})$')
+        self.file_regex = compile_alternatives([
+            '^(?:{})$'.format('|'.join(re.escape(n) for n in sorted(exclude_filenames)))
+            if exclude_filenames else None,
+            '(?:{})$'.format('|'.join(re.escape(e) for e in sorted(exclude_extensions)))
+            if exclude_extensions else None,
+        ])
+        self.rules = [r for r in list(rules) + [IgnoreRules(patterns)] if r]
+
+    def excluded_dir(self, path, relpath):
+        if self.dir_regex and self.dir_regex.search(path):
+            return True
+        return any(r.excluded(relpath, is_dir=True) for r in self.rules) if relpath else False
+
+    def excluded_file(self, name, relpath):
+        if self.file_regex and self.file_regex.search(name):
+            return True
+        return any(r.excluded(relpath) for r in self.rules)
+
+
+def walk(top, path_filter=None, logger=None):
+    """Walk the tree under `top`, top-down and sorted by name, skipping what
+    `path_filter` excludes.
+
+    Yields `(dirpath, reldir, files)` for each directory, where `reldir` is
+    relative to `top` with '/' separators ('' for `top` itself) and `files`
+    are the `DirEntry`s of the regular files (or links to them) to keep.
+    As with `os.walk`, symlinks to directories are not followed
+    and unreadable directories are skipped.
+    """
+    path_filter = path_filter or PathFilter()
+    if path_filter.excluded_dir(top, ''):
+        if logger:
+            logger("walk: Removing dirpath {0!r}".format(top))
+        return
+    stack = [(top, '')]
+    while stack:
+        dirpath, reldir = stack.pop()
+        try:
+            entries = sorted(scandir(dirpath), key=lambda entry: entry.name)
+        except OSError:
+            continue
+        prefix = reldir + '/' if reldir else ''
+        files, subdirs = [], []
+        for entry in entries:
+            relpath = prefix + entry.name
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                is_file = not is_dir and entry.is_file()
+            except OSError:
+                continue
+            if is_dir:
+                if path_filter.excluded_dir(entry.path, relpath):
+                    if logger:
+                        logger("walk: Removing dir {0!r}".format(entry.path))
+                else:
+                    subdirs.append((entry.path, relpath))
+            elif is_file:
+                if path_filter.excluded_file(entry.name, relpath):
+                    if logger:
+                        logger("walk: Removing filename {0!r}".format(entry.path))
+                else:
+                    files.append(entry)
+        yield dirpath, reldir, files
+        stack.extend(reversed(subdirs))
+
+
+def select(top, relpaths, path_filter=None, logger=None):
+    """The files among `relpaths` (relative to `top`, with '/' separators)
+    that `path_filter` keeps, without walking the tree.
+
+    Yields `(path, relpath, stat)`, sorted by `relpath`, for the regular
+    files (or links to them); missing files and anything else are skipped.
+    Each file's parent directories are checked too, as `walk` would.
+    """
+    path_filter = path_filter or PathFilter()
+    excluded_dirs = {'': path_filter.excluded_dir(top, '')}
+
+    def excluded_dir(reldir):
+        if reldir not in excluded_dirs:
+            parent = reldir.rpartition('/')[0]
+            excluded_dirs[reldir] = excluded_dir(parent) or path_filter.excluded_dir(
+                os.path.join(top, reldir), reldir)
+            if excluded_dirs[reldir] and logger and not excluded_dirs[parent]:
+                logger("select: Removing dir {0!r}".format(os.path.join(top, reldir)))
+        return excluded_dirs[reldir]
+
+    for relpath in sorted(set(relpaths)):
+        reldir, _, name = relpath.rpartition('/')
+        if excluded_dir(reldir):
+            continue
+        path = os.path.join(top, *relpath.split('/'))
+        if path_filter.excluded_file(name, relpath):
+            if logger:
+                logger("select: Removing filename {0!r}".format(path))
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            if logger:
+                logger("select: Missing {0!r}".format(path))
+            continue
+        if stat.S_ISREG(st.st_mode):
+            yield path, relpath, st
@@ -2,21 +2,64 @@
 
 from __future__ import absolute_import, print_function
 
+import collections
+import concurrent.futures
+import locale
 import logging
+import multiprocessing
 import os
+import signal
 import subprocess
+import threading
+import time
+
+import six
+from six.moves import queue
 
 
 DevNull = os.open(os.devnull, os.O_RDWR)
 
+STDOUT, STDERR = "stdout", "stderr"
+
+CommandResult = collections.namedtuple('CommandResult', 'cmd output error elapsed')
+
 
 class CalledProcessError(subprocess.CalledProcessError):
-    def __init__(self, returncode, cmd, output=None):
+    """`output`, if any, is the tail of the command's output."""
+    def __init__(self, returncode, cmd, output=None, cwd=None):
         super(CalledProcessError, self).__init__(returncode, cmd, output)
-        self.cwd = os.getcwd()
+        self.cwd = cwd or os.getcwd()
+
+    def __str__(self):
+        return "Command '%s' (working dir: '%s') returned non-zero exit status %d%s" % (
+            self.cmd, self.cwd, self.returncode, self._output_tail())
+
+    def _output_tail(self):
+        return "; last lines of output:\n" + self.output if self.output else ""
+
+
+class CommandTimeoutError(CalledProcessError):
+    """The command ran longer than `timeout`, or was silent for longer than
+    `idle_timeout`, and its process group was killed."""
+    def __init__(self, cmd, timeout, idle=False, output=None, cwd=None):
+        super(CommandTimeoutError, self).__init__(-getattr(signal, 'SIGKILL', 9), cmd, output, cwd)
+        self.timeout = timeout
+        self.idle = idle
+
+    def __str__(self):
+        return "Command '%s' (working dir: '%s') %s %gs and was killed%s" % (
+            self.cmd, self.cwd, "produced no output for" if self.idle else "timed out after",
+            self.timeout, self._output_tail())
+
+
+class CommandCancelledError(CalledProcessError):
+    """The command was killed because its `cancel` event was set."""
+    def __init__(self, cmd, output=None, cwd=None):
+        super(CommandCancelledError, self).__init__(-getattr(signal, 'SIGKILL', 9), cmd, output, cwd)
+
     def __str__(self):
-        return "Command '%s' (working dir: '%s') returned non-zero exit status %d" % (
-            self.cmd, self.cwd, self.returncode)
+        return "Command '%s' (working dir: '%s') was cancelled%s" % (
+            self.cmd, self.cwd, self._output_tail())
 
 
 def run_command_using_sh(cmd, env, kwargs):
@@ -53,15 +96,147 @@ def run_command_using_popen(cmd, env, kwargs):
     return command_stderr, command_stdout, retcode
 
 
+def _put(lines, item, stop):
+    """Queue `item`, unless the consumer has gone away."""
+    while not stop.is_set():
+        try:
+            lines.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def _read_lines(pipe, stream, lines, stop):
+    encoding = locale.getpreferredencoding(False)
+    try:
+        for raw_line in iter(pipe.readline, b''):
+            # Undecodable bytes mustn't stop the reader: the command would block on a full pipe
+            for line in raw_line.decode(encoding, 'replace').splitlines() or ['']:
+                _put(lines, (stream, line), stop)
+    except (IOError, OSError, ValueError):
+        pass  # pipe closed under us
+    finally:
+        _put(lines, (stream, None), stop)
+
+
+def _kill(child, grace_period, process_group):
+    """SIGTERM, then SIGKILL after `grace_period`, the child; and everything
+    it started, if it leads its own `process_group`."""
+    if os.name != 'posix':
+        child.kill()
+        return
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            if process_group:
+                os.killpg(child.pid, sig)
+            else:
+                os.kill(child.pid, sig)
+        except OSError:
+            return  # already gone
+        deadline = time.time() + grace_period
+        while child.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        if child.poll() is not None:
+            return
+
+
+def iter_command(
+        cmd, env=os.environ, timeout=None, idle_timeout=None,
+        tail_lines=50, kill_grace_period=5, kill_process_group=False, cancel=None,
+        **kwargs):
+    """
+    Run `cmd` and yield `(stream, line)` for each line of its output as it
+    arrives, where `stream` is STDOUT or STDERR, without buffering the output.
+
+    If the command runs longer than `timeout` seconds, or says nothing for
+    `idle_timeout` seconds, it is killed (SIGTERM, then SIGKILL) and
+    CommandTimeoutError is raised. A non-zero exit raises CalledProcessError.
+    Either way, the error carries the last `tail_lines` lines of output.
+    Output is decoded with the locale's encoding; undecodable bytes become U+FFFD.
+    Closing the generator early, or setting the `cancel` event, also
+    kills the command; the latter raises CommandCancelledError.
+
+    With `kill_process_group`, the command runs in a session of its own,
+    so that killing it kills its children too; but then it no longer gets
+    the terminal's Ctrl-C.
+    """
+    if kill_process_group and os.name == 'posix':
+        if six.PY3:
+            kwargs.setdefault('start_new_session', True)
+        else:
+            kwargs.setdefault('preexec_fn', os.setsid)
+    child = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env,
+        **kwargs)
+    lines = queue.Queue(maxsize=1000)
+    stop = threading.Event()
+    readers = [threading.Thread(target=_read_lines, args=(pipe, stream, lines, stop))
+               for pipe, stream in ((child.stdout, STDOUT), (child.stderr, STDERR))]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    tail = collections.deque(maxlen=tail_lines)
+    start = last_output = time.time()
+    open_streams = len(readers)
+    try:
+        while True:
+            now = time.time()
+            deadlines = []
+            if timeout is not None:
+                deadlines.append((start + timeout, False, timeout))
+            if idle_timeout is not None:
+                deadlines.append((last_output + idle_timeout, True, idle_timeout))
+            deadline, idle, limit = min(deadlines) if deadlines else (None, False, None)
+            if deadline is not None and now >= deadline:
+                _kill(child, kill_grace_period, kill_process_group)
+                raise CommandTimeoutError(cmd, limit, idle, "\n".join(tail), kwargs.get('cwd'))
+            if cancel is not None:
+                if cancel.is_set():
+                    _kill(child, kill_grace_period, kill_process_group)
+                    raise CommandCancelledError(cmd, "\n".join(tail), kwargs.get('cwd'))
+                deadline = min(deadline or now + 0.1, now + 0.1)  # poll `cancel`
+            if open_streams:
+                try:
+                    stream, line = lines.get(timeout=None if deadline is None else deadline - now)
+                except queue.Empty:
+                    continue
+                if line is None:
+                    open_streams -= 1
+                    continue
+                last_output = time.time()
+                tail.append(line)
+                yield stream, line
+            elif child.poll() is not None:
+                break
+            else:
+                # Output closed, but the command hasn't exited yet
+                time.sleep(0.05 if deadline is None else max(0, min(0.05, deadline - now)))
+    finally:
+        stop.set()
+        if child.poll() is None:
+            _kill(child, kill_grace_period, kill_process_group)
+        child.stdout.close()
+        child.stderr.close()
+
+    if child.returncode != 0:
+        raise CalledProcessError(child.returncode, cmd, "\n".join(tail), kwargs.get('cwd'))
+
+
 def run_command(
         cmd, env=os.environ,
         logger=None, loggerName=None, log_errors=True,
+        timeout=None, idle_timeout=None,
         **kwargs):
     """
     Run the given command, possibly modifying it by inserting some
     convenient options, with the given environment.  Returns an array
     of lines from stdout on success; raises a
-    CalledProcessError on failure.
+    CalledProcessError on failure, or CommandTimeoutError if `timeout`
+    or `idle_timeout` expires (see `iter_command`).
     """
     logger = logger or logging.getLogger(loggerName)
 
@@ -73,20 +248,61 @@ def run_command(
                 logger.warn("run_command: Ignoring keyword %s", kw)
             del kwargs[kw]
 
-    command_stderr, command_stdout, retcode = run_command_using_popen(cmd, env, kwargs)
-
-    if retcode != 0:
-        for line in command_stderr.splitlines():
+    output = {STDOUT: [], STDERR: []}
+    try:
+        for stream, line in iter_command(cmd, env, timeout=timeout, idle_timeout=idle_timeout, **kwargs):
+            output[stream].append(line)
+    except CalledProcessError:
+        for line in output[STDERR]:
             if log_errors:
                 logger.error("%s", line)
             else:
                 logger.debug("%s", line)
-        raise CalledProcessError(retcode, cmd)
+        raise
 
-    rv = command_stdout.splitlines() + command_stderr.splitlines()
+    rv = output[STDOUT] + output[STDERR]
 
     logger.debug("in %s, %s => %s",
                  kwargs.get('cwd', os.getcwd()),
                  cmd, rv)
     # TODO: return (retcode, stdout, stderr)
     return rv
+
+
+def run_commands(cmds, max_workers=None, fail_fast=True, **kwargs):
+    """
+    Run several commands concurrently, at most `max_workers` at a time
+    (default: the CPU count plus 4, as they mostly wait on I/O).
+    `kwargs` are passed to `run_command` for every command.
+
+    Returns a list of `CommandResult(cmd, output, error, elapsed)`, in the
+    order of `cmds`, where `output` is what `run_command` returned (None
+    on failure), `error` is the exception (None on success) and `elapsed`
+    is in seconds. If `fail_fast`, the first failure kills the commands
+    still running and skips those not yet started; then the failure (the
+    first in `cmds` order, if several failed at once) is raised instead.
+    """
+    cmds = list(cmds)
+    max_workers = max_workers or min(32, multiprocessing.cpu_count() + 4)
+    cancel = threading.Event() if fail_fast else None
+
+    def run(cmd):
+        start = time.time()
+        try:
+            if cancel is not None and cancel.is_set():
+                raise CommandCancelledError(cmd, cwd=kwargs.get('cwd'))
+            return CommandResult(cmd, run_command(cmd, cancel=cancel, **kwargs), None, time.time() - start)
+        except (CalledProcessError, OSError) as e:
+            if cancel is not None and not isinstance(e, CommandCancelledError):
+                cancel.set()
+            return CommandResult(cmd, None, e, time.time() - start)
+
+    if not cmds:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(min(max_workers, len(cmds))) as executor:
+        results = list(executor.map(run, cmds))
+    if fail_fast:
+        errors = [r.error for r in results if r.error and not isinstance(r.error, CommandCancelledError)]
+        if errors:
+            raise errors[0]
+    return results
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""Profile flyingcloud's own Python: cProfile plus a sampling profiler.
+
+`Profiler(prefix)` writes
+ - `prefix.pstats`: cProfile statistics of the main thread (`python -m pstats`, snakeviz, ...)
+ - `prefix.collapsed`: stacks sampled from every thread, one `frame;frame;... count` line each,
+   for flamegraph.pl or speedscope; each stack starts with its thread and the phases
+   (see `phase`) it was in, so time is attributed to build stages
+ - `prefix.txt`: samples per phase, and the top functions by cumulative time
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import cProfile
+import collections
+import contextlib
+import os
+import pstats
+import sys
+import threading
+import time
+
+import six
+
+
+def profile_prefix(argv):
+    """The value of `--profile` in `argv`, or None: for starting the profiler
+    before the full command line (which needs the configuration) is parsed."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--profile')
+    namespace, _ = parser.parse_known_args(argv)
+    return namespace.profile
+
+
+def start_profiler(argv):
+    """A started Profiler if `argv` has `--profile PREFIX`, else None."""
+    prefix = profile_prefix(argv)
+    return Profiler(prefix).start() if prefix else None
+
+
+@contextlib.contextmanager
+def profile_phase(profiler, name):
+    """`profiler.phase(name)`, or nothing if `profiler` is None."""
+    if profiler is None:
+        yield
+    else:
+        with profiler.phase(name):
+            yield
+
+
+def frame_name(code):
+    return "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+
+
+class Profiler(object):
+    def __init__(self, prefix, interval=0.005):
+        self.prefix = prefix
+        self.interval = interval
+        self.profile = cProfile.Profile()
+        self.stacks = collections.Counter()
+        self.phases = {}  # thread ident -> list of phase names
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.sampler = None
+        self.start_time = self.duration = None
+
+    def start(self):
+        self.start_time = time.time()
+        self.sampler = threading.Thread(target=self._sample, name="profiler")
+        self.sampler.daemon = True
+        self.sampler.start()
+        self.profile.enable()
+        return self
+
+    def stop(self):
+        if self.sampler is None:
+            return
+        self.profile.disable()
+        self.stopping.set()
+        self.sampler.join()
+        self.sampler = None
+        self.duration = time.time() - self.start_time
+
+    def push_phase(self, name):
+        with self.lock:
+            self.phases.setdefault(threading.current_thread().ident, []).append(name)
+
+    def pop_phase(self):
+        with self.lock:
+            self.phases[threading.current_thread().ident].pop()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Attribute samples taken in the body, on this thread, to phase `name`."""
+        self.push_phase(name)
+        try:
+            yield
+        finally:
+            self.pop_phase()
+
+    def _sample(self):
+        own = threading.current_thread().ident
+        while not self.stopping.wait(self.interval):
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            with self.lock:
+                phases = dict((ident, tuple(p)) for ident, p in self.phases.items())
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append("phase:" + ";phase:".join(phases[ident]) if phases.get(ident) else "phase:-")
+                stack.append("thread:" + names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def phase_samples(self):
+        """Samples per phase (innermost phase of each stack), over all threads."""
+        counts = collections.Counter()
+        for stack, count in self.stacks.items():
+            phases = [f[len("phase:"):] for f in stack.split(";") if f.startswith("phase:")]
+            counts[phases[-1] if phases else "-"] += count
+        return counts
+
+    def write(self):
+        """Write the .pstats, .collapsed and .txt files; returns their names."""
+        self.stop()
+        filenames = [self.prefix + ext for ext in (".pstats", ".collapsed", ".txt")]
+        self.profile.dump_stats(filenames[0])
+        with open(filenames[1], 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write("{} {}\n".format(stack, count))
+
+        stream = six.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.sort_stats('cumulative').print_stats(40)
+        with open(filenames[2], 'w') as f:
+            total = sum(self.stacks.values()) or 1
+            f.write("Profiled {:.1f}s; {} samples every {}s\n\nSamples by phase (all threads):\n".format(
+                self.duration, sum(self.stacks.values()), self.interval))
+            for name, count in self.phase_samples().most_common():
+                f.write("  {:6.1f}%  {:6d}  {}\n".format(100.0 * count / total, count, name))
+            f.write("\nMain thread, by cumulative time:\n")
+            f.write(stream.getvalue())
+        return filenames
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""Sample a container's CPU, memory, block I/O and network use while it works."""
+
+from __future__ import absolute_import
+
+import threading
+import time
+
+
+SampleFields = ('cpu_percent', 'memory_bytes', 'block_read_bytes', 'block_write_bytes',
+                'network_rx_bytes', 'network_tx_bytes')
+# Cumulative counters, summarized by their increase rather than peak and average
+CounterFields = ('block_read_bytes', 'block_write_bytes', 'network_rx_bytes', 'network_tx_bytes')
+
+
+def parse_stats(stats):
+    """One sample from an Engine API stats object: CPU use as a percentage
+    of one CPU (as `docker stats` shows it), memory in use excluding the
+    page cache, and cumulative block I/O and network bytes."""
+    cpu, precpu = stats.get('cpu_stats') or {}, stats.get('precpu_stats') or {}
+    cpu_percent = 0.0
+    cpu_delta = (cpu.get('cpu_usage', {}).get('total_usage', 0)
+                 - precpu.get('cpu_usage', {}).get('total_usage', 0))
+    system_delta = cpu.get('system_cpu_usage', 0) - precpu.get('system_cpu_usage', 0)
+    if precpu.get('system_cpu_usage') and cpu_delta > 0 and system_delta > 0:
+        online_cpus = cpu.get('online_cpus') or len(cpu.get('cpu_usage', {}).get('percpu_usage') or [1])
+        cpu_percent = 100.0 * cpu_delta / system_delta * online_cpus
+
+    memory = stats.get('memory_stats') or {}
+    memory_stats = memory.get('stats') or {}
+    # cgroup v1 reports "cache"; v2, "inactive_file"
+    cache = memory_stats.get('total_inactive_file', memory_stats.get('inactive_file', memory_stats.get('cache', 0)))
+    memory_bytes = max(0, memory.get('usage', 0) - cache)
+
+    block_read = block_write = 0
+    for entry in (stats.get('blkio_stats') or {}).get('io_service_bytes_recursive') or []:
+        op = (entry.get('op') or '').lower()
+        if op == 'read':
+            block_read += entry.get('value', 0)
+        elif op == 'write':
+            block_write += entry.get('value', 0)
+
+    networks = (stats.get('networks') or {}).values()
+    return dict(
+        cpu_percent=cpu_percent,
+        memory_bytes=memory_bytes,
+        memory_limit_bytes=memory.get('limit', 0),
+        block_read_bytes=block_read,
+        block_write_bytes=block_write,
+        network_rx_bytes=sum(n.get('rx_bytes', 0) for n in networks),
+        network_tx_bytes=sum(n.get('tx_bytes', 0) for n in networks),
+    )
+
+
+def summarize(samples):
+    """Peaks and averages of the gauges, and increases of the counters."""
+    if not samples:
+        return dict(samples=0, duration=0, peaks={}, averages={}, totals={})
+    summary = dict(
+        samples=len(samples),
+        duration=samples[-1]['t'] - samples[0]['t'],
+        peaks={}, averages={}, totals={})
+    for field in SampleFields:
+        values = [s[field] for s in samples]
+        if field in CounterFields:
+            summary['totals'][field] = values[-1] - values[0]
+            if summary['duration'] > 0:
+                summary['averages'][field + '_per_second'] = summary['totals'][field] / summary['duration']
+        else:
+            summary['peaks'][field] = max(values)
+            summary['averages'][field] = sum(values) / float(len(values))
+    summary['memory_limit_bytes'] = samples[-1]['memory_limit_bytes']
+    return summary
+
+
+class ResourceSampler(object):
+    """Streams `client.stats(container)` on a background thread, keeping a
+    sample every `interval` seconds (Docker reports about once a second).
+
+        with ResourceSampler(client, container_id, interval=5) as sampler:
+            ... # run something in the container
+        profile = sampler.profile()
+    """
+    def __init__(self, client, container, interval=1.0, logger=None):
+        self.client = client
+        self.container = container
+        self.interval = interval
+        self.logger = logger
+        self.samples = []
+        self.error = None
+        self.stopping = threading.Event()
+        self.thread = None
+        self.start_time = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self._run, name="stats-" + self.container[:12])
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        try:
+            for stats in self.client.stats(self.container, decode=True, stream=True):
+                if self.stopping.is_set():
+                    break
+                now = time.time()
+                if self.samples and now - self.start_time - self.samples[-1]['t'] < self.interval * 0.9:
+                    continue
+                sample = parse_stats(stats)
+                sample['t'] = now - self.start_time
+                self.samples.append(sample)
+        except Exception as e:
+            # The container went away, or the daemon doesn't support stats
+            self.error = e
+            if self.logger and not self.stopping.is_set():
+                self.logger("Stopped sampling %s: %s", self.container[:12], e)
+
+    def stop(self, timeout=5):
+        """Stop sampling; the thread notices at the next report from Docker."""
+        self.stopping.set()
+        if self.thread:
+            self.thread.join(timeout)
+
+    def profile(self):
+        samples = list(self.samples)
+        return dict(
+            container=self.container,
+            interval=self.interval,
+            started=self.start_time,
+            summary=summarize(samples),
+            samples=samples,
+        )
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+"""Build timelines in Chrome's trace-event format.
+
+Load the output of `Tracer.write` in chrome://tracing or https://ui.perfetto.dev.
+"""
+
+from __future__ import absolute_import
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Monotonic where available
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class Tracer(object):
+    """Records spans as trace events, from any thread.
+
+    Each span becomes a complete ("X") event on its thread's track,
+    so nested and concurrent spans show up as such.
+    Timestamps are microseconds since the tracer was created.
+    With a `profiler` (see utils.profiler), each span is also a profiling phase.
+    """
+    def __init__(self, process_name="flyingcloud", profiler=None):
+        self.process_name = process_name
+        self.profiler = profiler
+        self.pid = os.getpid()
+        self.origin = timer()
+        self.start_time = time.time()
+        self.events = []
+        self.thread_names = {}
+        self.lock = threading.Lock()
+
+    def _now(self):
+        return (timer() - self.origin) * 1e6
+
+    def _add(self, event):
+        thread = threading.current_thread()
+        event.update(pid=self.pid, tid=thread.ident)
+        with self.lock:
+            self.thread_names.setdefault(thread.ident, thread.name)
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, category="build", **args):
+        """Time the body as a span. Yields `args`, so the body can add to them;
+        an exception is recorded in them as `error`."""
+        start = self._now()
+        if self.profiler is not None:
+            self.profiler.push_phase(name)
+        try:
+            yield args
+        except BaseException as e:
+            args['error'] = repr(e)
+            raise
+        finally:
+            if self.profiler is not None:
+                self.profiler.pop_phase()
+            self._add(dict(name=name, cat=category, ph="X", ts=start, dur=self._now() - start,
+                           args=args))
+
+    def instant(self, name, category="build", **args):
+        self._add(dict(name=name, cat=category, ph="i", s="t", ts=self._now(), args=args))
+
+    def trace_events(self):
+        with self.lock:
+            metadata = [dict(name="process_name", ph="M", pid=self.pid, args=dict(name=self.process_name))]
+            metadata.extend(
+                dict(name="thread_name", ph="M", pid=self.pid, tid=tid, args=dict(name=name))
+                for tid, name in sorted(self.thread_names.items()))
+            return metadata + sorted(self.events, key=lambda e: e['ts'])
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(dict(
+                traceEvents=self.trace_events(),
+                displayTimeUnit="ms",
+                otherData=dict(start_time=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.start_time))),
+            ), f)
+            f.write('\n')
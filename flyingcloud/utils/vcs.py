@@ -1,18 +1,57 @@
 # -*- coding: utf-8 -*-
 
-"""Simple wrapper around Git and Mercurial."""
+"""Simple wrapper around Git and Mercurial.
+
+Root, branch and tracked files are read from the repository's metadata files
+where possible, rather than by running `git` or `hg`; the SHA comes from
+`git rev-parse --short` or `hg identify`. All are remembered.
+"""
 
 from __future__ import absolute_import, print_function
 
 import os
+import stat
+import struct
 import subprocess
 
 from .process import run_command
 
 
+# find_vcs results, by directory; and VCS instances, by (class, root)
+_vcs_by_dir = {}
+_vcs_by_root = {}
+
+
+def clear_vcs_cache():
+    """Forget all remembered repositories and their metadata."""
+    _vcs_by_dir.clear()
+    _vcs_by_root.clear()
+
+
+def find_upwards(dir, name):
+    """The nearest of `dir` and its ancestors that contains `name`, or None."""
+    dir = os.path.abspath(dir)
+    while True:
+        if os.path.exists(os.path.join(dir, name)):
+            return dir
+        parent = os.path.dirname(dir)
+        if parent == dir:
+            return None
+        dir = parent
+
+
+def read_file(filename, mode='r'):
+    try:
+        with open(filename, mode) as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
 class VCS(object):
     def __init__(self, root):
         self.root = root
+        self._memo = {}
 
     def __repr__(self):
         return "<%s root=%r>" % (self.__class__.__name__, self.root)
@@ -26,29 +65,63 @@ class VCS(object):
     def command(self, params, one_liner=True, *args, **kwargs):
         return self.run_cmd(params, cwd=self.root, one_liner=one_liner, *args, **kwargs)
 
+    def memoize(self, key, func):
+        if key not in self._memo:
+            self._memo[key] = func()
+        return self._memo[key]
+
 
 class Git(VCS):
     Executable = ["git"]
 
     @classmethod
     def find_root(cls, dir):
+        if not os.getenv("GIT_DIR"):
+            return find_upwards(dir, ".git")
         try:
             relroot = cls.run_cmd(params=["rev-parse", "--show-cdup"], cwd=dir)
             return os.path.normpath(os.path.join(dir, relroot.strip() or "."))
         except (subprocess.CalledProcessError, OSError):
             return None
 
+    @property
+    def git_dir(self):
+        """The repository directory: `.git`, or where a `.git` file points (worktrees, submodules)."""
+        def find():
+            git_dir = os.path.join(self.root, ".git")
+            if os.path.isfile(git_dir):
+                content = read_file(git_dir) or ""
+                if content.startswith("gitdir:"):
+                    git_dir = os.path.join(self.root, content[len("gitdir:"):].strip())
+            return os.path.normpath(git_dir)
+        return self.memoize("git_dir", find)
+
+    def head_ref(self):
+        """What HEAD points to, e.g. 'refs/heads/master', or None if detached."""
+        content = (read_file(os.path.join(self.git_dir, "HEAD")) or "").strip()
+        return content[len("ref:"):].strip() if content.startswith("ref:") else None
+
     def checkout(self, branch):
+        self._memo.clear()
         return self.command(["checkout", branch])
 
     def sha(self):
-        return self.command(["rev-parse", "--short", "HEAD"])
+        # git picks the abbreviation's length (core.abbrev, repo size, ambiguity)
+        return self.memoize("sha", lambda: self.command(["rev-parse", "--short", "HEAD"]))
 
     def revision(self):
-        return int(self.command(["rev-list", "--count", "HEAD"]))
+        return self.memoize("revision", lambda: int(self.command(["rev-list", "--count", "HEAD"])))
 
     def current_branch(self):
-        return self.command(["rev-parse", "--abbrev-ref", "HEAD"])
+        def find():
+            if os.path.exists(os.path.join(self.git_dir, "HEAD")):
+                ref = self.head_ref()
+                if ref is None:
+                    return "HEAD"  # detached, as `git rev-parse --abbrev-ref HEAD` says
+                if ref.startswith("refs/heads/"):
+                    return ref[len("refs/heads/"):]
+            return self.command(["rev-parse", "--abbrev-ref", "HEAD"])
+        return self.memoize("current_branch", find)
 
     def branch_exists(self, branch):
         try:
@@ -56,36 +129,105 @@ class Git(VCS):
         except subprocess.CalledProcessError:
             return False
 
+    def tracked_files(self):
+        """Sorted paths, relative to the root with '/' separators, of the
+        files in the index (submodules excluded)."""
+        try:
+            return read_git_index(os.path.join(self.git_dir, "index"))
+        except (IOError, OSError, ValueError):
+            output = self.command(["ls-files", "-z"], one_liner=False)
+            return sorted(set(path for line in output for path in line.split("\0") if path))
+
 
 class Mercurial(VCS):
     Executable = ["hg"]
 
     @classmethod
     def find_root(cls, dir):
-        try:
-            return cls.run_cmd(["root"], cwd=dir).strip()
-        except (subprocess.CalledProcessError, OSError):
-            return None
+        return find_upwards(dir, ".hg")
 
     def checkout(self, branch):
         raise NotImplementedError("checkout")
 
     def sha(self):
-        return self.command(["identify", "--id"])
+        """Short ID of the working directory's parent, with a '+' for uncommitted changes."""
+        return self.memoize("sha", lambda: self.command(["identify", "--id"]))
 
     def revision(self):
-        return int(self.command(["identify", "--num"]))
+        return self.memoize("revision", lambda: int(self.command(["identify", "--num"])))
 
     def current_branch(self):
-        return self.command(["branch"])
+        def find():
+            if os.path.isdir(os.path.join(self.root, ".hg")):
+                branch = read_file(os.path.join(self.root, ".hg", "branch"))
+                return branch.strip() if branch and branch.strip() else "default"
+            return self.command(["branch"])
+        return self.memoize("current_branch", find)
 
     def branch_exists(self, branch):
         raise NotImplementedError("branch_exists")
 
+    def tracked_files(self):
+        """Sorted paths, relative to the root, of the files in the working directory's parent."""
+        return sorted(self.command(["manifest"], one_liner=False))
+
+
+def read_git_index(filename):
+    """Sorted paths of the stage-0 or conflicted files in a Git index (versions 2-4).
+
+    Raises ValueError for anything it can't read, such as a sparse index.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    signature, version, count = struct.unpack('>4sLL', data[:12])
+    if signature != b'DIRC' or version not in (2, 3, 4):
+        raise ValueError("{}: unsupported index (version {})".format(filename, version))
+    paths = set()
+    offset, name = 12, b''
+    for _ in range(count):
+        start = offset
+        mode, = struct.unpack('>L', data[offset + 24:offset + 28])
+        flags, = struct.unpack('>H', data[offset + 60:offset + 62])
+        offset += 62
+        if flags & 0x4000:  # extended flags
+            offset += 2
+        if version == 4:
+            # Name is the previous name, less some trailing bytes, plus a suffix
+            strip, offset = _read_offset_varint(data, offset)
+            end = data.index(b'\0', offset)
+            name = name[:len(name) - strip] + data[offset:end]
+            offset = end + 1
+        else:
+            end = data.index(b'\0', offset)
+            name = data[offset:end]
+            offset = start + ((end - start + 8) & ~7)  # NUL-padded to a multiple of 8
+        if stat.S_ISDIR(mode):
+            raise ValueError("{}: sparse index".format(filename))
+        if stat.S_IFMT(mode) != 0o160000:  # not a submodule
+            paths.add(name.decode('utf-8'))
+    return sorted(paths)
+
+
+def _read_offset_varint(data, offset):
+    """Git's "offset" varint encoding."""
+    c = bytearray(data[offset:offset + 1])[0]
+    offset += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = bytearray(data[offset:offset + 1])[0]
+        offset += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, offset
+
 
 def find_vcs(dir):
-    for vcs in (Git, Mercurial):
-        root = vcs.find_root(dir)
-        if root:
-            return vcs(root)
-    return None
+    """The Git or Mercurial repository containing `dir`, or None. Remembered per directory and root."""
+    dir = os.path.abspath(dir)
+    if dir not in _vcs_by_dir:
+        _vcs_by_dir[dir] = None
+        for vcs in (Git, Mercurial):
+            root = vcs.find_root(dir)
+            if root:
+                _vcs_by_dir[dir] = _vcs_by_root.setdefault((vcs, root), vcs(root))
+                break
+    return _vcs_by_dir[dir]
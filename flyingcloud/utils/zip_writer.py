@@ -0,0 +1,554 @@
+# -*- coding: utf-8 -*-
+
+"""Zip archive writer that deflates entries on a thread pool.
+
+zlib releases the GIL while compressing, so threads use all cores.
+Entries are written to the archive in the order they were added,
+so the output is the same as writing them serially.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import concurrent.futures
+import hashlib
+import multiprocessing
+import os
+import re
+import stat
+import struct
+import threading
+import time
+import zipfile
+import zlib
+
+import six
+
+from .build_context import glob_to_regex
+
+ZIP64_LIMIT = (1 << 31) - 1  # Same conservative limit as zipfile
+ZIP_FILECOUNT_LIMIT = (1 << 16) - 1
+ZIP_MAX = 0xFFFFFFFF
+DEFAULT_COMPRESSION_LEVEL = 6
+STREAMING_CHUNK_SIZE = (1 << 20)
+
+LocalFileHeader = struct.Struct('<4s2B4HL2L2H')
+CentralDirHeader = struct.Struct('<4s4B4HL2L5H2L')
+EndOfCentralDir = struct.Struct('<4s4H2LH')
+EndOfCentralDir64 = struct.Struct('<4sQ2H2L4Q')
+EndOfCentralDir64Locator = struct.Struct('<4sLQL')
+
+
+def check_compress_type(compress_type):
+    """`compress_type`, if `ParallelZipWriter` can write it; else ValueError."""
+    if compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        raise ValueError("Unsupported compression method {!r}: use ZIP_STORED or ZIP_DEFLATED".format(
+            compress_type))
+    return compress_type
+
+
+def check_level(level):
+    if level is not None and not 0 <= level <= 9:
+        raise ValueError("Compression level must be 0-9: {!r}".format(level))
+    return level
+
+
+def deflate(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def normalized_mode(mode):
+    """0755 for directories and executables, 0644 for everything else."""
+    file_type = stat.S_IFMT(mode)
+    return file_type | (0o755 if stat.S_ISDIR(mode) or mode & 0o111 else 0o644)
+
+
+def dos_date_time(date_time):
+    """(date, time) in MS-DOS format, which has a resolution of two seconds."""
+    dt = date_time
+    return ((dt[0] - 1980) << 9 | dt[1] << 5 | dt[2],
+            dt[3] << 11 | dt[4] << 5 | (dt[5] // 2))
+
+
+class CompressionPolicy(object):
+    """How to compress each file, chosen by its name and size.
+
+    `levels` is a list of (glob, level) pairs, where the first glob that
+    matches the name decides the deflate level; level 0 means store.
+    A glob without a '/' matches at any depth. Otherwise, files in
+    `StoredExtensions` (already compressed) are stored, and other files
+    of at least `sample_min_size` bytes whose type isn't known to compress
+    well are sample-tested: unless deflating their first `sample_size`
+    bytes saves at least `min_saving` of them, they're stored.
+    Any entry that deflate would make bigger is stored as well.
+    """
+    StoredExtensions = frozenset([
+        '.7z', '.bz2', '.egg', '.gif', '.gz', '.jar', '.jpeg', '.jpg', '.lz4', '.mp3',
+        '.mp4', '.png', '.tbz2', '.tgz', '.txz', '.war', '.webm', '.webp', '.whl',
+        '.woff', '.woff2', '.xz', '.zip', '.zst',
+    ])
+    CompressibleExtensions = frozenset([
+        '.cfg', '.conf', '.css', '.csv', '.html', '.ini', '.js', '.json', '.map',
+        '.md', '.po', '.py', '.rst', '.sh', '.sql', '.svg', '.txt', '.xml', '.yaml', '.yml',
+    ])
+
+    def __init__(
+            self, level=DEFAULT_COMPRESSION_LEVEL, levels=(), stored_extensions=None,
+            sample_min_size=256 << 10, sample_size=64 << 10, min_saving=0.1):
+        self.level = check_level(level)
+        self.levels = []
+        for pattern, pattern_level in levels:
+            check_level(pattern_level)
+            regex = glob_to_regex(pattern.lstrip('/'))
+            if '/' not in pattern:
+                regex = '^(?:.*/)?' + regex[1:]
+            self.levels.append((re.compile(regex), pattern_level))
+        self.stored_extensions = self.StoredExtensions if stored_extensions is None \
+            else frozenset(stored_extensions)
+        self.sample_min_size = sample_min_size
+        self.sample_size = sample_size
+        self.min_saving = min_saving
+
+    def choose(self, arcname, size):
+        """(compress_type, level, sample) for a file: `sample` says whether
+        to check that its contents compress before deflating them."""
+        for regex, level in self.levels:
+            if regex.match(arcname):
+                return (zipfile.ZIP_DEFLATED, level, False) if level else (zipfile.ZIP_STORED, None, False)
+        extension = os.path.splitext(arcname)[1].lower()
+        if extension in self.stored_extensions or not self.level:
+            return zipfile.ZIP_STORED, None, False
+        sample = (self.sample_min_size is not None and size >= self.sample_min_size
+                  and extension not in self.CompressibleExtensions)
+        return zipfile.ZIP_DEFLATED, self.level, sample
+
+    def compressible(self, data):
+        sample = data[:self.sample_size]
+        return len(deflate(sample, 1)) <= len(sample) * (1 - self.min_saving)
+
+
+class ArchiveEntries(object):
+    """Compressed members of an existing zip, for `ParallelZipWriter` to copy
+    without recompressing them."""
+    def __init__(self, filename):
+        self.filename = filename
+        with zipfile.ZipFile(filename) as zf:
+            self.infos = dict((info.filename, info) for info in zf.infolist()
+                              if not info.flag_bits & 0x1)  # not encrypted
+        self.fp = open(filename, 'rb')
+        self.mtime = os.fstat(self.fp.fileno()).st_mtime
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.infos)
+
+    def close(self):
+        self.fp.close()
+
+    def get(self, arcname, file_size, compress_type):
+        """The entry for `arcname`, if it could hold the same content.
+
+        A stored entry may stand in for a deflated one, since
+        incompressible files end up stored.
+        """
+        info = self.infos.get(arcname)
+        if info and info.file_size == file_size and (
+                info.compress_type == compress_type or info.compress_type == zipfile.ZIP_STORED):
+            return info
+        return None
+
+    def unchanged(self, info, st):
+        """Whether the file whose stat is `st` can be assumed unchanged since `info` was written.
+
+        Zip timestamps have a two-second resolution, so a file modified
+        around when the archive was written is not trusted: its CRC must be checked.
+        """
+        return (st.st_mtime < self.mtime - 2
+                and dos_date_time(info.date_time) == dos_date_time(time.localtime(st.st_mtime)[0:6]))
+
+    def _read_at(self, offset, size):
+        with self.lock:
+            self.fp.seek(offset)
+            return self.fp.read(size)
+
+    def _data_offset(self, info):
+        header = self._read_at(info.header_offset, LocalFileHeader.size)
+        if len(header) != LocalFileHeader.size or header[0:4] != b'PK\003\004':
+            raise zipfile.BadZipfile("{}: bad local header for {}".format(self.filename, info.filename))
+        name_length, extra_length = struct.unpack('<2H', header[26:30])
+        return info.header_offset + LocalFileHeader.size + name_length + extra_length
+
+    def read_raw(self, info):
+        return self._read_at(self._data_offset(info), info.compress_size)
+
+    def iter_raw(self, info, chunk_size=STREAMING_CHUNK_SIZE):
+        offset = self._data_offset(info)
+        end = offset + info.compress_size
+        while offset < end:
+            chunk = self._read_at(offset, min(chunk_size, end - offset))
+            if not chunk:
+                raise zipfile.BadZipfile("{}: {} is truncated".format(self.filename, info.filename))
+            offset += len(chunk)
+            yield chunk
+
+
+class ZipEntry(object):
+    """Metadata for one archive member, plus its payload until it is written."""
+    __slots__ = ('arcname', 'date_time', 'external_attr', 'compress_type',
+                 'CRC', 'file_size', 'compress_size', 'header_offset', 'data')
+
+    def __init__(self, arcname, date_time, external_attr, compress_type):
+        self.arcname = arcname
+        self.date_time = date_time
+        self.external_attr = external_attr
+        self.compress_type = compress_type
+        self.CRC = self.file_size = self.compress_size = self.header_offset = 0
+        self.data = None
+
+    @property
+    def filename(self):
+        return self.arcname
+
+    @property
+    def encoded_name(self):
+        try:
+            return self.arcname.encode('ascii'), 0
+        except UnicodeError:
+            return self.arcname.encode('utf-8'), 0x800
+
+    @property
+    def dos_date_time(self):
+        return dos_date_time(self.date_time)
+
+    def local_header(self, zip64):
+        name, flags = self.encoded_name
+        dosdate, dostime = self.dos_date_time
+        extra = b''
+        file_size, compress_size = self.file_size, self.compress_size
+        if zip64:
+            extra = struct.pack('<HHQQ', 1, 16, file_size, compress_size)
+            file_size = compress_size = ZIP_MAX
+        return LocalFileHeader.pack(
+            b'PK\003\004', 45 if zip64 else 20, 0, flags, self.compress_type,
+            dostime, dosdate, self.CRC, compress_size, file_size,
+            len(name), len(extra)) + name + extra
+
+    def central_dir_header(self):
+        name, flags = self.encoded_name
+        dosdate, dostime = self.dos_date_time
+        extra_data = []
+        file_size, compress_size, header_offset = self.file_size, self.compress_size, self.header_offset
+        if file_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT:
+            extra_data += [file_size, compress_size]
+            file_size = compress_size = ZIP_MAX
+        if header_offset > ZIP64_LIMIT:
+            extra_data.append(header_offset)
+            header_offset = ZIP_MAX
+        extra = b''
+        version = 20
+        if extra_data:
+            extra = struct.pack('<HH' + 'Q' * len(extra_data), 1, 8 * len(extra_data), *extra_data)
+            version = 45
+        return CentralDirHeader.pack(
+            b'PK\001\002', version, 3, version, 0, flags, self.compress_type,
+            dostime, dosdate, self.CRC, compress_size, file_size,
+            len(name), len(extra), 0, 0, 0, self.external_attr, header_offset) + name + extra
+
+
+class ParallelZipWriter(object):
+    """Write-only stand-in for `zipfile.ZipFile(filename, "w", ZIP_DEFLATED)`.
+
+    Files up to `large_file_size` are read and deflated on `max_workers` threads;
+    larger ones are streamed through the writing thread.
+    At most `max_pending_bytes` of file data is held in memory at once.
+    Each entry's CRC is computed from the same bytes that are compressed,
+    as they are read, and duplicate names are rejected as they are added,
+    so the archive needn't be re-read to check it.
+
+    Given `reuse`, an `ArchiveEntries` for a previous build of the archive,
+    files whose size and mtime (or else CRC) match their previous entry
+    are copied across still compressed.
+
+    `policy`, a `CompressionPolicy`, chooses how to compress each file
+    added without an explicit `compress_type`.
+
+    For reproducible archives, give every entry the same `date_time`
+    and `normalize_modes`; the output then depends only on the names,
+    order and contents of the entries (and the zlib version).
+    """
+    def __init__(
+            self, file, compression=zipfile.ZIP_DEFLATED, compresslevel=None,
+            max_workers=None, max_pending_bytes=256 << 20, large_file_size=32 << 20,
+            reuse=None, date_time=None, normalize_modes=False, policy=None):
+        # Before any output file or worker exists
+        check_compress_type(compression)
+        check_level(compresslevel)
+        if isinstance(file, six.string_types):
+            self.filename, self.fp, self._close_fp = file, open(file, 'wb'), True
+        else:
+            self.filename, self.fp, self._close_fp = getattr(file, 'name', None), file, False
+        self.compression = compression
+        self.policy = policy
+        if compresslevel is None:
+            compresslevel = policy.level if policy else DEFAULT_COMPRESSION_LEVEL
+        self.compresslevel = compresslevel
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        self.max_pending_bytes = max_pending_bytes
+        self.large_file_size = large_file_size
+        self.reuse = reuse
+        self.reused_count = 0
+        self.date_time = date_time and max(tuple(date_time), (1980, 1, 1, 0, 0, 0))
+        self.normalize_modes = normalize_modes
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.max_workers)
+        self.pending = collections.deque()  # (entry, future, size), in archive order
+        self.pending_bytes = 0
+        self.entries = []
+        self.arcnames = set()
+        self.offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def namelist(self):
+        return [e.arcname for e in self.entries] + [e.arcname for e, _, _ in self.pending]
+
+    def infolist(self):
+        return list(self.entries)
+
+    @classmethod
+    def arcname_for(cls, filename, arcname, isdir):
+        arcname = os.path.normpath(os.path.splitdrive(arcname or filename)[1])
+        while arcname[0] in (os.sep, os.altsep):
+            arcname = arcname[1:]
+        arcname = arcname.replace(os.sep, '/')
+        if isinstance(arcname, bytes):
+            arcname = arcname.decode('utf-8')
+        return arcname + '/' if isdir else arcname
+
+    def write(self, filename, arcname=None, compress_type=None, st=None):
+        """Add `filename`; `st` is its `os.stat` result, if the caller already has it."""
+        st = st or os.stat(filename)
+        isdir = stat.S_ISDIR(st.st_mode)
+        date_time = self.date_time or max(time.localtime(st.st_mtime)[0:6], (1980, 1, 1, 0, 0, 0))
+        mode = normalized_mode(st.st_mode) if self.normalize_modes else st.st_mode
+        external_attr = (mode & 0xFFFF) << 16
+        if isdir:
+            external_attr |= 0x10  # MS-DOS directory flag
+        level, sample = self.compresslevel, False
+        if isdir:
+            compress_type = zipfile.ZIP_STORED
+        elif compress_type is not None:
+            check_compress_type(compress_type)
+        elif self.policy:
+            compress_type, level, sample = self.policy.choose(
+                self.arcname_for(filename, arcname, isdir), st.st_size)
+        else:
+            compress_type = self.compression
+        entry = ZipEntry(self.arcname_for(filename, arcname, isdir),
+                         date_time, external_attr, compress_type)
+        self._add_name(entry.arcname)
+        previous, unchanged = None, False
+        if self.reuse is not None and not isdir:
+            previous = self.reuse.get(entry.arcname, st.st_size, compress_type)
+            unchanged = previous is not None and self.reuse.unchanged(previous, st)
+        if isdir:
+            self._submit(entry, None, 0)
+        elif st.st_size > self.large_file_size:
+            self._drain(flush=True)
+            if unchanged:
+                self._write_reused(entry, previous)
+            else:
+                self._write_streamed(entry, filename, st.st_size, level, sample)
+        else:
+            self._submit(entry, self.executor.submit(
+                self._read_and_compress, filename, compress_type, level, sample,
+                previous, unchanged), st.st_size)
+
+    def writestr(self, arcname, data, compress_type=None):
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        level, sample = self.compresslevel, False
+        if compress_type is not None:
+            check_compress_type(compress_type)
+        elif self.policy:
+            compress_type, level, sample = self.policy.choose(arcname, len(data))
+        else:
+            compress_type = self.compression
+        entry = ZipEntry(arcname, self.date_time or time.localtime(time.time())[0:6],
+                         (stat.S_IFREG | 0o644 if self.normalize_modes else 0o600) << 16,
+                         compress_type)
+        self._add_name(arcname)
+        self._submit(entry, self.executor.submit(
+            self._compress, data, compress_type, level, sample), len(data))
+
+    def content_digest(self):
+        """SHA-256 over the names, modes, sizes and CRCs of the entries so far.
+
+        Unlike a hash of the archive, this ignores timestamps and compression.
+        """
+        self._drain(flush=True)
+        digest = hashlib.sha256()
+        for entry in self.entries:
+            digest.update("{}\0{:o}\0{}\0{:08x}\n".format(
+                entry.arcname, entry.external_attr >> 16, entry.file_size, entry.CRC).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _add_name(self, arcname):
+        if arcname in self.arcnames:
+            raise ValueError("Duplicate filename found: {}".format(arcname))
+        self.arcnames.add(arcname)
+
+    def _submit(self, entry, future, size):
+        self.pending.append((entry, future, size))
+        self.pending_bytes += size
+        self._drain()
+
+    def _drain(self, flush=False):
+        """Write queued entries, in order: those already compressed, then
+        (waiting for them) as many as needed to get the queue back within bounds."""
+        while self.pending:
+            entry, future, size = self.pending[0]
+            if not (flush or future is None or future.done()
+                    or self.pending_bytes > self.max_pending_bytes
+                    or len(self.pending) > 4 * self.max_workers):
+                break
+            self.pending.popleft()
+            self.pending_bytes -= size
+            if future is not None:
+                entry.CRC, entry.file_size, entry.data, reused, entry.compress_type = future.result()
+                entry.compress_size = len(entry.data)
+                self.reused_count += reused
+            self._write_entry(entry)
+
+    def _read_and_compress(
+            self, filename, compress_type, level=None, sample=False, previous=None, unchanged=False):
+        if unchanged:
+            return (previous.CRC, previous.file_size, self.reuse.read_raw(previous), True,
+                    previous.compress_type)
+        with open(filename, 'rb') as fp:
+            data = fp.read()
+        if previous and len(data) == previous.file_size \
+                and zlib.crc32(data) & 0xFFFFFFFF == previous.CRC:
+            return (previous.CRC, previous.file_size, self.reuse.read_raw(previous), True,
+                    previous.compress_type)
+        return self._compress(data, compress_type, level, sample)
+
+    def _compress(self, data, compress_type, level=None, sample=False):
+        """(CRC, size, compressed data, reused, compress_type actually used)"""
+        crc = zlib.crc32(data) & 0xFFFFFFFF
+        if compress_type == zipfile.ZIP_DEFLATED and sample and not self.policy.compressible(data):
+            compress_type = zipfile.ZIP_STORED
+        if compress_type == zipfile.ZIP_DEFLATED:
+            compressed = deflate(data, self.compresslevel if level is None else level)
+            if self.policy and len(compressed) >= len(data):
+                return crc, len(data), data, False, zipfile.ZIP_STORED
+            return crc, len(data), compressed, False, compress_type
+        elif compress_type == zipfile.ZIP_STORED:
+            return crc, len(data), data, False, compress_type
+        raise ValueError("Unsupported compression method {!r}".format(compress_type))
+
+    def _write_entry(self, entry):
+        entry.header_offset = self.offset
+        zip64 = entry.file_size > ZIP64_LIMIT or entry.compress_size > ZIP64_LIMIT
+        header = entry.local_header(zip64)
+        self.fp.write(header)
+        self.fp.write(entry.data or b'')
+        self.offset += len(header) + entry.compress_size
+        entry.data = None
+        self.entries.append(entry)
+
+    def _write_streamed(self, entry, filename, file_size, level=None, sample=False):
+        """Compress a large file chunk by chunk, then patch its local header."""
+        if entry.compress_type == zipfile.ZIP_DEFLATED and sample:
+            with open(filename, 'rb') as fp:
+                if not self.policy.compressible(fp.read(self.policy.sample_size)):
+                    entry.compress_type = zipfile.ZIP_STORED
+        entry.header_offset = self.offset
+        entry.file_size = file_size
+        zip64 = file_size * 1.05 > ZIP64_LIMIT
+        self.fp.write(entry.local_header(zip64))
+        level = self.compresslevel if level is None else level
+        compressor = (zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+                      if entry.compress_type == zipfile.ZIP_DEFLATED else None)
+        crc, file_size, compress_size = 0, 0, 0
+        with open(filename, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(STREAMING_CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+                file_size += len(chunk)
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                compress_size += len(chunk)
+                self.fp.write(chunk)
+            if compressor:
+                chunk = compressor.flush()
+                compress_size += len(chunk)
+                self.fp.write(chunk)
+        entry.CRC, entry.file_size, entry.compress_size = crc & 0xFFFFFFFF, file_size, compress_size
+        if not zip64 and (file_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT):
+            raise zipfile.LargeZipFile("{}: file size grew while being zipped".format(filename))
+        end = self.fp.tell()
+        self.fp.seek(entry.header_offset)
+        self.fp.write(entry.local_header(zip64))
+        self.fp.seek(end)
+        self.offset = end
+        self.entries.append(entry)
+
+    def _write_reused(self, entry, previous):
+        """Copy the compressed data of an unchanged large file from the previous archive,
+        compressed as it was there (which may be stored, where deflate was asked for)."""
+        entry.CRC, entry.file_size, entry.compress_size, entry.compress_type = (
+            previous.CRC, previous.file_size, previous.compress_size, previous.compress_type)
+        entry.header_offset = self.offset
+        header = entry.local_header(entry.file_size > ZIP64_LIMIT or entry.compress_size > ZIP64_LIMIT)
+        self.fp.write(header)
+        for chunk in self.reuse.iter_raw(previous):
+            self.fp.write(chunk)
+        self.offset += len(header) + entry.compress_size
+        self.entries.append(entry)
+        self.reused_count += 1
+
+    def close(self):
+        if self.fp is None:
+            return
+        try:
+            self._drain(flush=True)
+            self._write_central_directory()
+        finally:
+            self.executor.shutdown()
+            if self._close_fp:
+                self.fp.close()
+            self.fp = None
+
+    def abort(self):
+        for _, future, _ in self.pending:
+            if future is not None:
+                future.cancel()
+        self.pending.clear()
+        self.executor.shutdown()
+        if self._close_fp and self.fp is not None:
+            self.fp.close()
+        self.fp = None
+
+    def _write_central_directory(self):
+        cd_offset = self.offset
+        for entry in self.entries:
+            self.fp.write(entry.central_dir_header())
+        cd_end = self.fp.tell()
+        cd_size = cd_end - cd_offset
+        count = len(self.entries)
+        if count > ZIP_FILECOUNT_LIMIT or cd_offset > ZIP64_LIMIT or cd_size > ZIP64_LIMIT:
+            self.fp.write(EndOfCentralDir64.pack(
+                b'PK\006\006', 44, 45, 45, 0, 0, count, count, cd_size, cd_offset))
+            self.fp.write(EndOfCentralDir64Locator.pack(b'PK\006\007', 0, cd_end, 1))
+            count = min(count, 0xFFFF)
+            cd_size = min(cd_size, ZIP_MAX)
+            cd_offset = min(cd_offset, ZIP_MAX)
+        self.fp.write(EndOfCentralDir.pack(b'PK\005\006', 0, 0, count, count, cd_size, cd_offset, 0))
+        self.fp.flush()
@@ -13,6 +13,8 @@ setup(
     packages=find_packages(exclude='tests'),
     install_requires=[
         'docker-py',
+        'futures; python_version < "3.0"',
+        'scandir; python_version < "3.5"',
         'psutil',
         'pyyaml',
         'requests!=2.12.2',
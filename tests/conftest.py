@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+
+import sys
+
+collect_ignore = []
+if sys.version_info < (3, 6):
+    # asyncio backend needs async generators
+    collect_ignore.append("unit/test_docker_async.py")
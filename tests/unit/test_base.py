@@ -2,13 +2,37 @@
 
 from __future__ import print_function, unicode_literals, absolute_import
 
+import argparse
+import json
+import logging
 import os
+import time
 import yaml
 
+import docker
+import mock
+import requests
+from mock import MagicMock
+
 # noinspection PyUnresolvedReferences
 import pytest
 
 from flyingcloud.base import DockerBuildLayer as DBL
+from flyingcloud.exceptions import DockerResultError, FlyingCloudError
+from flyingcloud.utils.trace import Tracer
+
+Registry = dict(host="quay.io", organization="org")
+
+
+def make_namespace(**kwargs):
+    """A namespace with a mock Docker client; `kwargs` are the parsed options."""
+    namespace = argparse.Namespace(docker=MagicMock(), logger=logging.getLogger(__name__))
+    namespace.__dict__.update(kwargs)
+    return namespace
+
+
+def make_layer(name="web", **kwargs):
+    return DBL("app", name, None, "help", **kwargs)
 
 
 class TestBuildLayer:
@@ -133,3 +157,318 @@ exposed_ports:
             b"""decorator 4.0.11 is already th\x01\x00\x00\x00\x00\x00 \x00e active version in easy-install.pth""")
         assert (b"Constructing docker client object with {u'version': '1.17', 'timeout': 300}", 0) == DBL.filter_stream_header(
             b"Constructing docker client object with {u'version': '1.17', 'timeout': 300}")
+
+
+class TestTeardown:
+    def test_teardown_stops_and_removes_each_container(self):
+        namespace = make_namespace(stop_timeout=1, kill_containers=False)
+        results = make_layer().docker_teardown(namespace, ["c1", "c2", "c3"])
+        assert [r.container for r in results] == ["c1", "c2", "c3"]
+        assert all(r.stopped and r.removed and r.error is None for r in results)
+        assert namespace.docker.stop.call_count == 3
+        namespace.docker.stop.assert_any_call("c2", timeout=1)
+        namespace.docker.remove_container.assert_any_call(container="c3", force=True)
+
+    def test_teardown_kill_skips_stop(self):
+        namespace = make_namespace(stop_timeout=1, kill_containers=True)
+        results = make_layer().docker_teardown(namespace, ["c1", "c2"])
+        assert not namespace.docker.stop.called
+        assert [(r.stopped, r.removed) for r in results] == [(False, True), (False, True)]
+
+    def test_teardown_escalates_and_reports_errors(self):
+        namespace = make_namespace(stop_timeout=1, kill_containers=False)
+        namespace.docker.stop.side_effect = docker.errors.DockerException("stuck")
+
+        def remove_container(container, force):
+            if container == "gone":
+                raise docker.errors.DockerException("no such container")
+        namespace.docker.remove_container.side_effect = remove_container
+
+        stuck, gone = make_layer().docker_teardown(namespace, ["stuck", "gone"])
+        assert (stuck.stopped, stuck.removed, stuck.error) == (False, True, None)
+        assert (gone.removed, str(gone.error)) == (False, "no such container")
+
+
+class TestBuildDockerfile:
+    def _namespace(self):
+        return make_namespace(pull_layer=False, push_layer=False, logged_in=True)
+
+    def test_image_id_from_aux(self):
+        namespace = self._namespace()
+        namespace.docker.build.return_value = iter([
+            b'{"stream": "Step 1/2 : FROM scratch\\n"}\r\n',
+            b'{"aux": {"ID": "sha256:abc123"}}\r\n{"stream": "Successfully built abc123\\n"}\r\n',
+        ])
+        layer = make_layer()
+        assert "sha256:abc123" == layer._build_dockerfile(namespace, "app_web:1", fileobj=None)
+
+    def test_image_id_from_legacy_stream(self):
+        namespace = self._namespace()
+        layer = make_layer()
+        assert "0123abcd" == layer.parse_build_output(
+            namespace, '{"stream": "Successfully built 0123abcd\\n"}')
+        assert layer.parse_build_output(namespace, '{"stream": "Step 2/2"}') is None
+
+    def test_build_error(self):
+        layer = make_layer()
+        with pytest.raises(DockerResultError):
+            layer.parse_build_output(self._namespace(), '{"error": "no space left on device"}')
+
+    def test_build_options(self):
+        layer = make_layer(build_args={"VERSION": 3}, build_target="runtime")
+        assert {
+            'buildargs': {"VERSION": "3"},
+            'target': "runtime",
+        } == layer.build_options(self._namespace())
+        assert {} == make_layer().build_options(self._namespace())
+
+    def test_cache_from_images(self):
+        namespace = self._namespace()
+        assert ["app_web:latest"] == make_layer().cache_from_images(namespace)
+        assert [] == make_layer(cache_from=[]).cache_from_images(namespace)
+        old_api = make_layer(cache_from=["app_base:latest"],
+                             registry_config=dict(docker_api_version="1.24"))
+        assert [] == old_api.cache_from_images(namespace)
+
+    def _dockerfile_build(self, tmpdir, layer, base_image_id="sha256:base1"):
+        namespace = self._namespace()
+        namespace.build_context_cache_dir = str(tmpdir.join("cache"))
+        namespace.docker.inspect_image.return_value = dict(Id=base_image_id)
+        namespace.docker.images.return_value = []
+        namespace.docker.build.return_value = iter([b'{"aux": {"ID": "sha256:abc123"}}'])
+        context = tmpdir.join("context")
+        context.ensure("Dockerfile").write("FROM app_base:latest\n")
+        assert "sha256:abc123" == layer.build_dockerfile(namespace, "app_web:1", str(context.join("Dockerfile")))
+        return namespace
+
+    def test_build_is_labelled_with_base_image_ids(self, tmpdir):
+        layer = make_layer(cache_from=[])
+        digests = []
+        for base_image_id in ("sha256:base1", "sha256:base1", "sha256:base2"):
+            namespace = self._dockerfile_build(tmpdir, layer, base_image_id)
+            namespace.docker.inspect_image.assert_called_with("app_base:latest")
+            digests.append(namespace.docker.build.call_args[1]['labels'][DBL.ContextDigestLabel])
+        assert digests[0] == digests[1] != digests[2]
+
+    def test_old_api_has_no_labels_or_reuse(self, tmpdir):
+        layer = make_layer(cache_from=[], registry_config=dict(docker_api_version="1.17"))
+        namespace = self._dockerfile_build(tmpdir, layer)
+        assert 'labels' not in namespace.docker.build.call_args[1]
+        assert not namespace.docker.images.called and layer.build_cache_hit is False
+
+    def test_client_without_cache_from_or_target(self):
+        class LegacyClient(object):  # docker-py 1.x
+            def build(self, path=None, tag=None, fileobj=None, custom_context=False,
+                      dockerfile=None, buildargs=None, labels=None):
+                pass
+        namespace = self._namespace()
+        namespace.docker = LegacyClient()
+        assert [] == make_layer(cache_from=["app_base:latest"]).cache_from_images(namespace)
+        with pytest.raises(FlyingCloudError) as excinfo:
+            make_layer(build_target="runtime").build_options(namespace)
+        assert "docker-py 1.x" in str(excinfo.value)
+
+    def test_target_needs_api_1_29(self):
+        layer = make_layer(build_target="runtime", registry_config=dict(docker_api_version="1.24"))
+        with pytest.raises(FlyingCloudError) as excinfo:
+            layer.build_options(self._namespace())
+        assert "Docker API 1.29" in str(excinfo.value)
+
+    def test_expose_ports_build_has_no_cache_from(self):
+        namespace = self._namespace()
+        namespace.docker.build.return_value = iter([b'{"aux": {"ID": "sha256:abc123"}}'])
+        layer = make_layer(exposed_ports=[80])
+        layer.source_image_name, layer.layer_timestamp_name = "app_base:latest", "app_web:1"
+        assert "sha256:abc123" == layer.make_expose_ports(namespace)
+        assert 'cache_from' not in namespace.docker.build.call_args[1]
+        assert not namespace.docker.pull.called
+
+
+class TestGarbageCollection:
+    Repo = "quay.io/org/app_web"
+
+    def _namespace(self, tmpdir, **kwargs):
+        namespace = make_namespace(
+            build_store_file=str(tmpdir.join("builds.sqlite")),
+            docker_tagsfile=str(tmpdir.join("docker_tags.json")),
+            gc_keep=2, gc_max_age_days=None, gc_remote=False, dry_run=True)
+        namespace.__dict__.update(kwargs)
+        day = 24 * 60 * 60
+        namespace.docker.images.return_value = [
+            dict(Id="i5", Created=time.time(), Size=500,
+                 RepoTags=[self.Repo + ":2017-01-05t000000z", self.Repo + ":latest"]),
+            dict(Id="i4", Created=time.time() - 1 * day, Size=400,
+                 RepoTags=[self.Repo + ":2017-01-04t000000z"]),
+            dict(Id="i3", Created=time.time() - 2 * day, Size=300,
+                 RepoTags=[self.Repo + ":2017-01-03t000000z-sq", "other/image:v3"]),
+            dict(Id="i2", Created=time.time() - 3 * day, Size=200,
+                 RepoTags=[self.Repo + ":2017-01-02t000000z", self.Repo + ":2017-01-02t000000z-sq"]),
+            dict(Id="i1", Created=time.time() - 4 * day, Size=100,
+                 RepoTags=[self.Repo + ":2017-01-01t000000z_fail"]),
+        ]
+        # Found both by name and by ancestor
+        namespace.docker.containers.return_value = [dict(Id="dead1", SizeRw=10)]
+        return namespace
+
+    def test_dry_run_plan(self, tmpdir):
+        namespace = self._namespace(tmpdir)
+        actions = make_layer(registry_config=Registry).do_gc(namespace)
+        assert [(a.kind, a.name, a.size) for a in actions] == [
+            ('image', self.Repo + ":2017-01-03t000000z-sq", 0),
+            ('image', self.Repo + ":2017-01-02t000000z", 0),
+            ('image', self.Repo + ":2017-01-02t000000z-sq", 200),
+            ('image', self.Repo + ":2017-01-01t000000z_fail", 100),
+            ('container', "dead1", 10),
+        ]
+        assert not namespace.docker.remove_image.called
+
+    def test_max_age_and_store_are_respected(self, tmpdir):
+        namespace = self._namespace(tmpdir, gc_max_age_days=2.5)
+        layer = make_layer(registry_config=Registry)
+        layer.build_store(namespace).record_build(
+            self.Repo, "2017-01-01t000000z", pushed=True)
+        actions = layer.do_gc(namespace)
+        assert [a.name for a in actions if a.kind == 'image'] == [
+            self.Repo + ":2017-01-02t000000z", self.Repo + ":2017-01-02t000000z-sq"]
+
+    def test_removes_in_parallel_and_reports_errors(self, tmpdir):
+        namespace = self._namespace(tmpdir, dry_run=False)
+
+        def remove_image(image, force):
+            if image.endswith("_fail"):
+                raise docker.errors.DockerException("in use")
+        namespace.docker.remove_image.side_effect = remove_image
+        with mock.patch.object(DBL, 'log_disk_usage'):
+            actions = make_layer(registry_config=Registry).do_gc(namespace)
+        assert namespace.docker.remove_image.call_count == 4
+        namespace.docker.remove_container.assert_called_once_with(container="dead1", force=True)
+        assert [a.name for a in actions if a.error] == [self.Repo + ":2017-01-01t000000z_fail"]
+
+    def test_non_timestamp_tags_are_kept(self, tmpdir):
+        namespace = self._namespace(tmpdir, gc_keep=1)
+        namespace.docker.images.return_value[1]['RepoTags'].append(self.Repo + ":stable")
+        namespace.docker.images.return_value.append(
+            dict(Id="i0", Created=0, Size=50, RepoTags=[self.Repo + ":zz-release"]))
+        actions = make_layer(registry_config=Registry).do_gc(namespace)
+        names = [a.name for a in actions if a.kind == 'image']
+        assert self.Repo + ":2017-01-05t000000z" not in names
+        assert self.Repo + ":2017-01-04t000000z" in names
+        assert not [name for name in names if name.endswith(("stable", "zz-release"))]
+
+    def test_remote_tags_age_by_their_timestamp(self, tmpdir):
+        namespace = self._namespace(tmpdir, gc_keep=0, gc_remote=True, gc_max_age_days=30)
+        tags_file = tmpdir.join("docker_tags.json")
+        tags_file.write(json.dumps({self.Repo: [
+            "2017-01-01t000000z", time.strftime("%Y-%m-%dt%H%M%Sz", time.gmtime()), "stable"]}))
+        layer = make_layer(registry_config=Registry)
+        layer.build_store(namespace)  # imports docker_tags.json now
+        actions = layer.do_gc(namespace)
+        assert [a.name for a in actions if a.kind == 'remote_tag'] == [self.Repo + ":2017-01-01t000000z"]
+
+    def test_remote_tags_removed_in_parallel(self, tmpdir):
+        namespace = self._namespace(tmpdir, gc_keep=0, gc_remote=True, gc_max_age_days=30, dry_run=False)
+        old_tags = ["2017-01-0{}t000000z".format(day) for day in range(1, 5)]
+        tmpdir.join("docker_tags.json").write(json.dumps({self.Repo: old_tags + ["stable"]}))
+        layer = make_layer(registry_config=Registry)
+        store = layer.build_store(namespace)
+        with mock.patch.object(DBL, 'registry_delete_tag') as delete_tag, \
+                mock.patch.object(DBL, 'log_disk_usage'):
+            actions = layer.do_gc(namespace)
+        assert sorted(call[0][2] for call in delete_tag.call_args_list) == old_tags
+        assert not [a for a in actions if a.error]
+        assert store.tags()[self.Repo] == ["stable"]
+
+    def test_registry_bearer_token(self, tmpdir):
+        namespace = self._namespace(tmpdir, username="robot", password="secret")
+        challenge = 'Bearer realm="https://quay.io/v2/auth",service="quay.io",scope="repository:org/app_web:{}"'
+
+        def request(method, url, headers=None, **kwargs):
+            authorization = (headers or {}).get('Authorization')
+            scope = "pull" if method == 'HEAD' else "pull,push,delete"
+            if authorization != "Bearer token-" + scope:
+                return MagicMock(status_code=401, headers={'WWW-Authenticate': challenge.format(scope)})
+            return MagicMock(status_code=202 if method == 'DELETE' else 200,
+                             headers={'Docker-Content-Digest': "sha256:" + url.rpartition('/')[2]})
+
+        def get(url, auth, params):
+            assert (url, auth, params['service']) == ("https://quay.io/v2/auth", ("robot", "secret"), "quay.io")
+            return MagicMock(json=lambda: dict(token="token-" + params['scope'].rpartition(':')[2]))
+
+        with mock.patch('requests.request', side_effect=request) as request_mock, \
+                mock.patch('requests.get', side_effect=get) as get_mock:
+            make_layer(registry_config=Registry).registry_delete_tag(namespace, self.Repo, "2017-01-01t000000z")
+        assert get_mock.call_count == 2  # one token for pulls, reused; one for the delete
+        assert request_mock.call_args_list[-1][0] == (
+            'DELETE', "https://quay.io/v2/org/app_web/manifests/sha256:2017-01-01t000000z")
+
+
+class TestSaltHighstate:
+    def test_states_split_across_chunks(self, tmpdir):
+        namespace = make_namespace(
+            env_vars=None, timeout=None, use_docker_machine=False,
+            commit_failed_builds=False, push_layer=False, docker_clients=MagicMock())
+        client = namespace.docker_clients.get.return_value
+        client.exec_start.return_value = iter([
+            b"          ID: nginx\n    Function: pkg.inst",
+            b"alled\n      Result: True\n    Durat",
+            b"ion: 1500.0 ms\n\nSucceeded: 1\nFailed:    0\n",
+        ])
+        client.exec_inspect.return_value = dict(ExitCode=0)
+        layer = make_layer()
+        with mock.patch.object(DBL, 'salt_states_exist', return_value=True), \
+                mock.patch.object(DBL, 'docker_create_container', return_value="c1"), \
+                mock.patch.object(DBL, 'docker_start'), mock.patch.object(DBL, 'post_build'), \
+                mock.patch.object(DBL, 'docker_commit'), mock.patch.object(DBL, 'docker_teardown'):
+            layer.salt_highstate(namespace, "app_web", "app_base:latest", "app_web:1", str(tmpdir))
+        assert layer.salt_states == [("nginx", "pkg.installed", "True", 1.5)]
+
+
+class TestBuildHistory:
+    def test_record_build_and_report(self, tmpdir, capsys):
+        namespace = make_namespace(
+            tracer=Tracer(),
+            build_store_file=str(tmpdir.join("builds.sqlite")),
+            docker_tagsfile=str(tmpdir.join("docker_tags.json")),
+            report_runs=20, report_window=10, report_threshold=0.5,
+            report_json=str(tmpdir.join("report.json")))
+        namespace.docker.inspect_image.return_value = dict(Id="sha256:1", Size=123000000)
+        layer = make_layer(registry_config=Registry)
+        other = make_layer("db", registry_config=Registry)
+        namespace.layer_dict = dict(web=layer, db=other)
+
+        with layer.trace(namespace, "highstate"):
+            pass
+        with other.trace(namespace, "push"):
+            pass
+        layer.build_start_time, layer.build_cache_hit = time.time() - 42, True
+        layer.salt_states = [("nginx", "pkg.installed", "True", 1.5)]
+        build_id = layer.record_build(namespace, "quay.io/org/app_web:2017-01-01t000000z", 'success')
+        layer.build_store(namespace).record_build(
+            "quay.io/org/app_cache", "2016-12-31t000000z", duration=30, layer="cache")
+
+        store = layer.build_store(namespace)
+        build = store.build_history("quay.io/org/app_web")[0]
+        assert (build['layer'], build['image_size'], build['cache_hit']) == ("web", 123000000, 1)
+        assert list(store.phase_durations([build_id])[build_id]) == ["highstate"]
+        assert store.state_durations([build_id])[build_id] == {("nginx", "pkg.installed"): 1.5}
+
+        reports = layer.do_report(namespace)
+        assert [(r['layer'], r['summary']['runs'], r['configured']) for r in reports] == [
+            ("web", 1, True), ("db", 0, True), ("cache", 1, False)]
+        out = capsys.readouterr().out
+        assert "cache (not configured)" in out
+        assert "web: runs" in out and "123 MB" in out and "hit" in out
+        assert tmpdir.join("report.json").check()
+
+    def test_failed_build_recorded_when_daemon_is_gone(self, tmpdir):
+        namespace = make_namespace(
+            tracer=Tracer(),
+            build_store_file=str(tmpdir.join("builds.sqlite")),
+            docker_tagsfile=str(tmpdir.join("docker_tags.json")))
+        namespace.docker.inspect_image.side_effect = requests.exceptions.ConnectionError("daemon gone")
+        layer = make_layer()
+        layer.build_start_time = time.time()
+        layer.record_build(namespace, "app_web:2017-01-01t000000z", 'failed')
+        builds = layer.build_store(namespace).build_history("app_web")
+        assert [(b['tag'], b['status'], b['image_id']) for b in builds] == [
+            ("2017-01-01t000000z", 'failed', None)]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import json
+
+import pytest
+
+from flyingcloud.utils.benchmark import (
+    Measure, Skip, run_benchmark, summarize, compare, report, load_report, format_table)
+
+
+class TestBenchmark:
+    def test_run_benchmark(self):
+        calls = []
+
+        def benchmark(size):
+            return Measure(run=lambda: calls.append(size), work=size, unit="MB",
+                           teardown=lambda: calls.append("teardown"))
+        result = run_benchmark("stream/text", benchmark, repeat=3, warmup=2, args=(8,))
+        assert calls == [8] * 5 + ["teardown"]
+        assert result["repeat"] == 3 and len(result["times"]) == 3
+        assert result["min"] <= result["median"] and result["work"] == 8
+        assert result["throughput"] == 8 / result["median"]
+
+    def test_skip(self):
+        def benchmark():
+            raise Skip("needs docker-py 1.x")
+        assert run_benchmark("exec/stream", benchmark) == dict(
+            name="exec/stream", params={}, skipped="needs docker-py 1.x")
+
+    def test_summarize(self):
+        result = summarize("zip", [3.0, 1.0, 2.0, 6.0])
+        assert result["median"] == 2.5 and result["mean"] == 3.0 and result["min"] == 1.0
+        assert "throughput" not in result
+
+    def test_compare(self, tmpdir):
+        baseline = [summarize("a", [1.0]), summarize("b", [1.0]), dict(name="c", skipped="no git")]
+        current = [summarize("a", [1.05]), summarize("b", [1.5]), summarize("c", [1.0]),
+                   summarize("d", [1.0])]
+        filename = str(tmpdir.join("baseline.json"))
+        with open(filename, "w") as fp:
+            json.dump(report(baseline), fp)
+        comparisons = compare(current, load_report(filename)["results"], threshold=0.1)
+        assert [(c["name"], c["regressed"]) for c in comparisons] == [("a", False), ("b", True)]
+        assert comparisons[1]["change"] == pytest.approx(0.5)
+
+        table = format_table(current + [dict(name="e", skipped="no git")], comparisons)
+        assert "+50.0%  REGRESSED" in table and "skipped: no git" in table
+
+    def test_load_report_rejects_other_files(self, tmpdir):
+        filename = tmpdir.join("other.json")
+        filename.write("{}")
+        with pytest.raises(ValueError):
+            load_report(str(filename))
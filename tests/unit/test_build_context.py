@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import tarfile
+
+import pytest
+
+from flyingcloud.utils.build_context import (
+    DockerIgnore, build_context_files, make_build_context, dockerfile_base_images)
+
+
+class TestDockerIgnore:
+    def test_patterns(self):
+        ignore = DockerIgnore([
+            "# comment",
+            "",
+            "*.log",
+            "build/",
+            "**/*.pyc",
+            "docs/*.md",
+            "!docs/README.md",
+        ])
+        assert ignore.excluded("flyingcloud.log")
+        assert not ignore.excluded("logs/flyingcloud.log")
+        assert ignore.excluded("build")
+        assert ignore.excluded("build/lib/foo.py")
+        assert ignore.excluded("foo.pyc")
+        assert ignore.excluded("app/tests/foo.pyc")
+        assert ignore.excluded("docs/usage.md")
+        assert not ignore.excluded("docs/README.md")
+        assert not ignore.excluded("Dockerfile")
+        assert ignore.has_exceptions
+
+    def test_empty(self):
+        ignore = DockerIgnore()
+        assert len(ignore) == 0
+        assert not ignore.excluded("anything")
+
+
+class TestBuildContext:
+    def _make_tree(self, tmpdir):
+        tmpdir.join("Dockerfile").write("FROM scratch\n")
+        tmpdir.join(".dockerignore").write("*.log\nnode_modules\nDockerfile\n")
+        tmpdir.join("app.log").write("noise")
+        tmpdir.mkdir("node_modules").join("huge.js").write("x" * 1000)
+        tmpdir.mkdir("files").join("motd").write("hello")
+        return str(tmpdir)
+
+    def test_build_context_files(self, tmpdir):
+        context_dir = self._make_tree(tmpdir)
+        # Dockerfile and .dockerignore are always sent, as Docker does
+        assert build_context_files(context_dir, always_include=["Dockerfile"]) == [
+            ".dockerignore", "Dockerfile", "files", "files/motd"]
+
+    def test_make_build_context_is_cached_by_content(self, tmpdir):
+        context_dir = self._make_tree(tmpdir.mkdir("context"))
+        cache_dir = str(tmpdir.join("cache"))
+        dockerfile = os.path.join(context_dir, "Dockerfile")
+
+        tar1, digest1 = make_build_context(context_dir, dockerfile, cache_dir, "app_sysbase")
+        with tarfile.open(tar1) as tar:
+            assert sorted(tar.getnames()) == [".dockerignore", "Dockerfile", "files", "files/motd"]
+        mtime = os.path.getmtime(tar1)
+
+        # Changes to ignored files don't change the context
+        tmpdir.join("context", "app.log").write("more noise")
+        tar2, digest2 = make_build_context(context_dir, dockerfile, cache_dir, "app_sysbase")
+        assert (tar2, digest2) == (tar1, digest1)
+        assert os.path.getmtime(tar2) == mtime
+
+        tmpdir.join("context", "files", "motd").write("goodbye")
+        tar3, digest3 = make_build_context(context_dir, dockerfile, cache_dir, "app_sysbase")
+        assert digest3 != digest1
+        assert os.listdir(cache_dir) == [os.path.basename(tar3)]
+
+    def test_dockerfile_base_images(self, tmpdir):
+        dockerfile = tmpdir.join("Dockerfile")
+        dockerfile.write(
+            "ARG BASE=python:3\n"
+            "FROM --platform=linux/amd64 golang:1.9 AS build\n"
+            "RUN make\n"
+            "from $BASE\n"
+            "COPY --from=build /app /app\n"
+            "FROM build as test\n"
+            "FROM scratch\n")
+        assert dockerfile_base_images(str(dockerfile)) == ["golang:1.9", "$BASE"]
+
+    def test_dockerfile_outside_context(self, tmpdir):
+        context_dir = self._make_tree(tmpdir.mkdir("context"))
+        with pytest.raises(ValueError):
+            make_build_context(
+                os.path.join(context_dir, "files"), os.path.join(context_dir, "Dockerfile"),
+                str(tmpdir.join("cache")), "app_sysbase")
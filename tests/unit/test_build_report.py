@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import pytest
+
+from flyingcloud.utils.build_report import (
+    parse_salt_states, percentile, compare_with_baseline, layer_report, format_report,
+    format_duration, sparkline)
+from flyingcloud.utils.build_store import BuildStore
+
+SaltOutput = """local:
+----------
+          ID: nginx
+    Function: pkg.installed
+      Result: True
+     Comment: The following packages were installed/updated: nginx
+     Started: 12:00:00.123456
+    Duration: 12345.6 ms
+     Changes:
+              ----------
+              nginx:
+                  ----------
+                  Duration:
+                      1 ms
+----------
+          ID: /etc/nginx/nginx.conf
+    Function: file.managed
+      Result: False
+     Comment: Source file salt://nginx/nginx.conf not found
+     Started: 12:00:12.500000
+    Duration: 8.5 ms
+     Changes:
+  Name: /etc/hosts - Function: file.managed - Result: Clean - Started: 12:00:12.600000 - Duration: 1.5 ms
+
+Summary for local
+------------
+Succeeded: 2 (changed=1)
+Failed:    1
+------------
+Total states run:     3
+Total run time:  12.356 s
+"""
+
+
+class TestBuildReport:
+    def test_parse_salt_states(self):
+        assert parse_salt_states(SaltOutput) == [
+            ("nginx", "pkg.installed", "True", pytest.approx(12.3456)),
+            ("/etc/nginx/nginx.conf", "file.managed", "False", pytest.approx(0.0085)),
+            ("/etc/hosts", "file.managed", "Clean", pytest.approx(0.0015)),
+        ]
+        assert parse_salt_states("local:\n    Data failed to compile:\n") == []
+        assert parse_salt_states(None) == []
+
+    def test_percentile_and_baseline(self):
+        assert percentile([], 0.5) is None
+        assert percentile([4, 1, 3, 2], 0.5) == 2.5
+        assert percentile(range(1, 21), 0.95) == pytest.approx(19.05)
+        assert compare_with_baseline(100, [60, 62], 0.5, 5) is None  # too few runs
+        assert compare_with_baseline(100, [60, 62, 58], 0.5, 5) == dict(
+            baseline=60, change=pytest.approx(2 / 3), regressed=True)
+        assert not compare_with_baseline(80, [60, 62, 58], 0.5, 5)['regressed']
+        assert not compare_with_baseline(3, [1, 1, 1], 0.5, 5)['regressed']  # only 2s slower
+
+    def test_layer_report(self, tmpdir):
+        store = BuildStore(str(tmpdir.join("builds.sqlite")))
+        repo = "quay.io/org/app_web"
+        for i, duration in enumerate([60, 62, 58, 61, 30, 150]):
+            store.record_build(
+                repo, "t{}".format(i), duration=duration, layer="web",
+                status='failed' if i == 3 else 'success',
+                cache_hit=i == 4,  # a cache hit is only compared with other hits
+                phases=dict(highstate=duration - 10, push=10),
+                states=[("nginx", "pkg.installed", "True", 20 if i == 5 else 2)])
+
+        report = layer_report(store, repo, runs=5, window=10, threshold=0.5, min_delta=5)
+        assert report['layer'] == "web" and [b['tag'] for b in report['runs']] == [
+            "t1", "t2", "t3", "t4", "t5"]
+        assert [b['regressed'] for b in report['runs']] == [False, False, False, False, True]
+        assert report['runs'][-1]['baseline'] == 60
+        assert report['runs'][1]['change'] is None  # the third build has no baseline yet
+        assert report['summary'] == dict(runs=4, last=150, median=60, p95=pytest.approx(136.8))
+        phases = dict((p['name'], p) for p in report['phases'])
+        assert phases['highstate']['regressed'] and phases['highstate']['median'] == 49
+        assert not phases['push']['regressed']
+        assert [(s['name'], s['regressed']) for s in report['states']] == [
+            (("nginx", "pkg.installed"), True)]
+
+        text = format_report([report], detail=repo)
+        assert "+150% REGRESSED" in text
+        assert "web: salt states of the latest run" in text and "nginx (pkg.installed)" in text
+        assert "web: runs" not in format_report([report])
+
+    def test_empty_history(self, tmpdir):
+        store = BuildStore(str(tmpdir.join("builds.sqlite")))
+        report = layer_report(store, "quay.io/org/app_web")
+        assert report['runs'] == [] and report['summary']['median'] is None
+        assert "app_web" in format_report([report], detail="quay.io/org/app_web")
+
+    def test_formatting(self):
+        assert [format_duration(s) for s in (None, 12.34, 185, 3725)] == ["-", "12.3s", "3m05s", "1h02m"]
+        assert sparkline([10, 20, 15, None, 10]) == "_#-_"
+        assert sparkline([5, 5]) == "__"
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import json
+import sqlite3
+import threading
+import time
+
+from flyingcloud.utils.build_store import BuildStore
+
+
+class TestBuildStore:
+    def test_latest_tag_and_successful_build(self, tmpdir):
+        store = BuildStore(str(tmpdir.join("builds.sqlite")))
+        assert store.is_empty()
+        assert store.latest_tag("quay.io/org/app_web") is None
+
+        store.record_build("quay.io/org/app_web", "2017-01-02t000000z", image_id="sha256:2",
+                           duration=12.5, pushed=True)
+        store.record_build("quay.io/org/app_web", "2017-01-01t000000z", image_id="sha256:1",
+                           pushed=True)
+        store.record_build("quay.io/org/app_web", "2017-01-03t000000z", status='failed')
+        store.record_build("quay.io/org/app_db", "2017-01-04t000000z", pushed=True)
+
+        assert not store.is_empty()
+        assert store.latest_tag("quay.io/org/app_web") == "2017-01-02t000000z"
+        build = store.latest_successful_build("quay.io/org/app_web")
+        assert (build['tag'], build['image_id'], build['status']) == (
+            "2017-01-01t000000z", "sha256:1", "success")
+        assert store.latest_successful_build("quay.io/org/nothing") is None
+
+    def test_legacy_json_round_trip(self, tmpdir):
+        legacy = {"quay.io/org/app_web": ["2017-01-01t000000z", "2017-01-02t000000z"]}
+        tags_file = tmpdir.join("docker_tags.json")
+        tags_file.write(json.dumps(legacy))
+
+        store = BuildStore(str(tmpdir.join("builds.sqlite")))
+        store.import_tags_json(str(tags_file))
+        store.record_build("quay.io/org/app_web", "2017-01-03t000000z", pushed=True)
+        store.record_build("quay.io/org/app_web", "2017-01-04t000000z", pushed=False)
+        store.export_tags_json(str(tags_file))
+
+        assert json.loads(tags_file.read()) == {
+            "quay.io/org/app_web": ["2017-01-01t000000z", "2017-01-02t000000z", "2017-01-03t000000z"]}
+        assert tmpdir.listdir(lambda p: p.ext == ".tmp") == []
+
+    def test_concurrent_writers_lose_nothing(self, tmpdir):
+        filename = str(tmpdir.join("builds.sqlite"))
+        BuildStore(filename).close()
+
+        def build(n):
+            store = BuildStore(filename)  # one connection per writer, as in separate processes
+            for i in range(20):
+                store.record_build("app_{}".format(n), "tag-{:02d}".format(i), pushed=True)
+            store.close()
+
+        threads = [threading.Thread(target=build, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        tags = BuildStore(filename).tags()
+        assert sorted(tags) == ["app_0", "app_1", "app_2", "app_3"]
+        assert all(len(t) == 20 for t in tags.values())
+
+    def test_phases_and_states(self, tmpdir):
+        store = BuildStore(str(tmpdir.join("builds.sqlite")))
+        first = store.record_build(
+            "quay.io/org/app_web", "t1", duration=60.0, layer="web", image_size=1000, cache_hit=True,
+            source_sha="abc1234", phases=dict(highstate=40.0, push=10.0),
+            states=[("nginx", "pkg.installed", "True", 12.5), ("nginx", "pkg.installed", "True", 13.0)])
+        second = store.record_build("quay.io/org/app_web", "t2", duration=30.0, phases=dict(highstate=20.0))
+        store.record_build("quay.io/org/app_web", "t3")  # no duration
+
+        history = store.build_history("quay.io/org/app_web")
+        assert [b['id'] for b in history] == [first, second]
+        assert (history[0]['layer'], history[0]['image_size'], history[0]['cache_hit'],
+                history[0]['source_sha']) == ("web", 1000, 1, "abc1234")
+        assert [b['id'] for b in store.build_history("quay.io/org/app_web", limit=1)] == [second]
+        assert store.history_repos() == [("quay.io/org/app_web", "web")]
+        assert store.phase_durations([first, second, 99]) == {
+            first: dict(highstate=40.0, push=10.0), second: dict(highstate=20.0), 99: {}}
+        assert store.state_durations([first, second]) == {
+            first: {("nginx", "pkg.installed"): 13.0}, second: {}}
+
+    def test_adds_columns_to_old_stores(self, tmpdir):
+        filename = str(tmpdir.join("builds.sqlite"))
+        conn = sqlite3.connect(filename)
+        conn.execute(
+            "CREATE TABLE builds (id INTEGER PRIMARY KEY AUTOINCREMENT, repo TEXT NOT NULL,"
+            " tag TEXT, image_id TEXT, digest TEXT, input_hash TEXT, duration REAL,"
+            " status TEXT NOT NULL, pushed INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL)")
+        conn.execute("INSERT INTO builds (repo, tag, duration, status, created_at)"
+                     " VALUES ('app_web', 't0', 5.0, 'success', 0)")
+        conn.commit()
+        conn.close()
+
+        store = BuildStore(filename)
+        store.record_build("app_web", "t1", duration=6.0, cache_hit=False)
+        assert [(b['tag'], b['cache_hit']) for b in store.build_history("app_web")] == [
+            ("t0", None), ("t1", 0)]
+        BuildStore(filename).close()  # already migrated
+
+    def test_concurrent_first_runs_import_once(self, tmpdir):
+        tags_file = tmpdir.join("docker_tags.json")
+        tags_file.write(json.dumps({"quay.io/org/app_web": ["2017-01-01t000000z", "2017-01-02t000000z"]}))
+        filename = str(tmpdir.join("builds.sqlite"))
+        BuildStore(filename).close()
+        ready, go, imported = [], threading.Event(), []
+
+        def first_run():
+            store = BuildStore(filename)  # one connection per run, as in separate processes
+            ready.append(store.is_empty())  # so each would import
+            go.wait()
+            imported.append(store.import_tags_json(str(tags_file), if_empty=True))
+            store.close()
+
+        threads = [threading.Thread(target=first_run) for _ in range(4)]
+        for t in threads:
+            t.start()
+        while len(ready) < len(threads):
+            time.sleep(0.01)
+        go.set()
+        for t in threads:
+            t.join()
+
+        assert ready == [True] * 4
+        assert len([i for i in imported if i is not None]) == 1
+        assert BuildStore(filename).tags() == {
+            "quay.io/org/app_web": ["2017-01-01t000000z", "2017-01-02t000000z"]}
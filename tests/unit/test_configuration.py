@@ -61,7 +61,8 @@ exposed_ports:
                'info': {
                    'help': 'Build Flask Example app',
                    'parent': 'opencv',
-                   'exposed_ports': [80]
+                   'exposed_ports': [80],
+                   'context': '.',
                },
                'path': '/'
            }
@@ -73,6 +74,7 @@ exposed_ports:
         assert type(the_layer) == DockerBuildLayer
         assert the_layer.registry_config['host'] == 'quay.io'
         assert the_layer.exposed_ports == [80]
+        assert the_layer.build_context == '.'
 
     def test_parse_project_yaml_minimal(self):
         project_info = {
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from flyingcloud.base import DockerBuildLayer
+from flyingcloud.exceptions import DockerResultError
+from flyingcloud.utils.docker_async import AsyncDockerBackend, AsyncEngineClient
+from flyingcloud.utils.fake_engine import FakeEngine, fake_id
+
+
+class TestAsyncDockerBackend:
+    def setup_method(self, method):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        # Keep the socket path short: unix socket paths are limited to ~100 chars
+        self.tmpdir = tempfile.mkdtemp()
+        self.engine = FakeEngine(
+            socket_path=os.path.join(self.tmpdir, "docker.sock"), latency=0.05,
+            exec_output=[(1, b"Succeeded: 3\n"), (2, b"Failed:    0\n")],
+            conflicting_names=["busy"], push_error="denied",
+            layers=1, layer_bytes=10, progress_step_bytes=10, stream_chunk_bytes=50).start()
+        self.layer = DockerBuildLayer("app", "web", None, "help", exposed_ports=[{8080: 80}])
+        self.backend = AsyncDockerBackend(
+            self.layer, AsyncEngineClient(self.engine.base_url, version="1.24", timeout=5))
+        self.namespace = argparse.Namespace(logger=logging.getLogger(__name__), retries=1)
+
+    def teardown_method(self, method):
+        self.engine.stop()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.tmpdir)
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_create_container(self):
+        container_id = self.run(self.backend.docker_create_container(
+            self.namespace, "app_web", "app_web:latest",
+            environment=dict(FOO="bar"), volume_map={"/tmp/salt": "/srv/salt"}))
+        assert container_id == fake_id("container", 1)
+        call = self.engine.calls[0]
+        assert (call["method"], call["path"], call["params"]) == (
+            "POST", "/containers/create", dict(name="app_web"))
+        body = call["body"]
+        assert body["Env"] == ["FOO=bar"]
+        assert body["ExposedPorts"] == {"80/tcp": {}}
+        assert body["HostConfig"]["PortBindings"] == {"80/tcp": [{"HostPort": "8080"}]}
+        assert body["HostConfig"]["Binds"] == ["/tmp/salt:/srv/salt:rw"]
+
+    def test_create_container_conflict(self):
+        with pytest.raises(DockerResultError) as exc_info:
+            self.run(self.backend.docker_create_container(self.namespace, "busy", "app_web:latest"))
+        assert "flyingcloud --kill" in str(exc_info.value)
+
+    def test_exec_demultiplexes_output(self):
+        result, output = self.run(self.backend.docker_exec(
+            self.namespace, "c0ffee", ["salt-call", "--local", "state.highstate"]))
+        assert result["ExitCode"] == 0
+        assert output == "Succeeded: 3\n\nFailed:    0\n"
+        assert self.engine.calls[0]["body"]["Cmd"] == ["salt-call", "--local", "state.highstate"]
+
+    def test_pull_reassembles_split_json(self):
+        output = self.run(self.backend.docker_pull(self.namespace, "quay.io/org/app_web:1234"))
+        assert [json.loads(line) for line in output.split('\n')] == list(
+            self.engine.progress_messages('pull', "quay.io/org/app_web", "1234"))
+        call = self.engine.calls[0]
+        assert call["path"] == "/images/create"
+        assert call["params"] == dict(fromImage="quay.io/org/app_web", tag="1234")
+
+    def test_push_error(self):
+        with pytest.raises(DockerResultError):
+            self.run(self.backend.docker_push(self.namespace, "app_web:latest"))
+
+    def test_operations_overlap(self):
+        self.run(asyncio.gather(
+            self.backend.docker_pull(self.namespace, "app_a:latest"),
+            self.backend.docker_pull(self.namespace, "app_b:latest"),
+            self.backend.docker_cleanup(self.namespace, "old_container"),
+        ))
+        assert len(self.engine.calls) == 4
+        assert self.engine.max_active >= 3
@@ -8,7 +8,7 @@ import unittest
 
 from docker.errors import DockerException
 from mock import MagicMock
-from flyingcloud.utils.docker_util import retry_call
+from flyingcloud.utils.docker_util import retry_call, DockerClientRegistry
 
 
 class TestDockerUtils(unittest.TestCase):
@@ -37,3 +37,29 @@ class TestDockerUtils(unittest.TestCase):
 
         self.assertRaises(DockerException, retry_call, fn, 'test_retry_failure', logger, 3, counter)
         self.assertEqual(counter["c"], 3)
+
+
+class TestDockerClientRegistry(unittest.TestCase):
+    def test_reuses_client_for_same_parameters(self):
+        factory = MagicMock(side_effect=lambda *args, **kwargs: MagicMock())
+        registry = DockerClientRegistry(factory=factory)
+
+        c1 = registry.get(timeout=300, version="1.17")
+        c2 = registry.get(timeout=300, version="1.17")
+        c3 = registry.get(timeout=2700, version="1.17")
+
+        self.assertIs(c1, c2)
+        self.assertIsNot(c1, c3)
+        self.assertEqual(factory.call_count, 2)
+        self.assertEqual(len(registry), 2)
+
+    def test_close(self):
+        registry = DockerClientRegistry(factory=lambda **kwargs: MagicMock())
+        c1 = registry.get(timeout=300)
+        c2 = registry.get(timeout=2700)
+        registry.close()
+
+        c1.close.assert_called_once_with()
+        c2.close.assert_called_once_with()
+        self.assertEqual(len(registry), 0)
+        self.assertIsNot(c1, registry.get(timeout=300))
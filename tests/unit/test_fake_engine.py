@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import json
+import socket
+import time
+
+import pytest
+from six.moves import http_client
+
+from flyingcloud.utils.fake_engine import FakeEngine, StreamHeader
+from flyingcloud.utils.metrics import transfer_bytes
+
+
+class UnixHTTPConnection(http_client.HTTPConnection):
+    def __init__(self, path):
+        http_client.HTTPConnection.__init__(self, "localhost")
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+@pytest.fixture(params=["tcp", "unix"])
+def engine(request, tmpdir):
+    socket_path = str(tmpdir.join("docker.sock")) if request.param == "unix" else None
+    with FakeEngine(socket_path=socket_path) as engine:
+        yield engine
+
+
+def connect(engine):
+    if engine.socket_path:
+        return UnixHTTPConnection(engine.socket_path)
+    return http_client.HTTPConnection(*engine.server.server_address[:2])
+
+
+def call(engine, method, path, body=None):
+    connection = connect(engine)
+    try:
+        connection.request(method, path, body=json.dumps(body) if body is not None else None)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+class TestFakeEngine:
+    def test_requests(self, engine):
+        assert engine.base_url.startswith("unix://" if engine.socket_path else "tcp://")
+        status, body = call(engine, "GET", "/v1.24/version")
+        assert status == 200 and json.loads(body.decode())["ApiVersion"] == "1.24"
+        status, body = call(engine, "POST", "/containers/create?name=app", dict(Image="app_base"))
+        assert status == 201 and len(json.loads(body.decode())["Id"]) == 64
+        status, body = call(engine, "POST", "/images/quay.io/org/app:latest/tag?repo=app&tag=v1")
+        assert status == 201
+        status, body = call(engine, "GET", "/nonesuch")
+        assert status == 404 and "nonesuch" in json.loads(body.decode())["message"]
+        assert engine.requests == dict(version=1, container_create=1, image_tag=1, **{"/nonesuch": 1})
+
+    def test_keep_alive(self, engine):
+        connection = connect(engine)
+        for _ in range(3):
+            connection.request("POST", "/containers/c1/stop?t=1")
+            response = connection.getresponse()
+            assert response.status == 204 and response.read() == b""
+        connection.close()
+        assert engine.requests["no_content"] == 3
+
+    def test_pull_progress(self, engine):
+        engine.configure(layers=3, layer_bytes=10 << 20, progress_step_bytes=1 << 20)
+        status, body = call(engine, "POST", "/images/create?fromImage=quay.io/org/app&tag=latest")
+        messages = [json.loads(line) for line in body.decode().splitlines()]
+        assert status == 200
+        assert messages[-1]["status"] == "Status: Downloaded newer image for quay.io/org/app:latest"
+        assert sum(m["status"] == "Downloading" for m in messages) == 3 * 10
+        assert transfer_bytes(body.decode()) == 3 * (10 << 20)
+
+    def test_exec_stream(self, engine):
+        engine.configure(exec_output_bytes=100000, exec_frame_bytes=1000, exec_invalid_utf8_every=10)
+        status, body = call(engine, "POST", "/exec/e1/start", dict(Detach=False, Tty=False))
+        assert status == 200
+        frames = []
+        while body:
+            stream_type, size = StreamHeader.unpack_from(body)
+            frames.append(body[StreamHeader.size:StreamHeader.size + size])
+            body = body[StreamHeader.size + size:]
+        assert sum(len(f) for f in frames) == 100000
+        assert sum(b"\xff" in f for f in frames) == len(frames) // 10
+
+    def test_image_get_and_load(self, engine):
+        engine.configure(image_bytes=(3 << 20) + 5)
+        status, body = call(engine, "GET", "/images/app:latest/get")
+        assert status == 200 and len(body) == (3 << 20) + 5
+        connection = connect(engine)
+        connection.request("POST", "/images/load", body=body)
+        response = connection.getresponse()
+        assert b"Loaded image (3145733 bytes)" in response.read()
+
+    def test_latency(self, engine):
+        engine.configure(latency=0.2)
+        start = time.time()
+        call(engine, "GET", "/_ping")
+        assert time.time() - start >= 0.2
+
+    def test_unknown_setting(self):
+        with pytest.raises(TypeError):
+            FakeEngine(lag=1)
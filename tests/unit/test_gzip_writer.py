@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import gzip
+import io
+import os
+import subprocess
+import tarfile
+import threading
+
+from flyingcloud.utils.archive import write_tarfile
+from flyingcloud.utils.file import find_in_path
+from flyingcloud.utils.gzip_writer import ParallelGzipWriter
+
+
+class TestParallelGzipWriter:
+    def test_round_trip(self, tmpdir):
+        data = b"".join(os.urandom(16) + b"the quick brown fox " * 50 for _ in range(500))
+        filename = str(tmpdir.join("data.gz"))
+        with open(filename, "wb") as fp:
+            with ParallelGzipWriter(fp, compresslevel=6, max_workers=4, block_size=4096,
+                                    filename="data") as gz:
+                for i in range(0, len(data), 1000):
+                    gz.write(data[i:i + 1000])
+        with gzip.open(filename) as fp:
+            assert fp.read() == data
+        assert os.path.getsize(filename) < len(data) / 5
+        if find_in_path("gzip"):
+            subprocess.check_call(["gzip", "-t", filename])
+
+    def test_empty(self):
+        out = io.BytesIO()
+        with ParallelGzipWriter(out):
+            pass
+        assert gzip.GzipFile(fileobj=io.BytesIO(out.getvalue())).read() == b""
+
+    def test_deterministic(self):
+        data = os.urandom(1000) * 300
+        outputs = []
+        for workers in (1, 8):
+            out = io.BytesIO()
+            with ParallelGzipWriter(out, max_workers=workers, block_size=8192, mtime=0) as gz:
+                gz.write(data)
+            outputs.append(out.getvalue())
+        assert outputs[0] == outputs[1]
+
+
+class TestWriteTarfile:
+    def test_stream_to_pipe(self, tmpdir):
+        src = tmpdir.mkdir("app")
+        for i in range(20):
+            src.join("f{:02d}.txt".format(i)).write("line\n" * 5000 * i)
+        read_fd, write_fd = os.pipe()
+
+        def produce():
+            with os.fdopen(write_fd, "wb") as fp:
+                write_tarfile(fp, str(src), ":gz", compresslevel=1, threads=4)
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        with os.fdopen(read_fd, "rb") as fp:
+            with tarfile.open(fileobj=fp, mode="r|gz") as tar:
+                members = dict((m.name, tar.extractfile(m).read()) for m in tar if m.isfile())
+        producer.join()
+        assert members["app/f07.txt"] == b"line\n" * 5000 * 7
+        assert len(members) == 20
+
+    def test_xz_to_unseekable_object(self, tmpdir):
+        src = tmpdir.mkdir("app")
+        src.join("main.py").write("print('hello')\n")
+        out = io.BytesIO()
+        write_tarfile(out, str(src), ":xz")
+        with tarfile.open(fileobj=io.BytesIO(out.getvalue()), mode="r:xz") as tar:
+            assert tar.getnames() == ["app", "app/main.py"]
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import gzip
+import logging
+import time
+
+import six
+from six.moves import queue
+import pytest
+
+from flyingcloud.utils.log_util import (
+    QueueHandler, QueueListener, StreamLogger, configure_logging, stop_logging)
+
+
+class SlowHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        time.sleep(0.01)
+        self.messages.append(record.getMessage())
+
+
+class TestQueuedLogging:
+    def test_configure_is_idempotent(self, tmpdir):
+        name = "flyingcloud.test.idempotent"
+        logfile = str(tmpdir.join("test.log"))
+        try:
+            for _ in range(3):
+                logger = configure_logging(name, logfile)
+            assert [h for h in logger.handlers if isinstance(h, QueueHandler)] == logger.handlers
+            assert len(logger.handlers) == 1
+            logger.debug("hello %s", "world")
+        finally:
+            stop_logging(name)
+        assert not logger.handlers
+        assert tmpdir.join("test.log").read().count("hello world") == 1
+
+    def test_slow_sink_does_not_block(self):
+        records, slow = queue.Queue(maxsize=20), SlowHandler()
+        handler, listener = QueueHandler(records), QueueListener(records, slow)
+        logger = logging.getLogger("flyingcloud.test.slow")
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        listener.start()
+        try:
+            start = time.time()
+            for i in range(200):
+                logger.info("line %d", i)
+            assert time.time() - start < 1  # the sink alone would take 2s
+        finally:
+            logger.removeHandler(handler)
+            listener.stop()
+        assert handler.dropped > 0
+        assert slow.messages[0] == "line 0"
+
+    def test_warnings_are_never_dropped(self):
+        records, slow = queue.Queue(maxsize=5), SlowHandler()
+        handler, listener = QueueHandler(records), QueueListener(records, slow)
+        logger = logging.getLogger("flyingcloud.test.warnings")
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        listener.start()
+        try:
+            for i in range(30):
+                logger.info("info %d", i)
+                logger.error("error %d", i)
+        finally:
+            logger.removeHandler(handler)
+            listener.stop()
+        assert handler.dropped + len([m for m in slow.messages if m.startswith("info")]) >= 30
+        assert [m for m in slow.messages if m.startswith("error")] == ["error %d" % i for i in range(30)]
+
+    def test_console_filter(self, tmpdir, capsys):
+        name = "flyingcloud.test.destinations"
+        logfile = tmpdir.join("test.log")
+        try:
+            logger = configure_logging(name, str(logfile))
+            logger.propagate = False
+            logger.info("everywhere")
+            logger.info("file only", extra=dict(to_console=False))
+            logger.info("console only", extra=dict(to_logfile=False))
+        finally:
+            stop_logging(name)
+        err = capsys.readouterr().err
+        assert "everywhere" in err and "console only" in err and "file only" not in err
+        assert "everywhere" in logfile.read() and "file only" in logfile.read()
+        assert "console only" not in logfile.read()
+
+    @pytest.mark.skipif(six.PY2, reason="RotatingFileHandler.rotator is Python 3 only")
+    def test_compressed_rotation(self, tmpdir):
+        name = "flyingcloud.test.rotation"
+        logfile = tmpdir.join("test.log")
+        try:
+            logger = configure_logging(name, str(logfile), max_bytes=1000, backup_count=2, compress=True)
+            logger.propagate = False
+            for i in range(100):
+                logger.debug("message %03d", i)
+        finally:
+            stop_logging(name)
+        assert sorted(p.basename for p in tmpdir.listdir()) == ["test.log", "test.log.1.gz", "test.log.2.gz"]
+        with gzip.open(str(tmpdir.join("test.log.1.gz")), "rt") as f:
+            assert "message" in f.read()
+        assert "message 099" in logfile.read()
+
+
+class TestStreamLogger:
+    def test_coalesces_lines(self):
+        records = []
+        with StreamLogger(lambda fmt, msg: records.append(msg), "docker_exec", interval=60, max_lines=3) as log:
+            for i in range(7):
+                log.add("line %d" % i)
+        assert records == [
+            "docker_exec: line 0\ndocker_exec: line 1\ndocker_exec: line 2",
+            "docker_exec: line 3\ndocker_exec: line 4\ndocker_exec: line 5",
+            "docker_exec: line 6",
+        ]
+
+    def test_flushes_after_interval(self):
+        records = []
+        log = StreamLogger(lambda fmt, msg: records.append(msg), "docker_pull", interval=0.1)
+        log.add({"status": "Downloading"})
+        time.sleep(0.5)
+        assert records == ["docker_pull: {'status': 'Downloading'}"]
+
+    def test_rate_limit_only_limits_the_console(self):
+        records = []
+
+        def log(fmt, msg, extra=None):
+            records.append((msg, extra))
+        with StreamLogger(log, "build", interval=60, max_lines=1000, rate_limit=5) as stream_logger:
+            for i in range(100):
+                stream_logger.add(i)
+        (logfile, logfile_extra), (console, console_extra) = records
+        assert logfile_extra == dict(to_console=False) and console_extra == dict(to_logfile=False)
+        assert logfile.splitlines() == ["build: {}".format(i) for i in range(100)]
+        assert console.splitlines() == ["build: {}".format(i) for i in range(5)] + [
+            "build: [95 lines not shown]"]
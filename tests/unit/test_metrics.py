@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import argparse
+import json
+import logging
+
+import mock
+from docker.errors import DockerException
+from mock import MagicMock
+
+from flyingcloud.base import DockerBuildLayer as DBL
+from flyingcloud.utils import docker_util
+from flyingcloud.utils.metrics import MetricsRegistry, default_registry, transfer_bytes
+
+
+class TestMetricsRegistry:
+    def test_textfile_format(self, tmpdir):
+        metrics = MetricsRegistry()
+        metrics.inc('flyingcloud_transfer_bytes_total', 100, help="Bytes.", layer="web", verb="push")
+        metrics.inc('flyingcloud_transfer_bytes_total', 50, layer="web", verb="push")
+        metrics.set('flyingcloud_disk_free_bytes', 12345, path='/var/lib/"docker"')
+        metrics.observe('flyingcloud_build_duration_seconds', 42.5, buckets=(10, 60), layer="web")
+        metrics.observe('flyingcloud_build_duration_seconds', 5, buckets=(10, 60), layer="web")
+
+        prom_file = tmpdir.join("flyingcloud.prom")
+        metrics.write_textfile(str(prom_file))
+        assert prom_file.read().splitlines() == [
+            '# HELP flyingcloud_build_duration_seconds flyingcloud_build_duration_seconds',
+            '# TYPE flyingcloud_build_duration_seconds histogram',
+            'flyingcloud_build_duration_seconds_bucket{layer="web",le="10"} 1',
+            'flyingcloud_build_duration_seconds_bucket{layer="web",le="60"} 2',
+            'flyingcloud_build_duration_seconds_bucket{layer="web",le="+Inf"} 2',
+            'flyingcloud_build_duration_seconds_sum{layer="web"} 47.5',
+            'flyingcloud_build_duration_seconds_count{layer="web"} 2',
+            '# HELP flyingcloud_disk_free_bytes flyingcloud_disk_free_bytes',
+            '# TYPE flyingcloud_disk_free_bytes gauge',
+            'flyingcloud_disk_free_bytes{path="/var/lib/\\"docker\\""} 12345',
+            '# HELP flyingcloud_transfer_bytes_total Bytes.',
+            '# TYPE flyingcloud_transfer_bytes_total counter',
+            'flyingcloud_transfer_bytes_total{layer="web",verb="push"} 150',
+        ]
+        assert [p.basename for p in tmpdir.listdir()] == ["flyingcloud.prom"]
+
+        json_file = tmpdir.join("metrics.json")
+        metrics.write_json(str(json_file))
+        summary = json.loads(json_file.read())
+        assert summary['flyingcloud_build_duration_seconds']['samples'] == [
+            dict(labels=dict(layer="web"), buckets={"10": 1, "60": 2}, sum=47.5, count=2)]
+        assert summary['flyingcloud_disk_free_bytes']['samples'][0]['value'] == 12345
+
+    def test_transfer_bytes(self):
+        output = "\n".join([
+            '{"status": "Pulling fs layer", "progressDetail": {}, "id": "a1"}',
+            '{"status": "Downloading", "progressDetail": {"current": 100, "total": 1000}, "id": "a1"}',
+            '{"status": "Downloading", "progressDetail": {"current": 1000, "total": 1000}, "id": "a1"}',
+            '{"status": "Pushing", "progressDetail": {"current": 512}, "id": "b2"}',
+            'not json',
+            '{"status": "Digest: sha256:abc"}',
+        ])
+        assert transfer_bytes(output) == 1512
+
+
+class TestRunMetrics:
+    def setup_method(self, method):
+        default_registry.clear()
+
+    def test_retries_are_counted(self):
+        attempts = []
+
+        def flaky():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise DockerException("try again")
+            return "ok"
+        with mock.patch.object(docker_util, "sleep"):
+            assert docker_util.retry_call(flaky, "push", MagicMock(), 3) == "ok"
+        assert default_registry.value('flyingcloud_retries_total', operation="push") == 2
+
+    def test_push_bytes_and_duration(self):
+        namespace = argparse.Namespace(
+            docker=MagicMock(), logger=logging.getLogger(__name__), logged_in=True, retries=1)
+        namespace.docker.push.return_value = iter([
+            b'{"status": "Pushing", "progressDetail": {"current": 10, "total": 300}, "id": "l1"}\r\n',
+            b'{"status": "Pushed", "progressDetail": {}, "id": "l1"}\r\n',
+        ])
+        DBL("app", "web", None, "help").docker_push(namespace, "app_web:1")
+        assert default_registry.value('flyingcloud_transfer_bytes_total', layer="web", verb="push") == 300
+        assert default_registry.value('flyingcloud_transfer_duration_seconds', layer="web", verb="push") == 1
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import argparse
+import io
+import json
+import os
+import subprocess
+import tarfile
+import time
+import zipfile
+
+import mock
+import pytest
+
+from flyingcloud.utils.archive import make_tarfile
+from flyingcloud.utils.file import find_in_path
+from flyingcloud.utils import package_build
+from flyingcloud.utils.package_build import build_package, open_previous_bundle
+from flyingcloud.utils.vcs import clear_vcs_cache
+
+
+class TestReproducibleBuilds:
+    def _make_tree(self, root, mtime):
+        app = root.mkdir("app")
+        app.join("main.py").write("print('hello')\n")
+        app.mkdir("static").join("site.css").write("body {}\n")
+        app.mkdir("empty")
+        for path in app.visit():
+            path.setmtime(mtime)
+        return app
+
+    def _build(self, app, tmpdir, *args):
+        with tmpdir.as_cwd():
+            zip_filename = build_package([
+                str(app), "--prefix", "app", "--build-date", "20170101t000000z",
+                "--build-number", "42", "--branch-name", "master", "--vcs-sha", "abcdef0",
+            ] + list(args))
+            with open(zip_filename, "rb") as fp:
+                return zip_filename, fp.read()
+
+    def test_identical_sources_give_identical_zips(self, tmpdir, monkeypatch):
+        monkeypatch.setenv("SOURCE_DATE_EPOCH", "1500000000")
+        app1 = self._make_tree(tmpdir.mkdir("one"), time.time() - 3600)
+        app2 = self._make_tree(tmpdir.mkdir("two"), time.time() - 7200)
+        os.chmod(str(app2.join("main.py")), 0o600)
+        zip1, data1 = self._build(app1, tmpdir.mkdir("out1"))
+        zip2, data2 = self._build(app2, tmpdir.mkdir("out2"))
+        assert data1 == data2
+
+        with zipfile.ZipFile(str(tmpdir.join("out1", zip1))) as zf:
+            assert zf.namelist() == ["main.py", "empty/", "static/site.css", "version.json"]
+            assert zf.getinfo("main.py").date_time == (2017, 7, 14, 2, 40, 0)
+            assert zf.getinfo("main.py").external_attr >> 16 == 0o100644
+            version = json.loads(zf.read("version.json").decode("utf-8"))
+        assert len(version["content_digest"]) == 64
+
+    def test_content_digest_ignores_timestamps(self, tmpdir):
+        app = self._make_tree(tmpdir.mkdir("src"), time.time() - 3600)
+        digests = []
+        for out in ("out1", "out2"):
+            self._build(app, tmpdir.mkdir(out))
+            digests.append(json.loads(app.join("version.json").read())["content_digest"])
+            app.join("main.py").setmtime(time.time() - 60)
+        assert digests[0] == digests[1]
+
+    def test_reproducible_tarfile(self, tmpdir, monkeypatch):
+        monkeypatch.delenv("SOURCE_DATE_EPOCH", raising=False)
+        app1 = self._make_tree(tmpdir.mkdir("one"), time.time() - 3600)
+        app2 = self._make_tree(tmpdir.mkdir("two"), time.time() - 7200)
+        outputs = []
+        for app in (app1, app2):
+            tar_filename = str(app.dirpath().join("app.tar.gz"))
+            make_tarfile(tar_filename, str(app), reproducible=True)
+            with open(tar_filename, "rb") as fp:
+                outputs.append(fp.read())
+        assert outputs[0] == outputs[1]
+        with tarfile.open(str(app1.dirpath().join("app.tar.gz"))) as tar:
+            assert tar.getnames() == ["app", "app/empty", "app/main.py", "app/static", "app/static/site.css"]
+            assert set((m.mtime, m.uid, m.uname) for m in tar.getmembers()) == set([(315532800, 0, "")])
+
+
+class TestTarCompression:
+    @pytest.mark.parametrize("extension", [".tar.gz", ".tar.bz2", ".tar.xz", ".tar.zst"])
+    def test_make_tarfile(self, tmpdir, extension):
+        if extension == ".tar.zst" and not find_in_path("zstd"):
+            pytest.skip("zstd not installed")
+        src = tmpdir.mkdir("app")
+        src.join("main.py").write("print('hello')\n" * 1000)
+        tar_filename = str(tmpdir.join("app" + extension))
+        make_tarfile(tar_filename, str(src), compresslevel=1, threads=2)
+        if extension == ".tar.zst":
+            tar_data = subprocess.check_output(["zstd", "-d", "-c", tar_filename])
+            tar = tarfile.open(fileobj=io.BytesIO(tar_data))
+        else:
+            tar = tarfile.open(tar_filename)
+        with tar:
+            assert tar.getnames() == ["app", "app/main.py"]
+            assert tar.extractfile("app/main.py").read() == b"print('hello')\n" * 1000
+
+
+@pytest.mark.skipif(not find_in_path("git"), reason="git not installed")
+class TestFromVcs:
+    def _make_repo(self, tmpdir):
+        clear_vcs_cache()
+        repo = tmpdir.mkdir("repo")
+        subprocess.check_call(["git", "init", "-q"], cwd=str(repo))
+        app = repo.mkdir("app")
+        app.join("main.py").write("print('hello')\n")
+        app.join("local_settings.py").write("")
+        app.mkdir("static").join("site.css").write("body {}\n")
+        app.join(".ebignore").write("local_settings.py\n")
+        repo.join("README").write("")
+        subprocess.check_call(["git", "add", "."], cwd=str(repo))
+        app.mkdir("node_modules").join("left-pad.js").write("")
+        app.mkdir("dist").join("bundle.js").write("")
+        app.join("scratch.txt").write("")
+        return app
+
+    def test_zips_tracked_files_and_includes(self, tmpdir):
+        app = self._make_repo(tmpdir)
+        app.join("static", "site.css").remove()  # tracked, but deleted
+        out = tmpdir.mkdir("out")
+        with out.as_cwd():
+            zip_filename = build_package([
+                str(app), "--prefix", "app", "--from-vcs", "--include", "dist",
+                "--branch-name", "master", "--vcs-sha", "abcdef0"])
+            with zipfile.ZipFile(zip_filename) as zf:
+                assert zf.namelist() == [".ebignore", "dist/bundle.js", "main.py", "version.json"]
+
+    def test_requires_a_repository(self, tmpdir):
+        clear_vcs_cache()
+        with pytest.raises(SystemExit):
+            build_package([str(tmpdir), "--from-vcs", "--branch-name", "master", "--vcs-sha", "abcdef0"])
+
+
+class TestPreviousBundle:
+    def _namespace(self, tmpdir, content):
+        bundle = tmpdir.join("app-1.0.zip")
+        bundle.write_binary(content)
+        return argparse.Namespace(previous_bundle=str(bundle), zipfile_name=str(bundle))
+
+    def test_corrupt_bundle_keeps_its_name(self, tmpdir):
+        namespace = self._namespace(tmpdir, b"not a zip file")
+        messages = []
+        assert open_previous_bundle(namespace, messages.append) is None
+        assert tmpdir.join("app-1.0.zip").read_binary() == b"not a zip file"
+        assert not tmpdir.join("app-1.0.previous.zip").exists()
+        assert "Not reusing" in messages[0]
+
+    def test_unreadable_bundle_keeps_its_name(self, tmpdir):
+        namespace = self._namespace(tmpdir, b"PK")
+        with mock.patch.object(package_build, "ArchiveEntries", side_effect=IOError("no access")):
+            with pytest.raises(IOError):
+                open_previous_bundle(namespace, None)
+        assert tmpdir.join("app-1.0.zip").exists()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import zipfile
+
+from flyingcloud.utils.archive import make_zipfile
+from flyingcloud.utils.path_filter import IgnoreRules, PathFilter, walk
+
+
+class TestIgnoreRules:
+    def test_patterns(self):
+        rules = IgnoreRules([
+            "# comment",
+            "",
+            "*.log",
+            "/build",
+            "node_modules/",
+            "docs/*.md",
+            "**/fixtures/*.json",
+        ])
+        assert rules.excluded("app.log")
+        assert rules.excluded("logs/app.log")
+        assert rules.excluded("build", is_dir=True)
+        assert not rules.excluded("src/build", is_dir=True)
+        assert rules.excluded("node_modules", is_dir=True)
+        assert rules.excluded("web/node_modules", is_dir=True)
+        assert not rules.excluded("node_modules")  # dir-only rule, and this is a file
+        assert rules.excluded("docs/usage.md")
+        assert not rules.excluded("docs/api/usage.md")
+        assert rules.excluded("tests/fixtures/data.json")
+        assert not rules.has_exceptions
+
+    def test_exceptions(self):
+        rules = IgnoreRules(["*.json", "!package.json", "\\!important"])
+        assert rules.excluded("data.json")
+        assert not rules.excluded("package.json")
+        assert not rules.excluded("web/package.json")
+        assert rules.excluded("!important")
+        assert rules.has_exceptions
+
+
+class TestPathFilter:
+    def test_exclusions(self):
+        path_filter = PathFilter(
+            exclude_dirs=[".git"], exclude_extensions=[".pyc", ".egg-info"],
+            exclude_filenames=["TAGS"], patterns=["/local_settings.py"])
+        assert path_filter.excluded_dir("/src/app/.git", ".git")
+        assert path_filter.excluded_dir("/src/app/foo.egg-info", "foo.egg-info")
+        assert not path_filter.excluded_dir("/src/app/lib", "lib")
+        assert path_filter.excluded_file("TAGS", "TAGS")
+        assert path_filter.excluded_file("app.pyc", "lib/app.pyc")
+        assert not path_filter.excluded_file("app.py", "lib/app.py")
+        assert not path_filter.excluded_file("MYTAGS", "MYTAGS")
+        assert path_filter.excluded_file("local_settings.py", "local_settings.py")
+        assert not path_filter.excluded_file("local_settings.py", "lib/local_settings.py")
+
+
+class TestWalk:
+    def _make_tree(self, tmpdir):
+        tmpdir.mkdir(".git").join("HEAD").write("ref: refs/heads/master\n")
+        lib = tmpdir.mkdir("lib")
+        lib.join("app.py").write("")
+        lib.join("app.pyc").write("")
+        lib.mkdir("empty")
+        tmpdir.join("README").write("")
+        tmpdir.join("debug.log").write("")
+        os.symlink(str(lib), str(tmpdir.join("lib-link")))
+        return tmpdir
+
+    def test_walk(self, tmpdir):
+        self._make_tree(tmpdir)
+        path_filter = PathFilter(exclude_dirs=[".git"], exclude_extensions=[".pyc"], patterns=["*.log"])
+        walked = dict((reldir, sorted(e.name for e in entries))
+                      for _, reldir, entries in walk(str(tmpdir), path_filter))
+        # Symlinked directories aren't followed, as with os.walk
+        assert walked == {"": ["README"], "lib": ["app.py"], "lib/empty": []}
+
+    def test_zip_add_directory(self, tmpdir):
+        src = self._make_tree(tmpdir.mkdir("src"))
+        zip_filename = str(tmpdir.join("out.zip"))
+        make_zipfile(zip_filename, str(src), exclude_dirs=[".git"], exclude_extensions=[".pyc", ".log"])
+        with zipfile.ZipFile(zip_filename) as zf:
+            assert sorted(zf.namelist()) == ["README", "lib/app.py", "lib/empty/"]
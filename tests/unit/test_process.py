@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import sys
+import time
+
+import psutil
+import pytest
+
+from flyingcloud.utils.process import (
+    run_command, iter_command, run_commands,
+    CalledProcessError, CommandTimeoutError, CommandCancelledError, STDOUT, STDERR)
+
+
+def python(script):
+    return [sys.executable, "-c", script]
+
+
+class TestIterCommand:
+    def test_lines_are_tagged_by_stream(self):
+        lines = list(iter_command(python(
+            "import sys\n"
+            "print('out 1'); sys.stdout.flush()\n"
+            "sys.stderr.write('err 1\\n'); sys.stderr.flush()\n"
+            "print('out 2')\n")))
+        assert [line for stream, line in lines if stream == STDOUT] == ["out 1", "out 2"]
+        assert [line for stream, line in lines if stream == STDERR] == ["err 1"]
+
+    def test_failure_keeps_a_bounded_tail(self):
+        with pytest.raises(CalledProcessError) as excinfo:
+            for _ in iter_command(python(
+                    "import sys\n"
+                    "for i in range(1000): print(i)\n"
+                    "sys.exit(3)\n"), tail_lines=2):
+                pass
+        assert excinfo.value.returncode == 3
+        assert excinfo.value.output == "998\n999"
+        assert str(excinfo.value).endswith("last lines of output:\n998\n999")
+
+    def test_timeout_kills_the_process_group(self):
+        start = time.time()
+        with pytest.raises(CommandTimeoutError) as excinfo:
+            lines = []
+            for _, line in iter_command(
+                    ["sh", "-c", "sleep 30 & echo $!; wait"], timeout=1, kill_grace_period=1,
+                    kill_process_group=True):
+                lines.append(line)
+        assert time.time() - start < 10
+        assert not excinfo.value.idle
+        grandchild = int(lines[0])
+        time.sleep(0.2)
+        # Killed, though perhaps not yet reaped by its new parent
+        assert not psutil.pid_exists(grandchild) or psutil.Process(grandchild).status() == psutil.STATUS_ZOMBIE
+
+    def test_stays_in_our_process_group_by_default(self):
+        script = "import os; print(os.getpgrp())"
+        assert [line for _, line in iter_command(python(script))] == [str(os.getpgrp())]
+        assert [line for _, line in iter_command(python(script), kill_process_group=True)] != [
+            str(os.getpgrp())]
+
+    def test_long_lines_are_not_split(self):
+        lines = list(iter_command(python("print('x' * 200000); print('y')")))
+        assert [line for _, line in lines] == ["x" * 200000, "y"]
+
+    def test_undecodable_output(self):
+        script = ("import sys\n"
+                  "out = getattr(sys.stdout, 'buffer', sys.stdout)\n"
+                  "out.write(b'a.txt\\n\\xffb.txt\\n' + b'c.txt\\n' * 100000)\n")
+        lines = [line for _, line in iter_command(python(script), timeout=30)]
+        assert lines[:3] == ["a.txt", "\ufffdb.txt", "c.txt"]
+        assert len(lines) == 100002
+
+    def test_idle_timeout(self):
+        with pytest.raises(CommandTimeoutError) as excinfo:
+            for _ in iter_command(python(
+                    "import sys, time\n"
+                    "print('working'); sys.stdout.flush()\n"
+                    "time.sleep(30)\n"), idle_timeout=1, kill_grace_period=1):
+                pass
+        assert excinfo.value.idle
+        assert excinfo.value.output == "working"
+        assert "produced no output for 1s" in str(excinfo.value)
+
+
+class TestRunCommand:
+    def test_returns_stdout_then_stderr(self):
+        assert run_command(python(
+            "import sys\n"
+            "sys.stderr.write('err\\n'); sys.stderr.flush()\n"
+            "print('out')\n")) == ["out", "err"]
+
+    def test_failure(self):
+        with pytest.raises(CalledProcessError):
+            run_command(python("import sys; sys.exit(1)"), log_errors=False)
+
+
+class TestRunCommands:
+    def test_results_are_in_order_and_concurrent(self):
+        cmds = [python("import time; time.sleep({}); print({})".format(delay, i))
+                for i, delay in enumerate([0.6, 0.2, 0.4])]
+        start = time.time()
+        results = run_commands(cmds, max_workers=3)
+        assert time.time() - start < 1.5
+        assert [r.output for r in results] == [["0"], ["1"], ["2"]]
+        assert [r.cmd for r in results] == cmds
+        assert all(r.error is None and r.elapsed > 0.1 for r in results)
+
+    def test_collect_all(self):
+        results = run_commands(
+            [python("print('ok')"), python("import sys; sys.exit(2)"), ["/nonexistent/command"]],
+            fail_fast=False, log_errors=False)
+        assert results[0].output == ["ok"] and results[0].error is None
+        assert results[1].output is None and results[1].error.returncode == 2
+        assert isinstance(results[2].error, OSError)
+
+    def test_fail_fast_cancels_the_rest(self):
+        start = time.time()
+        with pytest.raises(CalledProcessError) as excinfo:
+            run_commands(
+                [python("import time; time.sleep(30)"), python("import sys; sys.exit(2)")]
+                + [python("print('never')")] * 4,
+                max_workers=2, log_errors=False, kill_grace_period=1)
+        assert time.time() - start < 10
+        assert excinfo.value.returncode == 2
+        assert not isinstance(excinfo.value, CommandCancelledError)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import pstats
+import threading
+import time
+
+from flyingcloud.utils.package_build import build_package
+from flyingcloud.utils.profiler import Profiler, profile_prefix
+from flyingcloud.utils.trace import Tracer
+
+
+def spin(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class TestProfiler:
+    def test_profile_prefix(self):
+        assert profile_prefix(["app", "--profile", "/tmp/prof", "--no-pull"]) == "/tmp/prof"
+        assert profile_prefix(["app", "--no-pull"]) is None
+
+    def test_phases(self, tmpdir):
+        prefix = str(tmpdir.join("prof"))
+        profiler = Profiler(prefix, interval=0.001).start()
+        tracer = Tracer(profiler=profiler)
+        with tracer.span("build"):
+            with tracer.span("highstate"):
+                spin(0.2)
+            thread = threading.Thread(target=spin, args=(0.2,), name="worker")
+            thread.start()
+            thread.join()
+        pstats_file, collapsed_file, summary_file = profiler.write()
+
+        with open(collapsed_file) as fp:
+            stacks = [line.rsplit(" ", 1) for line in fp.read().splitlines()]
+        assert any(stack.startswith("thread:MainThread;phase:build;phase:highstate;")
+                   and "test_profiler.py:spin" in stack for stack, _ in stacks)
+        assert any(stack.startswith("thread:worker;phase:-;") for stack, _ in stacks)
+        assert all(int(count) > 0 for _, count in stacks)
+        counts = profiler.phase_samples()
+        assert counts["highstate"] > 0 and counts["-"] > 0
+        assert profiler.phases == {threading.current_thread().ident: []}
+
+        functions = set(func for _, _, func in pstats.Stats(pstats_file).stats)
+        assert "spin" in functions
+        with open(summary_file) as fp:
+            assert "highstate" in fp.read()
+
+    def test_build_package(self, tmpdir):
+        app = tmpdir.mkdir("app")
+        app.join("main.py").write("print('hello')\n")
+        prefix = str(tmpdir.join("prof"))
+        with tmpdir.as_cwd():
+            build_package([
+                str(app), "--prefix", "app", "--branch-name", "master", "--vcs-sha", "abcdef0",
+                "--verify", "--profile", prefix])
+        assert tmpdir.join("prof.pstats").check()
+        assert tmpdir.join("prof.collapsed").check()
+        functions = set(func for _, _, func in pstats.Stats(prefix + ".pstats").stats)
+        assert "zip_package" in functions
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import argparse
+import json
+import logging
+import time
+
+from mock import MagicMock
+
+from flyingcloud.base import DockerBuildLayer as DBL
+from flyingcloud.utils.metrics import default_registry
+from flyingcloud.utils.resource_sampler import ResourceSampler, parse_stats, summarize
+
+
+def make_stats(n, cgroup_v2=False):
+    """The nth of a series of stats reports: one CPU, fully busy, with growing I/O."""
+    memory_stats = dict(inactive_file=1000) if cgroup_v2 else dict(total_inactive_file=1000)
+    op_read, op_write = ("read", "write") if cgroup_v2 else ("Read", "Write")
+    return dict(
+        cpu_stats=dict(cpu_usage=dict(total_usage=(n + 1) * 10 ** 9), system_cpu_usage=(n + 1) * 2 * 10 ** 9,
+                       online_cpus=2),
+        precpu_stats=dict(cpu_usage=dict(total_usage=n * 10 ** 9), system_cpu_usage=n * 2 * 10 ** 9),
+        memory_stats=dict(usage=(n + 1) * 1000 + 1000, limit=10 ** 9, stats=memory_stats),
+        blkio_stats=dict(io_service_bytes_recursive=[
+            dict(major=8, minor=0, op=op_read, value=n * 100),
+            dict(major=8, minor=0, op=op_write, value=n * 200),
+            dict(major=8, minor=0, op="Total", value=n * 300),
+        ]),
+        networks=dict(eth0=dict(rx_bytes=n * 10, tx_bytes=n * 5)),
+    )
+
+
+class TestParseStats:
+    def test_cgroup_v1_and_v2(self):
+        for cgroup_v2 in (False, True):
+            sample = parse_stats(make_stats(3, cgroup_v2))
+            assert sample == dict(
+                cpu_percent=100.0, memory_bytes=4000, memory_limit_bytes=10 ** 9,
+                block_read_bytes=300, block_write_bytes=600, network_rx_bytes=30, network_tx_bytes=15)
+
+    def test_first_report_has_no_cpu_delta(self):
+        stats = make_stats(0)
+        stats['precpu_stats'] = {}
+        assert parse_stats(stats)['cpu_percent'] == 0.0
+
+    def test_summarize(self):
+        samples = [dict(parse_stats(make_stats(n)), t=n * 2.0) for n in range(5)]
+        summary = summarize(samples)
+        assert summary['samples'] == 5 and summary['duration'] == 8.0
+        assert summary['peaks']['memory_bytes'] == 5000
+        assert summary['averages']['memory_bytes'] == 3000
+        assert summary['totals']['block_write_bytes'] == 800
+        assert summary['averages']['block_write_bytes_per_second'] == 100
+
+
+class TestResourceSampler:
+    def test_samples_in_background(self):
+        def stats(container, decode, stream):
+            for n in range(1000):
+                time.sleep(0.01)
+                yield make_stats(n)
+        client = MagicMock()
+        client.stats.side_effect = stats
+        with ResourceSampler(client, "c0ffee", interval=0.05) as sampler:
+            time.sleep(0.5)
+        profile = sampler.profile()
+        assert 3 <= profile['summary']['samples'] <= 12
+        assert all(b['t'] - a['t'] >= 0.04 for a, b in zip(profile['samples'], profile['samples'][1:]))
+        assert not sampler.thread.is_alive()
+
+    def test_layer_saves_profile(self, tmpdir):
+        default_registry.clear()
+        namespace = argparse.Namespace(
+            docker=MagicMock(), logger=logging.getLogger(__name__), timeout=60, timestamp="2017-01-01t000000z",
+            resource_profile=str(tmpdir.join("{layer}-{timestamp}.json")), stats_interval=0.01,
+            docker_clients=MagicMock(), use_docker_machine=False)
+        namespace.docker_clients.get.return_value.stats.return_value = iter(
+            [make_stats(n) for n in range(1, 4)])
+        layer = DBL("app", "web", None, "help")
+        sampler = layer.start_resource_sampler(namespace, "c0ffee")
+        sampler.thread.join()
+        layer.save_resource_profile(namespace, sampler)
+        profile = json.loads(tmpdir.join("web-2017-01-01t000000z.json").read())
+        assert profile['layer'] == "web" and len(profile['samples']) >= 1
+        assert default_registry.value('flyingcloud_salt_cpu_percent', layer="web", stat="peak") == 100.0
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import argparse
+import json
+import logging
+import threading
+
+from mock import MagicMock
+import pytest
+
+from flyingcloud.base import DockerBuildLayer as DBL
+from flyingcloud.utils.trace import Tracer
+
+
+class TestTracer:
+    def test_spans(self, tmpdir):
+        tracer = Tracer()
+        with tracer.span("build", layer="app"):
+            with tracer.span("pull") as args:
+                args['bytes'] = 42
+            def teardown():
+                with tracer.span("teardown"):
+                    pass
+            thread = threading.Thread(target=teardown, name="teardown-1")
+            thread.start()
+            thread.join()
+        with pytest.raises(ValueError):
+            with tracer.span("push"):
+                raise ValueError("denied")
+
+        trace_file = str(tmpdir.join("trace.json"))
+        tracer.write(trace_file)
+        with open(trace_file) as fp:
+            events = json.load(fp)["traceEvents"]
+        spans = dict((e["name"], e) for e in events if e["ph"] == "X")
+        assert [e["name"] for e in events if e["ph"] == "X"] == ["build", "pull", "teardown", "push"]
+        build, pull = spans["build"], spans["pull"]
+        assert build["ts"] <= pull["ts"] and pull["ts"] + pull["dur"] <= build["ts"] + build["dur"]
+        assert build["args"] == {"layer": "app"} and pull["args"] == {"bytes": 42}
+        assert spans["push"]["args"]["error"].startswith("ValueError")
+        assert spans["teardown"]["tid"] != build["tid"]
+        thread_names = set(e["args"]["name"] for e in events if e["name"] == "thread_name")
+        assert "teardown-1" in thread_names
+
+
+class TestBuildLayerTracing:
+    def test_phases_are_traced(self):
+        namespace = argparse.Namespace(
+            docker=MagicMock(), logger=logging.getLogger(__name__), operation="kill",
+            kill_containers=False, stop_timeout=1, use_docker_machine=False)
+        namespace.docker.containers.return_value = [dict(Id="c1"), dict(Id="c2")]
+        DBL("app", "web", None, "help").do_operation(namespace)
+        names = [e["name"] for e in namespace.tracer.trace_events() if e["ph"] == "X"]
+        assert names[0] == "layer web"
+        assert names[1] == "teardown"
+        assert sorted(names[2:]) == ["remove_container"] * 2 + ["stop_container"] * 2
+        assert set(e["cat"] for e in namespace.tracer.events) == set(["web"])
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import subprocess
+
+import mock
+import pytest
+
+from flyingcloud.utils import vcs
+from flyingcloud.utils.file import find_in_path
+from flyingcloud.utils.vcs import Git, Mercurial, find_vcs, clear_vcs_cache
+
+
+def git(cwd, *args):
+    return subprocess.check_output(
+        ["git", "-c", "user.name=Test", "-c", "user.email=test@example.com"] + list(args),
+        cwd=cwd).decode("utf-8").strip()
+
+
+@pytest.mark.skipif(not find_in_path("git"), reason="git not installed")
+class TestGit:
+    def setup_method(self, method):
+        clear_vcs_cache()
+
+    def _make_repo(self, tmpdir):
+        repo = tmpdir.mkdir("repo")
+        git(str(repo), "init", "-q")
+        git(str(repo), "checkout", "-q", "-b", "feature/bundles")
+        repo.join("README").write("hello\n")
+        git(str(repo), "add", "README")
+        git(str(repo), "commit", "-q", "-m", "Initial")
+        repo.mkdir("app").join("main.py").write("")
+        return repo
+
+    def test_reads_metadata_without_subprocesses(self, tmpdir):
+        repo = self._make_repo(tmpdir)
+        with mock.patch.object(vcs, "run_command") as run_command:
+            found = find_vcs(str(repo.join("app")))
+            assert isinstance(found, Git)
+            assert found.root == str(repo)
+            assert found.current_branch() == "feature/bundles"
+            # Memoized: the same instance for any directory in the repo
+            assert find_vcs(str(repo)) is found
+        assert not run_command.called
+
+    def test_sha_is_abbreviated_by_git(self, tmpdir):
+        repo = self._make_repo(tmpdir)
+        git(str(repo), "config", "core.abbrev", "10")
+        found = find_vcs(str(repo))
+        assert found.sha() == git(str(repo), "rev-parse", "--short", "HEAD")
+        assert len(found.sha()) == 10
+
+    def test_detached_head(self, tmpdir):
+        repo = self._make_repo(tmpdir)
+        git(str(repo), "checkout", "-q", "--detach")
+        found = find_vcs(str(repo))
+        assert found.current_branch() == git(str(repo), "rev-parse", "--abbrev-ref", "HEAD") == "HEAD"
+        assert found.sha() == git(str(repo), "rev-parse", "--short", "HEAD")
+
+    def test_worktree(self, tmpdir):
+        repo = self._make_repo(tmpdir)
+        worktree = str(tmpdir.join("worktree"))
+        git(str(repo), "worktree", "add", "-q", "-b", "hotfix", worktree)
+        found = find_vcs(worktree)
+        assert found.root == worktree
+        assert found.current_branch() == "hotfix"
+        assert found.sha() == git(worktree, "rev-parse", "--short", "HEAD")
+
+    @pytest.mark.parametrize("index_version", ["2", "3", "4"])
+    def test_tracked_files_from_index(self, tmpdir, index_version):
+        repo = self._make_repo(tmpdir)
+        repo.mkdir("node_modules").join("left-pad.js").write("")
+        repo.join("app", "a very long file name that index v4 prefix-compresses.py").write("")
+        git(str(repo), "add", "app")
+        git(str(repo), "update-index", "--index-version", index_version)
+        if index_version == "3":
+            git(str(repo), "update-index", "--skip-worktree", "README")  # extended flags
+        expected = git(str(repo), "ls-files").splitlines()
+        with mock.patch.object(vcs, "run_command") as run_command:
+            assert find_vcs(str(repo)).tracked_files() == sorted(expected)
+        assert not run_command.called
+        assert "node_modules/left-pad.js" not in expected
+
+    def test_not_a_repo(self, tmpdir):
+        with mock.patch.object(vcs, "find_upwards", return_value=None):
+            assert find_vcs(str(tmpdir)) is None
+
+
+class TestMercurial:
+    def setup_method(self, method):
+        clear_vcs_cache()
+
+    def test_reads_branch(self, tmpdir):
+        hg_dir = tmpdir.mkdir("repo").mkdir(".hg")
+        hg = Mercurial(str(tmpdir.join("repo")))
+        with mock.patch.object(vcs, "run_command") as run_command:
+            assert hg.current_branch() == "default"
+        assert not run_command.called
+
+        hg = Mercurial(str(tmpdir.join("repo")))
+        hg_dir.join("branch").write("stable\n")
+        assert hg.current_branch() == "stable"
+
+    def test_sha_marks_uncommitted_changes(self, tmpdir):
+        tmpdir.mkdir("repo").mkdir(".hg")
+        hg = Mercurial(str(tmpdir.join("repo")))
+        with mock.patch.object(vcs, "run_command", return_value=["0a1b2c3d4e5f+"]) as run_command:
+            assert hg.sha() == "0a1b2c3d4e5f+"
+            assert hg.sha() == "0a1b2c3d4e5f+"  # memoized
+        run_command.assert_called_once_with(
+            ["hg", "identify", "--id"], cwd=str(tmpdir.join("repo")), log_errors=False)
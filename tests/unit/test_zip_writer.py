@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import zipfile
+
+import pytest
+
+from flyingcloud.utils.archive import make_zipfile, check_zipfile
+from flyingcloud.utils.zip_writer import ParallelZipWriter, ArchiveEntries, CompressionPolicy
+
+
+class TestParallelZipWriter:
+    def _make_tree(self, tmpdir):
+        src = tmpdir.mkdir("src")
+        sub = src.mkdir("sub")
+        for i in range(50):
+            sub.join("f{:02d}.txt".format(i)).write_binary(os.urandom(64) + b"spam " * (i * 100))
+        src.mkdir("empty")
+        src.join("big.bin").write_binary(b"abc" * 100000)
+        src.join("café.txt").write_text("déjà vu", encoding="utf-8")
+        src.join("empty.txt").write("")
+        return src
+
+    def _expected(self, src):
+        return dict((p.relto(src).replace(os.sep, "/"), p.read_binary())
+                    for p in src.visit() if p.isfile())
+
+    def test_round_trip(self, tmpdir):
+        src = self._make_tree(tmpdir)
+        zip_filename = str(tmpdir.join("out.zip"))
+        make_zipfile(zip_filename, str(src), max_workers=4)
+
+        with zipfile.ZipFile(zip_filename) as zf:
+            assert zf.testzip() is None
+            contents = dict((name, zf.read(name)) for name in zf.namelist() if not name.endswith("/"))
+            assert "empty/" in zf.namelist()
+            assert zf.getinfo("sub/f10.txt").compress_type == zipfile.ZIP_DEFLATED
+        assert contents == self._expected(src)
+
+    def test_order_matches_submission(self, tmpdir):
+        names = ["n{:03d}".format(i) for i in range(200)]
+        zip_filename = str(tmpdir.join("out.zip"))
+        # Tiny memory bound forces the writer to wait on the pool as it goes
+        with ParallelZipWriter(zip_filename, max_workers=8, max_pending_bytes=1000) as zw:
+            for i, name in enumerate(reversed(names)):
+                zw.writestr(name, os.urandom(10 * i))
+            assert zw.namelist() == list(reversed(names))
+        with zipfile.ZipFile(zip_filename) as zf:
+            assert zf.namelist() == list(reversed(names))
+            assert zf.testzip() is None
+
+    def test_large_files_are_streamed(self, tmpdir):
+        src = self._make_tree(tmpdir)
+        zip_filename = str(tmpdir.join("out.zip"))
+        with ParallelZipWriter(zip_filename, large_file_size=1000) as zw:
+            for path in sorted(p for p in src.visit() if p.isfile()):
+                zw.write(str(path), path.relto(src))
+        with zipfile.ZipFile(zip_filename) as zf:
+            assert zf.testzip() is None
+            assert zf.read("big.bin") == b"abc" * 100000
+            assert zf.getinfo("big.bin").compress_size < 10000
+
+    def test_same_output_as_serial(self, tmpdir):
+        src = self._make_tree(tmpdir)
+        outputs = []
+        for workers in (1, 8):
+            zip_filename = str(tmpdir.join("out{}.zip".format(workers)))
+            make_zipfile(zip_filename, str(src), max_workers=workers)
+            with open(zip_filename, "rb") as fp:
+                outputs.append(fp.read())
+        assert outputs[0] == outputs[1]
+
+
+class TestReuse:
+    def _make_tree(self, tmpdir):
+        src = tmpdir.mkdir("src")
+        for i in range(20):
+            src.join("f{:02d}.txt".format(i)).write_binary(b"eggs " * (i * 100 + 1))
+        src.join("big.bin").write_binary(b"abc" * 100000)
+        for path in src.visit():
+            path.setmtime(path.mtime() - 3600)
+        return src
+
+    def _zip(self, src, zip_filename, reuse=None):
+        with ParallelZipWriter(zip_filename, large_file_size=100000, reuse=reuse) as zw:
+            for path in sorted(p for p in src.visit() if p.isfile()):
+                zw.write(str(path), path.relto(src))
+        return zw
+
+    def test_unchanged_entries_are_copied(self, tmpdir):
+        src = self._make_tree(tmpdir)
+        first = str(tmpdir.join("first.zip"))
+        self._zip(src, first)
+
+        src.join("f01.txt").write_binary(b"spam " * 101)  # same size, new content
+        src.join("f02.txt").write_binary(b"more")
+        src.join("f03.txt").setmtime(src.join("f03.txt").mtime() - 7200)  # touched only
+        src.join("new.txt").write("new")
+
+        reuse = ArchiveEntries(first)
+        try:
+            second = self._zip(src, str(tmpdir.join("second.zip")), reuse)
+        finally:
+            reuse.close()
+        # f00, f04..f19 and big.bin by mtime; f03 by CRC.
+        # f01 was modified too recently for its mtime to be trusted.
+        assert second.reused_count == 19
+
+        fresh = str(tmpdir.join("fresh.zip"))
+        self._zip(src, fresh)
+        with open(second.filename, "rb") as fp1, open(fresh, "rb") as fp2:
+            assert fp1.read() == fp2.read()
+
+    def test_stored_entry_reused_under_deflate_policy(self, tmpdir):
+        src = tmpdir.mkdir("src")
+        src.join("random.bin").write_binary(os.urandom(300 << 10))
+        src.join("random.bin").setmtime(src.join("random.bin").mtime() - 3600)
+        first = str(tmpdir.join("first.zip"))
+        with ParallelZipWriter(first) as zw:
+            zw.write(str(src.join("random.bin")), "random.bin", compress_type=zipfile.ZIP_STORED)
+
+        reuse = ArchiveEntries(first)
+        second = str(tmpdir.join("second.zip"))
+        try:
+            for large_file_size in (1 << 30, 1000):  # copied on the pool, and streamed
+                with ParallelZipWriter(second, reuse=reuse, large_file_size=large_file_size) as zw:
+                    zw.write(str(src.join("random.bin")), "random.bin")
+                assert zw.reused_count == 1
+                check_zipfile(second)
+                with zipfile.ZipFile(second) as zf:
+                    assert zf.getinfo("random.bin").compress_type == zipfile.ZIP_STORED
+        finally:
+            reuse.close()
+
+class TestVerification:
+    def test_duplicate_names_are_rejected(self, tmpdir):
+        with ParallelZipWriter(str(tmpdir.join("out.zip"))) as zw:
+            zw.writestr("version.json", "{}")
+            with pytest.raises(ValueError):
+                zw.writestr("version.json", "{}")
+
+    def test_check_zipfile(self, tmpdir):
+        zip_filename = str(tmpdir.join("out.zip"))
+        with ParallelZipWriter(zip_filename) as zw:
+            for i in range(20):
+                zw.writestr("f{:02d}".format(i), b"spam" * 1000 * i, compress_type=zipfile.ZIP_STORED)
+        check_zipfile(zip_filename, max_workers=4)
+
+        with zipfile.ZipFile(zip_filename) as zf:
+            offset = zf.getinfo("f13").header_offset + 30 + len("f13") + 100
+        with open(zip_filename, "r+b") as fp:
+            fp.seek(offset)
+            fp.write(b"eggs")
+        with pytest.raises(zipfile.BadZipfile) as exc_info:
+            check_zipfile(zip_filename, max_workers=4)
+        assert "f13" in str(exc_info.value)
+
+    def test_check_zipfile_corrupt_deflate_stream(self, tmpdir):
+        zip_filename = str(tmpdir.join("out.zip"))
+        with ParallelZipWriter(zip_filename) as zw:
+            for i in range(4):
+                zw.writestr("f{}".format(i), b"spam and eggs " * 1000, compress_type=zipfile.ZIP_DEFLATED)
+        with zipfile.ZipFile(zip_filename) as zf:
+            offset = zf.getinfo("f2").header_offset + 30 + len("f2")
+        with open(zip_filename, "r+b") as fp:
+            fp.seek(offset)
+            fp.write(b"\xff" * 8)  # an invalid deflate block type
+        with pytest.raises(zipfile.BadZipfile) as exc_info:
+            check_zipfile(zip_filename, max_workers=2)
+        assert "f2" in str(exc_info.value)
+
+
+class TestCompressionPolicy:
+    def test_choose(self):
+        policy = CompressionPolicy(level=6, levels=[("static/*.svg", 9), ("*.dat", 0)])
+        assert policy.choose("static/logo.svg", 100) == (zipfile.ZIP_DEFLATED, 9, False)
+        assert policy.choose("app/static/logo.svg", 100) == (zipfile.ZIP_DEFLATED, 6, False)
+        assert policy.choose("data/big.dat", 100) == (zipfile.ZIP_STORED, None, False)
+        assert policy.choose("static/photo.JPG", 100) == (zipfile.ZIP_STORED, None, False)
+        assert policy.choose("wheels/six-1.10.0-py2.py3-none-any.whl", 100) == (zipfile.ZIP_STORED, None, False)
+        assert policy.choose("app/views.py", 10 << 20) == (zipfile.ZIP_DEFLATED, 6, False)
+        assert policy.choose("bin/tool", 100) == (zipfile.ZIP_DEFLATED, 6, False)
+        assert policy.choose("bin/tool", 10 << 20) == (zipfile.ZIP_DEFLATED, 6, True)
+
+    def test_policy_in_writer(self, tmpdir):
+        src = tmpdir.mkdir("src")
+        src.join("photo.jpg").write_binary(b"\xff\xd8" + b"x" * 1000)
+        src.join("random.bin").write_binary(os.urandom(300 << 10))
+        src.join("text.bin").write_binary(b"hello world\n" * (30 << 10))
+        src.join("tiny.txt").write_binary(b"x")
+        zip_filename = str(tmpdir.join("out.zip"))
+        for large_file_size in (1 << 30, 1000):  # compressed on the pool, and streamed
+            with ParallelZipWriter(zip_filename, policy=CompressionPolicy(),
+                                   large_file_size=large_file_size) as zw:
+                for path in sorted(src.listdir()):
+                    zw.write(str(path), path.basename)
+            with zipfile.ZipFile(zip_filename) as zf:
+                assert zf.testzip() is None
+                compress_types = dict((i.filename, i.compress_type) for i in zf.infolist())
+            assert compress_types["photo.jpg"] == zipfile.ZIP_STORED
+            assert compress_types["random.bin"] == zipfile.ZIP_STORED  # failed the sample test
+            assert compress_types["text.bin"] == zipfile.ZIP_DEFLATED
+            assert compress_types["tiny.txt"] == zipfile.ZIP_STORED  # deflate would grow it
+
+    def test_unsupported_methods_fail_up_front(self, tmpdir):
+        zip_filename = tmpdir.join("out.zip")
+        with pytest.raises(ValueError):
+            ParallelZipWriter(str(zip_filename), compression=zipfile.ZIP_BZIP2)
+        assert not zip_filename.check()
+        with pytest.raises(ValueError):
+            CompressionPolicy(levels=[("*.txt", 12)])
+        with ParallelZipWriter(str(zip_filename)) as zw:
+            with pytest.raises(ValueError):
+                zw.writestr("a.txt", "a", compress_type=zipfile.ZIP_LZMA)
+            zw.writestr("a.txt", "a")  # the name wasn't taken